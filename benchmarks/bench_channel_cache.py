@@ -0,0 +1,71 @@
+# Copyright (c) 2022-2023 Geosiris.
+# SPDX-License-Identifier: Apache-2.0
+"""
+Feeding a ChannelRangeCache with ChannelData and reading the last minute of channels from it
+(etpproto.channel_cache).
+
+    python benchmarks/bench_channel_cache.py [nb_channels]
+"""
+
+import sys
+import timeit
+
+import numpy as np
+from etptypes.energistics.etp.v12.datatypes.channel_data.channel_range_info import (
+    ChannelRangeInfo,
+)
+from etptypes.energistics.etp.v12.datatypes.index_value import IndexValue
+from etptypes.energistics.etp.v12.datatypes.object.index_interval import (
+    IndexInterval,
+)
+
+from etpproto.channel_cache import ChannelRangeCache
+from etpproto.channel_data import ChannelDataColumns
+
+SECOND = 1_000_000
+
+if __name__ == "__main__":
+    nb_channels = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    rng = np.random.default_rng(0)
+    # a ChannelData per second, with a value per channel, for 20 minutes
+    batches = [
+        ChannelDataColumns(
+            channel_ids=np.arange(nb_channels),
+            indexes=[np.full(nb_channels, t * SECOND)],
+            values=rng.random(nb_channels),
+        )
+        for t in range(1200)
+    ]
+    cache = ChannelRangeCache(max_span=600 * SECOND)
+
+    def feed():
+        for columns in batches:
+            cache.add(columns)
+
+    duration = min(timeit.repeat(feed, number=1, repeat=1))
+    print(
+        f"add       {len(batches)} x {nb_channels} values : {duration:6.2f} s"
+        f" ({duration / len(batches) * 1e3:6.2f} ms/ChannelData)"
+    )
+
+    last_minute = [
+        ChannelRangeInfo(
+            channel_ids=list(range(nb_channels)),
+            interval=IndexInterval(
+                start_index=IndexValue(item=1140 * SECOND),
+                end_index=IndexValue(item=1200 * SECOND),
+                uom="us",
+            ),
+        )
+    ]
+    duration = min(
+        timeit.repeat(
+            lambda: cache.get_ranges(last_minute), number=1, repeat=5
+        )
+    )
+    cached, missed = cache.get_ranges(last_minute)
+    print(
+        f"get_range {nb_channels} channels, {len(cached)} values : "
+        f"{duration * 1e3:8.2f} ms ({duration / nb_channels * 1e6:6.2f} us/channel)"
+        f", hit ratio {cache.metrics.hit_ratio():.2f}"
+    )
@@ -0,0 +1,70 @@
+# Copyright (c) 2022-2023 Geosiris.
+# SPDX-License-Identifier: Apache-2.0
+"""
+Encoding and decoding of a ChannelData message, from DataItem models and from columns (etpproto.channel_data).
+
+    python benchmarks/bench_channel_data.py [nb_channels]
+"""
+
+import sys
+import timeit
+
+import numpy as np
+from etptypes.energistics.etp.v12.protocol.channel_streaming.channel_data import (
+    ChannelData,
+)
+
+from etpproto.channel_data import (
+    ChannelDataColumns,
+    decode_channel_data_message,
+)
+from etpproto.connection import ETPConnection
+from etpproto.messages import Message
+
+
+def report(name: str, func, nb_channels: int) -> None:
+    duration = min(timeit.repeat(func, number=1, repeat=5))
+    print(
+        f"{name:20s} {nb_channels} values : {duration * 1000:8.2f} ms"
+        f" ({duration / nb_channels * 1e6:6.2f} us/value)"
+    )
+
+
+if __name__ == "__main__":
+    nb_channels = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    rng = np.random.default_rng(0)
+    # a value per channel, at the same time
+    columns = ChannelDataColumns(
+        channel_ids=np.arange(nb_channels),
+        indexes=[np.full(nb_channels, 1_700_000_000_000_000)],
+        values=rng.random(nb_channels),
+    )
+    table = ETPConnection.generic_transition_table
+    encoded = Message.get_object_message(
+        ChannelData.construct(data=columns), msg_id=2
+    ).encode_message()
+
+    report(
+        "encode models",
+        lambda: Message.get_object_message(
+            ChannelData(data=columns.to_data_items()), msg_id=2
+        ).encode_message(),
+        nb_channels,
+    )
+    report(
+        "encode columns",
+        lambda: Message.get_object_message(
+            ChannelData.construct(data=columns), msg_id=2
+        ).encode_message(),
+        nb_channels,
+    )
+    report(
+        "decode models",
+        lambda: Message.decode_binary_message(encoded, table),
+        nb_channels,
+    )
+    report(
+        "decode columns",
+        lambda: decode_channel_data_message(encoded, table),
+        nb_channels,
+    )
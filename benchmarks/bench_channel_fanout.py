@@ -0,0 +1,78 @@
+# Copyright (c) 2022-2023 Geosiris.
+# SPDX-License-Identifier: Apache-2.0
+"""
+Sending a ChannelData message to the sessions subscribed to the same channels : encoded for each session,
+and encoded once with a ChannelFanout (etpproto.channel_fanout).
+
+    python benchmarks/bench_channel_fanout.py [nb_sessions] [nb_values]
+"""
+
+import asyncio
+import sys
+import time
+
+import numpy as np
+from etptypes.energistics.etp.v12.protocol.channel_subscribe.channel_data import (
+    ChannelData,
+)
+
+from etpproto.channel_data import ChannelDataColumns
+from etpproto.channel_fanout import ChannelFanout
+from etpproto.connection import ETPConnection
+from etpproto.messages import Message
+
+
+def connections(nb_sessions: int):
+    result = [ETPConnection() for _ in range(nb_sessions)]
+    for connection in result:
+        connection.is_connected = True
+        connection.client_info.endpoint_capabilities[
+            "MaxWebSocketMessagePayloadSize"
+        ] = (1 << 20)
+    return result
+
+
+async def per_session(sessions, columns) -> None:
+    for connection in sessions:
+        msg = Message.get_object_message(
+            ChannelData.construct(data=columns),
+            msg_id=connection.consume_msg_id(),
+            message_flags=2,
+        )
+        for frame in connection.encode_message_generator(msg):
+            connection.outbound_queue.put_nowait(frame)
+
+
+def report(name: str, func, sessions, columns) -> None:
+    durations = []
+    for _ in range(5):
+        start = time.perf_counter()
+        asyncio.run(func(sessions, columns))
+        durations.append(time.perf_counter() - start)
+        for connection in sessions:
+            connection._outbound_queue = None
+    duration = min(durations)
+    print(
+        f"{name:12s} {len(sessions)} sessions x {len(columns)} values : "
+        f"{duration * 1000:8.2f} ms ({duration / len(sessions) * 1e6:7.1f} us/session)"
+    )
+
+
+if __name__ == "__main__":
+    nb_sessions = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    nb_values = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    columns = ChannelDataColumns(
+        np.arange(nb_values),
+        [np.full(nb_values, 1_700_000_000_000_000)],
+        np.random.default_rng(0).random(nb_values),
+    )
+    sessions = connections(nb_sessions)
+    fanout = ChannelFanout()
+    for connection in sessions:
+        fanout.subscribe(connection, range(nb_values))
+
+    async def fan_out(sessions, columns) -> None:
+        await fanout.publish(columns)
+
+    report("per session", per_session, sessions, columns)
+    report("fan-out", fan_out, sessions, columns)
@@ -0,0 +1,95 @@
+# Copyright (c) 2022-2023 Geosiris.
+# SPDX-License-Identifier: Apache-2.0
+"""
+Streaming points produced in small chunks : a ChannelData message per chunk (encoded with the same
+EncodedBody path), and batched by a ChannelDataBatcher (etpproto.channel_flow).
+A consumer task drains the outbound queue of the connection.
+
+    python benchmarks/bench_channel_flow.py [nb_points] [chunk_size]
+"""
+
+import asyncio
+import sys
+import time
+
+import numpy as np
+from etptypes.energistics.etp.v12.protocol.channel_streaming.channel_data import (
+    ChannelData,
+)
+
+from etpproto.channel_data import ChannelDataColumns
+from etpproto.channel_flow import ChannelDataBatcher
+from etpproto.connection import ETPConnection
+from etpproto.messages import EncodedBody
+
+
+def connection() -> ETPConnection:
+    result = ETPConnection()
+    result.client_info.endpoint_capabilities[
+        "MaxWebSocketMessagePayloadSize"
+    ] = (1 << 20)
+    return result
+
+
+def chunks(nb_points: int, chunk_size: int):
+    rng = np.random.default_rng(0)
+    for start in range(0, nb_points, chunk_size):
+        yield ChannelDataColumns(
+            np.arange(chunk_size) % 100,
+            [1_700_000_000_000_000 + np.arange(start, start + chunk_size)],
+            rng.random(chunk_size),
+        )
+
+
+async def per_chunk(conn: ETPConnection, nb_points: int, chunk_size: int):
+    for columns in chunks(nb_points, chunk_size):
+        body = EncodedBody(ChannelData, columns.encode())
+        await conn.outbound_queue.put(
+            body.encode_message(conn.consume_msg_id(), 0, 2)
+        )
+
+
+async def batched(conn: ETPConnection, nb_points: int, chunk_size: int):
+    async with ChannelDataBatcher(conn) as batcher:
+        for columns in chunks(nb_points, chunk_size):
+            await batcher.add(columns)
+        stats = batcher.stats
+    print(
+        f"{'':12s} batch target {batcher.batch_bytes} bytes, "
+        f"{stats.size_flushes} size / {stats.latency_flushes} latency flushes"
+    )
+
+
+def report(name: str, func, nb_points: int, chunk_size: int) -> None:
+    async def run():
+        conn = connection()
+        queue = conn.outbound_queue
+        counts = [0, 0]
+
+        async def consume():
+            while True:
+                frame = await queue.get()
+                counts[0] += 1
+                counts[1] += len(frame)
+
+        consumer = asyncio.ensure_future(consume())
+        start = time.perf_counter()
+        await func(conn, nb_points, chunk_size)
+        while not queue.empty():
+            await asyncio.sleep(0)
+        duration = time.perf_counter() - start
+        consumer.cancel()
+        return duration, counts
+
+    duration, (nb_messages, nb_bytes) = asyncio.run(run())
+    print(
+        f"{name:12s} {nb_points} points in chunks of {chunk_size} : {duration * 1000:8.2f} ms "
+        f"({nb_points / duration / 1e6:5.2f} M points/s), {nb_messages} messages, {nb_bytes} bytes"
+    )
+
+
+if __name__ == "__main__":
+    nb_points = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    chunk_size = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    report("per chunk", per_chunk, nb_points, chunk_size)
+    report("batched", batched, nb_points, chunk_size)
@@ -0,0 +1,47 @@
+# Copyright (c) 2022-2023 Geosiris.
+# SPDX-License-Identifier: Apache-2.0
+"""
+Cost of the resolution of the handler method of a message (ChannelData, in the ChannelStreaming protocol).
+
+    python benchmarks/bench_dispatch.py [nb_messages]
+"""
+
+import sys
+import timeit
+
+from etptypes.energistics.etp.v12.protocol.channel_streaming.channel_data import (
+    ChannelData,
+)
+
+from etpproto.protocols.channel_streaming import ChannelStreamingHandler
+from etpproto.utils import get_handler_method, get_object_class, snake_case
+
+
+class Handler(ChannelStreamingHandler):
+    pass
+
+
+def by_name(handler, etp_object):
+    return getattr(
+        handler, "on_" + snake_case(get_object_class(etp_object).__name__)
+    )
+
+
+def by_table(handler, etp_object):
+    return get_handler_method(handler, get_object_class(etp_object))
+
+
+if __name__ == "__main__":
+    nb_messages = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    handler = Handler()
+    msg = ChannelData(data=[])
+    for func in (by_name, by_table):
+        duration = min(
+            timeit.repeat(
+                lambda: func(handler, msg), number=nb_messages, repeat=5
+            )
+        )
+        print(
+            f"{func.__name__:10s} {nb_messages} messages : {duration * 1000:7.2f} ms"
+            f" ({duration / nb_messages * 1e9:6.0f} ns/message)"
+        )
@@ -0,0 +1,114 @@
+# Copyright (c) 2022-2023 Geosiris.
+# SPDX-License-Identifier: Apache-2.0
+"""
+Peak resident memory of the upload of a large .npy file in PutDataSubarrays messages to a store
+that writes them in a memory-mapped file (etpproto.mapped_arrays).
+
+    python benchmarks/bench_mapped_arrays.py [size_mb]
+"""
+
+import asyncio
+import os
+import resource
+import sys
+import tempfile
+import time
+
+import numpy as np
+from etptypes.energistics.etp.v12.datatypes.data_array_types.data_array_identifier import (
+    DataArrayIdentifier,
+)
+from etptypes.energistics.etp.v12.datatypes.data_array_types.put_uninitialized_data_array_type import (
+    PutUninitializedDataArrayType,
+)
+from etptypes.energistics.etp.v12.protocol.data_array.put_uninitialized_data_arrays import (
+    PutUninitializedDataArrays,
+)
+
+from etpproto.connection import CommunicationProtocol, ETPConnection
+from etpproto.mapped_arrays import (
+    MappedArray,
+    MappedDataArrayHandler,
+    iter_put_data_subarrays,
+)
+from etpproto.messages import Message
+from etpproto.subarrays import data_array_metadata
+
+MAX_PAYLOAD_SIZE = 1 << 20
+
+UID = DataArrayIdentifier(
+    uri="eml:///dataspace('bench')", path_in_resource="/values"
+)
+
+
+def peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def write_source(path: str, nb_rows: int) -> None:
+    """Writes the source file by blocks, without holding it in memory"""
+    array = MappedArray.create(path, np.float64, (nb_rows, 1024))
+    for start in range(0, nb_rows, 64):
+        count = min(64, nb_rows - start)
+        array.write(
+            [start, 0],
+            [count, 1024],
+            np.arange(start * 1024, (start + count) * 1024, dtype=np.float64),
+        )
+    array.close()
+
+
+async def upload(directory: str, source: str) -> int:
+    class Store(MappedDataArrayHandler):
+        def array_path(self, uid, client_info=None):
+            return os.path.join(directory, "destination.npy")
+
+    store = ETPConnection(handlers={CommunicationProtocol.DATA_ARRAY: Store()})
+    store.is_connected = True
+    store.client_info.endpoint_capabilities[
+        "MaxWebSocketMessagePayloadSize"
+    ] = MAX_PAYLOAD_SIZE
+
+    async def send(body, msg_id: int) -> None:
+        msg = Message.get_object_message(body, msg_id=msg_id)
+        for msg_part in store.encode_message_generator(msg):
+            async for _ in store.handle_bytes_generator(msg_part):
+                pass
+
+    shape = np.load(source, mmap_mode="r").shape
+    await send(
+        PutUninitializedDataArrays(
+            data_arrays={
+                "0": PutUninitializedDataArrayType(
+                    uid=UID, metadata=data_array_metadata(np.float64, shape)
+                )
+            }
+        ),
+        msg_id=2,
+    )
+    nb_messages = 0
+    for body in iter_put_data_subarrays(UID, source, MAX_PAYLOAD_SIZE):
+        nb_messages += 1
+        await send(body, msg_id=2 + 2 * nb_messages)
+    return nb_messages
+
+
+if __name__ == "__main__":
+    size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 512
+    nb_rows = size_mb * (1 << 20) // (1024 * 8)
+    with tempfile.TemporaryDirectory() as directory:
+        source = os.path.join(directory, "source.npy")
+        write_source(source, nb_rows)
+        before = peak_rss_mb()
+        start = time.perf_counter()
+        nb_messages = asyncio.run(upload(directory, source))
+        duration = time.perf_counter() - start
+        print(
+            f"{size_mb} MB in {nb_messages} messages of {MAX_PAYLOAD_SIZE >> 10} kB :"
+            f" {duration:.2f} s ({size_mb / duration:.0f} MB/s),"
+            f" peak RSS {before:.0f} MB before, {peak_rss_mb():.0f} MB after"
+        )
+        destination = np.load(
+            os.path.join(directory, "destination.npy"), mmap_mode="r"
+        )
+        assert destination[-1, -1] == nb_rows * 1024 - 1
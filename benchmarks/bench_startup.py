@@ -0,0 +1,63 @@
+# Copyright (c) 2022-2023 Geosiris.
+# SPDX-License-Identifier: Apache-2.0
+"""
+Startup time of etpproto : import of etpproto.connection, and first decode of a message,
+each measured in a new python process.
+
+    python benchmarks/bench_startup.py [nb_runs]
+"""
+
+import statistics
+import subprocess
+import sys
+
+SCENARIOS = {
+    "import etpproto.connection": "import etpproto.connection",
+    "import + first decode": """
+from etptypes.energistics.etp.v12.protocol.core.ping import Ping
+from etpproto.connection import ETPConnection
+from etpproto.messages import Message
+Message.decode_binary_message(
+    Message.get_object_message(Ping(current_date_time=0), msg_id=1).encode_message(),
+    ETPConnection.generic_transition_table,
+)
+""",
+    "get_all_etp_protocol_classes (eager table)": """
+from etpproto.utils import get_all_etp_protocol_classes
+get_all_etp_protocol_classes()
+""",
+    "ProtocolTable without index (source scan)": """
+from etpproto.protocol_index import ProtocolTable
+len(ProtocolTable(index_path=None))
+""",
+}
+
+TIMER = """
+import time
+_start = time.perf_counter()
+{code}
+print(time.perf_counter() - _start)
+"""
+
+
+def run(code: str, nb_runs: int) -> list:
+    return [
+        float(
+            subprocess.run(
+                [sys.executable, "-c", TIMER.format(code=code)],
+                check=True,
+                capture_output=True,
+                text=True,
+            ).stdout
+        )
+        for _ in range(nb_runs)
+    ]
+
+
+if __name__ == "__main__":
+    nb_runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    for name, code in SCENARIOS.items():
+        times = run(code, nb_runs)
+        print(
+            f"{name:45s} min {min(times) * 1000:7.1f} ms   median {statistics.median(times) * 1000:7.1f} ms"
+        )
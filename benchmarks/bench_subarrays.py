@@ -0,0 +1,105 @@
+# Copyright (c) 2022-2023 Geosiris.
+# SPDX-License-Identifier: Apache-2.0
+"""
+Throughput of a SubarrayFetcher getting a data array from a store in memory, for several windows of requests
+in flight. Each message is delivered after a simulated network latency.
+
+    python benchmarks/bench_subarrays.py [nb_rows] [latency_ms]
+"""
+
+import asyncio
+import sys
+import time
+
+import numpy as np
+from etptypes.energistics.etp.v12.datatypes.data_array_types.data_array_identifier import (
+    DataArrayIdentifier,
+)
+from etptypes.energistics.etp.v12.datatypes.data_array_types.data_array_metadata import (
+    DataArrayMetadata,
+)
+from etptypes.energistics.etp.v12.protocol.data_array.get_data_array_metadata import (
+    GetDataArrayMetadata,
+)
+
+from etpproto.connection import (
+    CommunicationProtocol,
+    ConnectionType,
+    ETPConnection,
+)
+from etpproto.messages import Message
+from etpproto.subarrays import SubarrayFetcher, TiledDataArrayHandler
+
+MAX_PAYLOAD_SIZE = 1 << 20
+
+UID = DataArrayIdentifier(
+    uri="eml:///dataspace('bench')", path_in_resource="/values"
+)
+
+
+class Store(TiledDataArrayHandler):
+    def __init__(self, values):
+        self.values = values
+
+    async def get_array(self, uid, client_info=None):
+        return self.values
+
+
+def connect(connection: ETPConnection) -> ETPConnection:
+    connection.is_connected = True
+    connection.client_info.endpoint_capabilities[
+        "MaxWebSocketMessagePayloadSize"
+    ] = MAX_PAYLOAD_SIZE
+    return connection
+
+
+async def get_metadata(store: ETPConnection) -> DataArrayMetadata:
+    request = Message.get_object_message(
+        GetDataArrayMetadata(data_arrays={"0": UID}), msg_id=2
+    )
+    async for answer in store.handle_bytes_generator(request.encode_message()):
+        msg = Message.decode_binary_message(
+            answer, ETPConnection.generic_transition_table
+        )
+        return msg.body.array_metadata["0"]
+
+
+async def fetch(values, max_in_flight: int, latency: float) -> float:
+    store = connect(
+        ETPConnection(
+            handlers={CommunicationProtocol.DATA_ARRAY: Store(values)}
+        )
+    )
+    client = connect(ETPConnection(connection_type=ConnectionType.CLIENT))
+
+    async def deliver(msg_data: bytes) -> None:
+        await asyncio.sleep(latency)
+        async for answer in store.handle_bytes_generator(msg_data):
+            async for _ in client.handle_bytes_generator(answer):
+                pass
+
+    async def send(msg_data: bytes) -> None:
+        asyncio.ensure_future(deliver(msg_data))
+
+    fetcher = SubarrayFetcher(client, send, max_in_flight=max_in_flight)
+    client.handlers[CommunicationProtocol.DATA_ARRAY] = fetcher
+    metadata = await get_metadata(store)
+
+    start = time.perf_counter()
+    array = await fetcher.fetch(UID, metadata)
+    duration = time.perf_counter() - start
+    assert np.array_equal(array, values)
+    return duration
+
+
+if __name__ == "__main__":
+    nb_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 4000
+    latency = (float(sys.argv[2]) if len(sys.argv) > 2 else 5.0) / 1000
+    values = np.random.default_rng(0).random((nb_rows, 1000))
+    size = values.nbytes / 1e6
+    for max_in_flight in (1, 2, 4, 8, 16):
+        duration = asyncio.run(fetch(values, max_in_flight, latency))
+        print(
+            f"{max_in_flight:2d} in flight : {size:.0f} MB in {duration * 1000:8.2f} ms"
+            f" ({size / duration:7.1f} MB/s)"
+        )
@@ -0,0 +1,385 @@
+# Copyright (c) 2022-2023 Geosiris.
+# SPDX-License-Identifier: Apache-2.0
+"""
+In-memory cache of the recent data of the channels, to answer GetRanges (ChannelSubscribe protocol).
+
+A :class:`ChannelRangeCache` keeps the last points of each channel in a :class:`ChannelRingBuffer`, sized by bytes
+and/or by index span (e.g. the last 10 minutes of a time channel). It is fed with the ChannelData sent to the
+customers (give it to the ChannelFanout or the ChannelDataBatcher that sends them), and answers the ranges that start
+after the oldest point kept for the channel. The other ranges (misses) are returned to be read from the store.
+:class:`CachedChannelSubscribeHandler` answers GetRanges this way, the hits are encoded from the columns.
+
+    range_cache = ChannelRangeCache(max_span=600_000_000)
+    fanout = ChannelFanout(range_cache=range_cache)
+    connection.handlers[CommunicationProtocol.CHANNEL_SUBSCRIBE] = MyCachedHandler(range_cache)
+
+Only the channels with a single index are kept (the ranges of the others are misses), and only scalar values
+(see etpproto.channel_data).
+
+Requires numpy (see etpproto.numpy_codec).
+"""
+
+from dataclasses import dataclass
+from typing import (
+    Any,
+    AsyncGenerator,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
+
+from etptypes.energistics.etp.v12.datatypes.channel_data.channel_range_info import (
+    ChannelRangeInfo,
+)
+from etptypes.energistics.etp.v12.datatypes.channel_data.data_item import (
+    DataItem,
+)
+from etptypes.energistics.etp.v12.datatypes.message_header import MessageHeader
+from etptypes.energistics.etp.v12.protocol.channel_subscribe.get_ranges import (
+    GetRanges,
+)
+from etptypes.energistics.etp.v12.protocol.channel_subscribe.get_ranges_response import (
+    GetRangesResponse,
+)
+
+from etpproto.channel_data import ChannelDataColumns
+from etpproto.channel_fanout import encode_bodies, max_body_size
+from etpproto.client_info import ClientInfo
+from etpproto.error import NotSupportedError
+from etpproto.messages import EncodedBody, Message, ResponseBuilder
+from etpproto.numpy_codec import np
+from etpproto.protocols.channel_subscribe import ChannelSubscribeHandler
+
+
+class ChannelRingBuffer:
+    """
+    The last points (index, value) of a channel, in increasing index order.
+    The points are kept in arrays of twice the capacity : they are written after the last one, and the points kept
+    are moved back to the start of the arrays when their end is reached. The points are thus always contiguous,
+    and a range is found by binary search on the index column (numpy.searchsorted).
+    A point with an index lower or equal to the last one replaces the points from its index.
+    The arrays are promoted (numpy.result_type) when points of another type are appended (e.g. float values
+    in a buffer created with int values), the points are not cast to the type of the first ones.
+
+    :ivar capacity: max number of points
+    :ivar max_span: if not None, the points older than the last index minus max_span are dropped
+        (e.g. a duration in microseconds for a time index)
+    """
+
+    def __init__(
+        self,
+        capacity: int,
+        index_dtype: Any = np.int64,
+        value_dtype: Any = np.float64,
+        max_span: Optional[Union[int, float]] = None,
+    ) -> None:
+        if capacity < 1:
+            raise ValueError("The capacity must be at least 1")
+        self.capacity = capacity
+        self.max_span = max_span
+        self._indexes = np.empty(2 * capacity, dtype=index_dtype)
+        self._values = np.empty(2 * capacity, dtype=value_dtype)
+        self._start = 0
+        self._end = 0
+
+    def __len__(self) -> int:
+        return self._end - self._start
+
+    @property
+    def indexes(self) -> Any:
+        return self._indexes[self._start : self._end]
+
+    @property
+    def values(self) -> Any:
+        return self._values[self._start : self._end]
+
+    def append(self, indexes: Any, values: Any) -> None:
+        """Appends points, in increasing index order"""
+        if len(indexes) == 0:
+            return
+        indexes = np.asarray(indexes)
+        values = np.asarray(values)
+        self._indexes = _promote(self._indexes, indexes)
+        self._values = _promote(self._values, values)
+        if len(indexes) > self.capacity:
+            indexes = indexes[-self.capacity :]
+            values = values[-self.capacity :]
+        size = len(indexes)
+        if len(self) > 0 and indexes[0] <= self._indexes[self._end - 1]:
+            # the points from indexes[0] are replaced
+            self._end = self._start + int(
+                np.searchsorted(self.indexes, indexes[0], side="left")
+            )
+        if len(self) + size > self.capacity:
+            self._start = self._end - (self.capacity - size)
+        if self._end + size > len(self._indexes):
+            kept = len(self)
+            self._indexes[:kept] = self.indexes
+            self._values[:kept] = self.values
+            self._start, self._end = 0, kept
+        self._indexes[self._end : self._end + size] = indexes
+        self._values[self._end : self._end + size] = values
+        self._end += size
+        if self.max_span is not None:
+            oldest = self._indexes[self._end - 1] - self.max_span
+            if self._indexes[self._start] < oldest:
+                self._start += int(self.indexes.searchsorted(oldest))
+
+    def range(
+        self, start: Union[int, float], end: Union[int, float]
+    ) -> Optional[Tuple[Any, Any]]:
+        """
+        Returns copies of the indexes and values of the points from :param start: to :param end: (included),
+        None if the buffer does not hold all of them (it is empty or start is before its oldest point).
+        """
+        if len(self) == 0 or start < self._indexes[self._start]:
+            return None
+        indexes = self.indexes
+        first = int(np.searchsorted(indexes, start, side="left"))
+        last = int(np.searchsorted(indexes, end, side="right"))
+        return (
+            indexes[first:last].copy(),
+            self._values[self._start + first : self._start + last].copy(),
+        )
+
+
+def _promote(array: Any, added: Any) -> Any:
+    """Returns :param array: with a dtype that can hold its values and the values :param added:"""
+    try:
+        dtype = np.result_type(array, added)
+    except TypeError:
+        dtype = np.dtype(object)
+    if dtype.kind in "SU" and array.dtype.kind != added.dtype.kind:
+        # numbers and strings : the numbers are not converted to strings
+        dtype = np.dtype(object)
+    return array if dtype == array.dtype else array.astype(dtype)
+
+
+@dataclass
+class CacheMetrics:
+    """
+    :ivar hits: number of channel ranges answered by the cache
+    :ivar misses: number of channel ranges not in the cache
+    :ivar points: number of points answered by the cache
+    """
+
+    hits: int = 0
+    misses: int = 0
+    points: int = 0
+
+    def hit_ratio(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+
+class ChannelRangeCache:
+    """
+    A :class:`ChannelRingBuffer` per channel, created with the first data of the channel.
+
+        cache = ChannelRangeCache(max_bytes_per_channel=1 << 20, max_span=600_000_000)
+        cache.add(columns)  # the data sent in ChannelData messages
+        cached, missed = cache.get_ranges(get_ranges.channel_ranges)
+
+    :ivar max_bytes_per_channel: size of the points kept for a channel (index and value)
+    :ivar max_span: see ChannelRingBuffer.max_span
+    :ivar channels: the buffers, by channel id
+    :ivar metrics: the hits and misses of the cache
+    """
+
+    def __init__(
+        self,
+        max_bytes_per_channel: int = 1 << 20,
+        max_span: Optional[Union[int, float]] = None,
+    ) -> None:
+        self.max_bytes_per_channel = max_bytes_per_channel
+        self.max_span = max_span
+        self.channels: Dict[int, ChannelRingBuffer] = {}
+        self.metrics = CacheMetrics()
+
+    def add(self, data: Union[ChannelDataColumns, Any]) -> None:
+        """Adds the points of ChannelDataColumns, of a ChannelData body or of a list of DataItems"""
+        if not isinstance(data, ChannelDataColumns):
+            data = getattr(data, "data", data)
+            if not isinstance(data, ChannelDataColumns):
+                data = ChannelDataColumns.from_data_items(data)
+        if len(data) == 0:
+            return
+        if len(data.indexes) != 1:
+            # the DataItems of the answers would miss indexes : the ranges of these channels are misses
+            for channel_id in np.unique(data.channel_ids).tolist():
+                self.channels.pop(channel_id, None)
+            return
+        channel_ids = data.channel_ids
+        order = np.argsort(channel_ids, kind="stable")
+        boundaries = np.flatnonzero(np.diff(channel_ids[order])) + 1
+        for points in np.split(order, boundaries):
+            channel_id = int(channel_ids[points[0]])
+            indexes = data.indexes[0][points]
+            values = data.values[points]
+            buffer = self.channels.get(channel_id)
+            if buffer is None:
+                buffer = ChannelRingBuffer(
+                    max(
+                        1,
+                        self.max_bytes_per_channel
+                        // (indexes.dtype.itemsize + values.dtype.itemsize),
+                    ),
+                    index_dtype=indexes.dtype,
+                    value_dtype=values.dtype,
+                    max_span=self.max_span,
+                )
+                self.channels[channel_id] = buffer
+            buffer.append(indexes, values)
+
+    def lookup(
+        self, channel_id: int, start: Union[int, float], end: Union[int, float]
+    ) -> Optional[Tuple[Any, Any]]:
+        """Returns the indexes and values of a channel from :param start: to :param end:, None if it is a miss"""
+        buffer = self.channels.get(channel_id)
+        found = buffer.range(start, end) if buffer is not None else None
+        if found is None:
+            self.metrics.misses += 1
+        else:
+            self.metrics.hits += 1
+            self.metrics.points += len(found[0])
+        return found
+
+    def latest(
+        self,
+        channel_id: int,
+        start: Optional[Union[int, float]] = None,
+        count: Optional[int] = None,
+    ) -> Optional[Tuple[Any, Any]]:
+        """
+        Returns the indexes and values of a channel from :param start: (included), or its last :param count:
+        points, None if the cache does not hold all of them (see ChannelSubscribeInfo.startIndex and
+        requestLatestIndexCount). The metrics are not updated.
+        """
+        buffer = self.channels.get(channel_id)
+        if buffer is None:
+            return None
+        if count is not None:
+            if count > len(buffer):
+                return None
+            return (
+                buffer.indexes[len(buffer) - count :].copy(),
+                buffer.values[len(buffer) - count :].copy(),
+            )
+        if start is None:
+            return None
+        return buffer.range(start, np.inf)
+
+    def get_ranges(
+        self, channel_ranges: Sequence[ChannelRangeInfo]
+    ) -> Tuple[ChannelDataColumns, List[ChannelRangeInfo]]:
+        """
+        Returns the points of the ranges of a GetRanges message that are in the cache,
+        and the ranges (with the channels that are not in the cache) to read from the store.
+        The ranges with secondary intervals or PassIndexedDepth indexes are not answered by the cache.
+        """
+        channel_ids: List[Any] = []
+        indexes: List[Any] = []
+        values: List[Any] = []
+        missed = []
+        for channel_range in channel_ranges:
+            start = channel_range.interval.start_index.item
+            end = channel_range.interval.end_index.item
+            if (
+                len(channel_range.secondary_intervals) > 0
+                or not isinstance(start, (int, float))
+                or not isinstance(end, (int, float))
+            ):
+                self.metrics.misses += len(channel_range.channel_ids)
+                missed.append(channel_range)
+                continue
+            missed_ids = []
+            for channel_id in channel_range.channel_ids:
+                found = self.lookup(channel_id, start, end)
+                if found is None:
+                    missed_ids.append(channel_id)
+                else:
+                    channel_ids.append(np.full(len(found[0]), channel_id))
+                    indexes.append(found[0])
+                    values.append(found[1])
+            if len(missed_ids) > 0:
+                missed.append(
+                    channel_range.copy(update={"channel_ids": missed_ids})
+                )
+        if len(channel_ids) == 0:
+            return ChannelDataColumns([], [], []), missed
+        return (
+            ChannelDataColumns(
+                np.concatenate(channel_ids),
+                [np.concatenate(indexes)],
+                np.concatenate(values),
+            ),
+            missed,
+        )
+
+
+class CachedChannelSubscribeHandler(ChannelSubscribeHandler):
+    """
+    ChannelSubscribeHandler of a store that answers GetRanges from a :class:`ChannelRangeCache`
+    and reads the ranges that are not in the cache with :meth:`get_ranges_from_store`.
+    The cache is fed by the ChannelFanout or the ChannelDataBatcher that sends the ChannelData to the customers
+    (see their range_cache). The answer is streamed in GetRangesResponse messages : the hits are encoded
+    from their columns, then the DataItems of the store follow (see etpproto.messages.ResponseBuilder).
+
+    :ivar range_cache: the cache, may be shared by the handlers of several connections
+    """
+
+    def __init__(self, range_cache: Optional[ChannelRangeCache] = None):
+        self.range_cache = (
+            range_cache if range_cache is not None else ChannelRangeCache()
+        )
+
+    async def get_ranges_from_store(
+        self,
+        channel_ranges: List[ChannelRangeInfo],
+        client_info: Union[None, ClientInfo] = None,
+    ) -> List[DataItem]:
+        """Returns the DataItems of ranges that are not in the cache"""
+        raise NotSupportedError()
+
+    async def on_get_ranges(
+        self,
+        msg: GetRanges,
+        msg_header: MessageHeader,
+        client_info: Union[None, ClientInfo] = None,
+    ) -> AsyncGenerator[Optional[Message], None]:
+        cached, missed = self.range_cache.get_ranges(msg.channel_ranges)
+        encoded_bodies = (
+            [
+                EncodedBody(GetRangesResponse, body)
+                for body in encode_bodies(
+                    cached,
+                    max_body_size(
+                        client_info.getCapability(
+                            "MaxWebSocketMessagePayloadSize"
+                        )
+                        if client_info is not None
+                        else None
+                    ),
+                )
+            ]
+            if len(cached) > 0
+            else []
+        )
+
+        async def data_items() -> AsyncGenerator[DataItem, None]:
+            if len(missed) > 0:
+                for item in await self.get_ranges_from_store(
+                    missed, client_info
+                ):
+                    yield item
+
+        yield ResponseBuilder(
+            GetRangesResponse(data=[]),
+            "data",
+            data_items(),
+            correlation_id=msg_header.message_id,
+            encoded_bodies=encoded_bodies,
+        )
@@ -0,0 +1,395 @@
+# Copyright (c) 2022-2023 Geosiris.
+# SPDX-License-Identifier: Apache-2.0
+"""
+Columnar encoding of the ChannelData messages (ChannelStreaming, ChannelSubscribe and ChannelDataLoad protocols).
+
+A :class:`ChannelDataColumns` holds the DataItems of a ChannelData message as columns : an array of channel ids,
+an array per index and an array of values. Its avro encoding is written in a single pass with vectorized
+numpy operations, instead of building and serializing a DataItem model per value :
+
+    columns = ChannelDataColumns(channel_ids, [times], values)
+    msg = Message.get_object_message(ChannelData.construct(data=columns), msg_id=...)
+
+and :func:`decode_channel_data_message` reads a received ChannelData message as columns.
+
+Only the scalar values (boolean, int, long, float, double) and the long/double indexes are supported,
+without value attributes : the other DataItems are built and read as models.
+
+Requires numpy (see etpproto.numpy_codec).
+"""
+
+import struct
+from array import array
+from dataclasses import dataclass
+from io import BytesIO
+from typing import IO, Any, List, Optional, Sequence, Tuple
+
+import etptypes.energistics.etp.v12.datatypes.message_header as mh
+from etptypes.energistics.etp.v12.datatypes.channel_data.data_item import (
+    DataItem,
+)
+from etptypes.energistics.etp.v12.datatypes.data_value import DataValue
+from etptypes.energistics.etp.v12.datatypes.index_value import IndexValue
+
+from etpproto.codec import (
+    MessageCodec,
+    get_codec,
+    get_header_codec,
+    header_from_record,
+)
+from etpproto.compression import decompress_body
+from etpproto.messages import MessageFlags
+from etpproto.numpy_codec import (
+    _read_block_count,
+    decode_long,
+    encode_long,
+    np,
+    varint_groups,
+)
+from etpproto.utils import ProtocolDict
+
+#: protocols of the ChannelData messages : ChannelStreaming (1), ChannelSubscribe (21), ChannelDataLoad (22)
+CHANNEL_DATA_PROTOCOLS = {1, 21, 22}
+
+#: {numpy dtype name: index of the DataValue union branch}
+VALUE_BRANCHES = {
+    "bool": 1,
+    "int8": 2,
+    "int16": 2,
+    "int32": 2,
+    "uint8": 2,
+    "uint16": 2,
+    "int64": 3,
+    "uint32": 3,
+    "float32": 4,
+    "float64": 5,
+}
+
+#: {index of the DataValue union branch: numpy dtype of the values}
+BRANCH_DTYPES = {1: "?", 2: "<i4", 3: "<i8", 4: "<f4", 5: "<f8"}
+
+# branches of the IndexValue union
+_LONG_INDEX = 1
+_DOUBLE_INDEX = 2
+
+_float = struct.Struct("<f")
+_double = struct.Struct("<d")
+
+
+@dataclass(eq=False)
+class ChannelDataColumns:
+    """
+    The DataItems of a ChannelData message, as columns : the i-th DataItem has the channel id channel_ids[i],
+    the indexes [index[i] for index in indexes] and the value values[i].
+    :ivar channel_ids: integer array
+    :ivar indexes: an array per index, of integers (long index, e.g. time) or floats (double index, e.g. depth)
+    :ivar values: array of booleans, integers or floats
+    """
+
+    channel_ids: Any
+    indexes: List[Any]
+    values: Any
+
+    def __post_init__(self) -> None:
+        self.channel_ids = np.asarray(self.channel_ids, dtype=np.int64)
+        self.indexes = [np.asarray(index) for index in self.indexes]
+        self.values = np.asarray(self.values)
+        if self.values.dtype.name not in VALUE_BRANCHES:
+            raise TypeError(
+                f"Unsupported dtype for ChannelData values : {self.values.dtype}"
+            )
+        if any(
+            len(column) != len(self.channel_ids)
+            for column in [self.values, *self.indexes]
+        ):
+            raise ValueError("The columns have different lengths")
+
+    def __len__(self) -> int:
+        return len(self.channel_ids)
+
+    def encode(self) -> bytes:
+        """Returns the avro encoding of the ChannelData message body"""
+        return encode_channel_data(self)
+
+    def take(self, rows: Any) -> "ChannelDataColumns":
+        """Returns the DataItems selected by :param rows: (a slice, an array of positions or a boolean mask)"""
+        return ChannelDataColumns(
+            self.channel_ids[rows],
+            [index[rows] for index in self.indexes],
+            self.values[rows],
+        )
+
+    @classmethod
+    def concat(
+        cls, columns: Sequence["ChannelDataColumns"]
+    ) -> "ChannelDataColumns":
+        """The DataItems of several ChannelDataColumns (with the same number of indexes), in their order"""
+        if len(columns) == 1:
+            return columns[0]
+        return cls(
+            np.concatenate([c.channel_ids for c in columns]),
+            [
+                np.concatenate([c.indexes[i] for c in columns])
+                for i in range(len(columns[0].indexes))
+            ],
+            np.concatenate([c.values for c in columns]),
+        )
+
+    def to_data_items(self) -> List[DataItem]:
+        index_columns = [index.tolist() for index in self.indexes]
+        return [
+            DataItem(
+                channel_id=channel_id,
+                indexes=[IndexValue(item=index[i]) for index in index_columns],
+                value=DataValue(item=value),
+                value_attributes=[],
+            )
+            for i, (channel_id, value) in enumerate(
+                zip(self.channel_ids.tolist(), self.values.tolist())
+            )
+        ]
+
+    @classmethod
+    def from_data_items(cls, data: Sequence[Any]) -> "ChannelDataColumns":
+        """Columns of DataItem models (or views) with scalar values"""
+        nb_indexes = len(data[0].indexes) if len(data) > 0 else 0
+        return cls(
+            channel_ids=[item.channel_id for item in data],
+            indexes=[
+                [item.indexes[i].item for item in data]
+                for i in range(nb_indexes)
+            ],
+            values=[item.value.item for item in data],
+        )
+
+
+def _fixed_column(values: Any, dtype: str) -> Tuple[Any, Any]:
+    matrix = (
+        np.ascontiguousarray(values, dtype=dtype)
+        .view(np.uint8)
+        .reshape(len(values), -1)
+    )
+    return matrix, np.ones(matrix.shape, dtype=bool)
+
+
+def _constant_column(value: bytes, nb_rows: int) -> Tuple[Any, Any]:
+    return (
+        np.broadcast_to(
+            np.frombuffer(value, dtype=np.uint8), (nb_rows, len(value))
+        ),
+        np.ones((nb_rows, len(value)), dtype=bool),
+    )
+
+
+def encode_channel_data(columns: ChannelDataColumns) -> bytes:
+    """
+    Returns the avro encoding of a ChannelData message body. Each field is encoded for all the DataItems
+    at once, as a matrix of bytes with a row per DataItem, and the rows are concatenated.
+    """
+    nb_rows = len(columns)
+    if nb_rows == 0:
+        return b"\x00"
+    parts = [varint_groups(columns.channel_ids)]
+    if len(columns.indexes) > 0:
+        parts.append(
+            _constant_column(encode_long(len(columns.indexes)), nb_rows)
+        )
+    for index in columns.indexes:
+        if index.dtype.kind == "f":
+            parts.append(_constant_column(encode_long(_DOUBLE_INDEX), nb_rows))
+            parts.append(_fixed_column(index, "<f8"))
+        else:
+            parts.append(_constant_column(encode_long(_LONG_INDEX), nb_rows))
+            parts.append(varint_groups(index))
+    # end of the indexes
+    parts.append(_constant_column(b"\x00", nb_rows))
+    branch = VALUE_BRANCHES[columns.values.dtype.name]
+    parts.append(_constant_column(encode_long(branch), nb_rows))
+    if branch in (2, 3):
+        parts.append(varint_groups(columns.values))
+    else:
+        parts.append(_fixed_column(columns.values, BRANCH_DTYPES[branch]))
+    # no value attributes
+    parts.append(_constant_column(b"\x00", nb_rows))
+
+    matrix = np.concatenate([matrix for matrix, _ in parts], axis=1)
+    mask = np.concatenate([mask for _, mask in parts], axis=1)
+    return encode_long(nb_rows) + matrix[mask].tobytes() + b"\x00"
+
+
+def decode_channel_data(
+    buffer: Any, pos: int = 0
+) -> Tuple[ChannelDataColumns, int]:
+    """
+    Reads a ChannelData message body at :param pos: as columns, returns them and the position after the body.
+    Raises a ValueError if a DataItem can not be put in columns (not scalar value, PassIndexedDepth index,
+    value attributes, or not the same number of indexes for all the DataItems).
+    """
+    buffer = memoryview(buffer).cast("B")
+    channel_ids = array("q")
+    indexes: Optional[List[list]] = None
+    index_branches: List[set] = []
+    values: list = []
+    value_branches = set()
+    unpack_double = _double.unpack_from
+    while True:
+        count, pos = _read_block_count(buffer, pos)
+        if count == 0:
+            break
+        for _ in range(count):
+            # the varints of a single byte (most of the ids, counts and union branches) are read inline
+            b = buffer[pos]
+            if b < 0x80:
+                channel_ids.append((b >> 1) ^ -(b & 1))
+                pos += 1
+            else:
+                channel_id, pos = decode_long(buffer, pos)
+                channel_ids.append(channel_id)
+
+            item_indexes = []
+            while True:
+                nb_indexes, pos = _read_block_count(buffer, pos)
+                if nb_indexes == 0:
+                    break
+                for _ in range(nb_indexes):
+                    branch = buffer[pos] >> 1
+                    pos += 1
+                    if branch == _LONG_INDEX:
+                        index, pos = decode_long(buffer, pos)
+                    elif branch == _DOUBLE_INDEX:
+                        index = unpack_double(buffer, pos)[0]
+                        pos += 8
+                    else:
+                        raise ValueError(
+                            "Only long and double indexes can be put in columns"
+                        )
+                    item_indexes.append((branch, index))
+            if indexes is None:
+                indexes = [[] for _ in item_indexes]
+                index_branches = [set() for _ in item_indexes]
+            if len(item_indexes) != len(indexes):
+                raise ValueError(
+                    "The DataItems do not have the same number of indexes"
+                )
+            for column, branches, (branch, index) in zip(
+                indexes, index_branches, item_indexes
+            ):
+                column.append(index)
+                branches.add(branch)
+
+            branch = buffer[pos] >> 1
+            pos += 1
+            if branch == 5:
+                value = unpack_double(buffer, pos)[0]
+                pos += 8
+            elif branch in (2, 3):
+                value, pos = decode_long(buffer, pos)
+            elif branch == 4:
+                value = _float.unpack_from(buffer, pos)[0]
+                pos += 4
+            elif branch == 1:
+                value = buffer[pos] != 0
+                pos += 1
+            else:
+                raise ValueError(
+                    "Only boolean, int, long, float and double values can be put in columns"
+                )
+            values.append(value)
+            value_branches.add(branch)
+
+            if buffer[pos] != 0:
+                raise ValueError("Value attributes can not be put in columns")
+            pos += 1
+
+    return (
+        ChannelDataColumns(
+            channel_ids=np.frombuffer(channel_ids, dtype=np.int64),
+            indexes=[
+                np.array(
+                    column,
+                    dtype=(
+                        np.int64 if branches == {_LONG_INDEX} else np.float64
+                    ),
+                )
+                for column, branches in zip(indexes or [], index_branches)
+            ],
+            values=np.array(values, dtype=_values_dtype(value_branches)),
+        ),
+        pos,
+    )
+
+
+def _values_dtype(branches: set) -> str:
+    if len(branches) == 0:
+        return "<f8"
+    if len(branches) == 1:
+        return BRANCH_DTYPES[next(iter(branches))]
+    if branches <= {1, 2, 3}:
+        return "<i8"
+    return "<f8"
+
+
+def decode_channel_data_message(
+    binary: bytes,
+    dict_map_pro_to_class: ProtocolDict,
+    max_decompressed_size: Optional[int] = None,
+) -> Optional[Tuple[mh.MessageHeader, ChannelDataColumns]]:
+    """
+    Reads a received ChannelData message (ChannelStreaming, ChannelSubscribe or ChannelDataLoad) as columns,
+    without building the DataItem models. Returns None if it is another message.
+    A compressed body larger than :param max_decompressed_size: raises a MaxSizeExceededError.
+
+        decoded = decode_channel_data_message(msg_data, ETPConnection.generic_transition_table)
+    """
+    fo = BytesIO(binary)
+    header = get_header_codec().read(fo)
+    if header["protocol"] not in CHANNEL_DATA_PROTOCOLS:
+        return None
+    try:
+        codec = get_codec(
+            header["protocol"], header["messageType"], dict_map_pro_to_class
+        )
+    except KeyError:
+        return None
+    if codec.object_class.__name__ != "ChannelData":
+        return None
+    if header["messageFlags"] & MessageFlags.COMPRESSED:
+        columns, _ = decode_channel_data(
+            decompress_body(
+                memoryview(binary)[fo.tell() :], max_decompressed_size
+            )
+        )
+    else:
+        columns, _ = decode_channel_data(binary, fo.tell())
+    return header_from_record(header), columns
+
+
+@dataclass(frozen=True)
+class ChannelDataCodec(MessageCodec):
+    """MessageCodec of the ChannelData messages, that writes their DataItems from a :class:`ChannelDataColumns`"""
+
+    def write(self, fo: IO, record: Any) -> None:
+        data = record["data"]
+        if isinstance(data, ChannelDataColumns):
+            fo.write(encode_channel_data(data))
+        else:
+            super().write(fo, record)
+
+
+def channel_data_codec(codec: MessageCodec) -> MessageCodec:
+    """
+    Returns a ChannelDataCodec for the ChannelData messages, else :param codec:.
+    The ChannelData are decoded as models, numpy is only used to encode a ChannelDataColumns.
+    """
+    if (
+        codec.protocol not in CHANNEL_DATA_PROTOCOLS
+        or codec.object_class.__name__ != "ChannelData"
+    ):
+        return codec
+    return ChannelDataCodec(
+        object_class=codec.object_class,
+        protocol=codec.protocol,
+        message_type=codec.message_type,
+        schema=codec.schema,
+        parsed_schema=codec.parsed_schema,
+    )
@@ -0,0 +1,486 @@
+# Copyright (c) 2022-2023 Geosiris.
+# SPDX-License-Identifier: Apache-2.0
+"""
+Fan-out of the channel data to the sessions that subscribed to the channels (ChannelSubscribe and
+ChannelStreaming protocols).
+
+A :class:`ChannelFanout` is shared by all the connections of a process. It keeps the subscribers of each channel,
+and :meth:`ChannelFanout.publish` sends a batch of points to all of them : the ChannelData body is encoded (and
+compressed) once for all the sessions that get the same channels, only the message header (message id,
+correlation id, flags) is encoded for each session (see etpproto.messages.EncodedBody).
+
+    fanout = ChannelFanout()
+    fanout.subscribe(connection, [1, 2, 3])  # e.g. in SubscribeChannels (see FanoutChannelSubscribeHandler)
+    await fanout.publish(ChannelDataColumns(channel_ids, [times], values))
+    fanout.unsubscribe(connection)  # when the websocket is closed
+The sessions of the connections closed by a CloseSession message are dropped by the next publish.
+
+Requires numpy (see etpproto.channel_data).
+"""
+
+import asyncio
+from dataclasses import dataclass, field
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    AsyncGenerator,
+    Awaitable,
+    Callable,
+    Dict,
+    FrozenSet,
+    Iterable,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
+
+from etptypes.energistics.etp.v12.datatypes.channel_data.channel_subscribe_info import (
+    ChannelSubscribeInfo,
+)
+from etptypes.energistics.etp.v12.datatypes.message_header import MessageHeader
+from etptypes.energistics.etp.v12.protocol.channel_subscribe.subscribe_channels import (
+    SubscribeChannels,
+)
+from etptypes.energistics.etp.v12.protocol.channel_subscribe.subscribe_channels_response import (
+    SubscribeChannelsResponse,
+)
+from etptypes.energistics.etp.v12.protocol.channel_subscribe.subscriptions_stopped import (
+    SubscriptionsStopped,
+)
+from etptypes.energistics.etp.v12.protocol.channel_subscribe.unsubscribe_channels import (
+    UnsubscribeChannels,
+)
+from etptypes.energistics.etp.v12.protocol.core.protocol_exception import (
+    ProtocolException,
+)
+
+from etpproto.channel_data import ChannelDataColumns
+from etpproto.client_info import ClientInfo
+from etpproto.codec import MAX_HEADER_SIZE
+from etpproto.compression import get_compressor
+from etpproto.connection import CommunicationProtocol, ETPConnection
+from etpproto.error import (
+    BackPressureLimitExceededError,
+    ETPError,
+    MaxSizeExceededError,
+    NotSupportedError,
+)
+from etpproto.messages import EncodedBody, Message, MessageFlags
+from etpproto.numpy_codec import np
+from etpproto.protocols.channel_subscribe import ChannelSubscribeHandler
+from etpproto.utils import get_class_from_protocol_and_name
+
+if TYPE_CHECKING:
+    from etpproto.channel_cache import ChannelRangeCache
+
+
+def max_body_size(max_payload_size: Optional[int]) -> int:
+    """Returns the max size of a message body for a max payload size, -1 if it is not limited"""
+    if max_payload_size is None or max_payload_size <= 0:
+        return -1
+    return max_payload_size - MAX_HEADER_SIZE
+
+
+@dataclass(eq=False)
+class FanoutSession:
+    """
+    A connection that subscribed to channels of a :class:`ChannelFanout`.
+    :ivar connection: the ETPConnection of the session, that gives the message ids, the max payload size
+        and the compression
+    :ivar channel_ids: the subscribed channels
+    :ivar protocol: protocol of the ChannelData messages (ChannelSubscribe or ChannelStreaming)
+    :ivar correlation_id: correlation id of the ChannelData messages
+    :ivar send: sends a binary message, if None the messages are put in the outbound_queue of the connection
+    """
+
+    connection: ETPConnection
+    channel_ids: Set[int] = field(default_factory=set)
+    protocol: CommunicationProtocol = CommunicationProtocol.CHANNEL_SUBSCRIBE
+    correlation_id: int = 0
+    send: Optional[Callable[[bytes], Awaitable[None]]] = None
+
+    def __post_init__(self) -> None:
+        channel_data_class = get_class_from_protocol_and_name(
+            str(self.protocol.value),
+            "ChannelData",
+            ETPConnection.generic_transition_table,
+        )
+        if channel_data_class is None:
+            raise ValueError(f"No ChannelData message in {self.protocol}")
+        self.channel_data_class = channel_data_class
+
+    def max_body_size(self) -> int:
+        return max_body_size(self.connection.max_payload_size())
+
+    async def send_bodies(
+        self,
+        bodies: List[EncodedBody],
+        wait: bool = False,
+        force: bool = False,
+    ) -> Tuple[int, int]:
+        """
+        Sends a message per body (ChannelData bodies), returns the number of messages and of bytes sent.
+        The messages are not sent when the outbound_queue of the connection is full (the peer gets a
+        BackPressureLimitExceeded ProtocolException, see etpproto.outbound), unless :param wait: is True :
+        then each message waits until the queue is writable, or :param force: is True : then the messages
+        are put at once, even above the limits of the queue (e.g. the first data of a subscription).
+        """
+        connection = self.connection
+        compressor = get_compressor(connection.client_info.compression)
+        nb_sent = sent = 0
+        for body in bodies:
+            if wait and not force and self.send is None:
+                await connection.outbound_queue.wait_writable()
+            # the message id is taken when the message is sent, so the ids are sent in increasing order
+            frame = body.encode_message(
+                connection.consume_msg_id(),
+                self.correlation_id,
+                MessageFlags.FINALPART,
+                compressor,
+                connection.compression_threshold,
+            )
+            if self.send is not None:
+                await self.send(frame)
+            else:
+                try:
+                    connection.outbound_queue.put_nowait(
+                        frame, force=wait or force
+                    )
+                except BackPressureLimitExceededError:
+                    break
+            nb_sent += 1
+            sent += len(frame)
+        return nb_sent, sent
+
+
+@dataclass
+class FanoutMetrics:
+    """
+    :ivar batches: number of published batches
+    :ivar bodies_encoded: number of encoded ChannelData bodies
+    :ivar messages_sent: number of sent ChannelData messages
+    :ivar messages_dropped: number of ChannelData messages not sent because of the back pressure of a session
+    :ivar sessions_stopped: number of sessions unsubscribed because of their back pressure
+    :ivar bytes_sent: number of sent bytes
+    """
+
+    batches: int = 0
+    bodies_encoded: int = 0
+    messages_sent: int = 0
+    messages_dropped: int = 0
+    sessions_stopped: int = 0
+    bytes_sent: int = 0
+
+
+def encode_bodies(
+    columns: ChannelDataColumns, max_body_size: int
+) -> List[bytes]:
+    """
+    Encodes the ChannelData bodies of the points of :param columns:, split in several bodies
+    of at most :param max_body_size: bytes if needed (no limit if it is negative)
+    """
+    data = columns.encode()
+    if max_body_size <= 0 or len(data) <= max_body_size:
+        return [data]
+    if len(columns) <= 1:
+        raise MaxSizeExceededError()
+    nb_parts = max(2, -(-len(data) // max_body_size))
+    bounds = np.linspace(0, len(columns), nb_parts + 1).astype(int)
+    return [
+        body
+        for start, end in zip(bounds[:-1], bounds[1:])
+        for body in encode_bodies(
+            columns.take(slice(start, end)), max_body_size
+        )
+    ]
+
+
+class ChannelFanout:
+    """
+    Index of the sessions subscribed to each channel, to send them the channel data.
+    :ivar subscribers: the sessions, by channel id
+    :ivar sessions: the sessions, by connection
+    :ivar metrics: the counts of encoded bodies and sent messages
+    :ivar range_cache: if not None, the published points are added to it (see etpproto.channel_cache)
+    """
+
+    def __init__(
+        self, range_cache: Optional["ChannelRangeCache"] = None
+    ) -> None:
+        self.subscribers: Dict[int, Set[FanoutSession]] = {}
+        self.sessions: Dict[ETPConnection, FanoutSession] = {}
+        self.metrics = FanoutMetrics()
+        self.range_cache = range_cache
+
+    def subscribe(
+        self,
+        connection: ETPConnection,
+        channel_ids: Iterable[int],
+        protocol: CommunicationProtocol = CommunicationProtocol.CHANNEL_SUBSCRIBE,
+        correlation_id: int = 0,
+        send: Optional[Callable[[bytes], Awaitable[None]]] = None,
+    ) -> FanoutSession:
+        """Adds channels to the subscriptions of a connection, returns its session"""
+        session = self.sessions.get(connection)
+        if session is None:
+            session = FanoutSession(
+                connection,
+                protocol=protocol,
+                correlation_id=correlation_id,
+                send=send,
+            )
+            self.sessions[connection] = session
+        for channel_id in channel_ids:
+            session.channel_ids.add(channel_id)
+            self.subscribers.setdefault(channel_id, set()).add(session)
+        return session
+
+    def unsubscribe(
+        self,
+        connection: ETPConnection,
+        channel_ids: Optional[Iterable[int]] = None,
+    ) -> List[int]:
+        """
+        Removes channels (all of them if :param channel_ids: is None) from the subscriptions of a connection,
+        returns the ids of the channels that were subscribed
+        """
+        session = self.sessions.get(connection)
+        if session is None:
+            return []
+        removed = [
+            channel_id
+            for channel_id in (
+                list(session.channel_ids)
+                if channel_ids is None
+                else channel_ids
+            )
+            if channel_id in session.channel_ids
+        ]
+        for channel_id in removed:
+            session.channel_ids.discard(channel_id)
+            subscribers = self.subscribers[channel_id]
+            subscribers.discard(session)
+            if len(subscribers) == 0:
+                del self.subscribers[channel_id]
+        if len(session.channel_ids) == 0:
+            del self.sessions[connection]
+        return removed
+
+    async def publish(self, data: Union[ChannelDataColumns, Any]) -> int:
+        """
+        Sends points (ChannelDataColumns or DataItems) to the sessions subscribed to their channels,
+        returns the number of sessions that received data.
+        The sessions that get the same channels, with the same max payload size, share the same encoded bodies.
+        The sessions of the closed connections are dropped.
+        A session whose outbound queue is full misses a part of the data : it is unsubscribed from all its
+        channels (see :meth:`stop`), the peer gets a BackPressureLimitExceeded ProtocolException and, in the
+        ChannelSubscribe protocol, a SubscriptionsStopped message, and may subscribe again.
+        """
+        for connection in [c for c in self.sessions if not c.is_connected]:
+            self.unsubscribe(connection)
+        if not isinstance(data, ChannelDataColumns):
+            data = ChannelDataColumns.from_data_items(data)
+        if self.range_cache is not None:
+            self.range_cache.add(data)
+        self.metrics.batches += 1
+        if len(data) == 0:
+            return 0
+        batch_ids = set(np.unique(data.channel_ids).tolist())
+        groups: Dict[Tuple[FrozenSet[int], int], List[FanoutSession]] = {}
+        for session in set().union(
+            *(self.subscribers.get(channel_id, ()) for channel_id in batch_ids)
+        ):
+            channels = frozenset(batch_ids & session.channel_ids)
+            groups.setdefault((channels, session.max_body_size()), []).append(
+                session
+            )
+
+        sends = []
+        receivers: List[Tuple[FanoutSession, int]] = []
+        nb_messages = 0
+        for (channels, body_size), sessions in groups.items():
+            columns = (
+                data
+                if len(channels) == len(batch_ids)
+                else data.take(np.isin(data.channel_ids, list(channels)))
+            )
+            parts = encode_bodies(columns, body_size)
+            self.metrics.bodies_encoded += len(parts)
+            nb_messages += len(parts) * len(sessions)
+            # the ChannelData of the protocols have the same encoding
+            bodies: Dict[type, List[EncodedBody]] = {}
+            for session in sessions:
+                object_class = session.channel_data_class
+                if object_class not in bodies:
+                    bodies[object_class] = [
+                        EncodedBody(object_class, part) for part in parts
+                    ]
+                sends.append(session.send_bodies(bodies[object_class]))
+                receivers.append((session, len(parts)))
+        # a slow session does not delay the others
+        results = await asyncio.gather(*sends)
+        for (session, nb_parts), (nb_sent, sent) in zip(receivers, results):
+            nb_messages -= nb_sent
+            self.metrics.messages_sent += nb_sent
+            self.metrics.bytes_sent += sent
+            if nb_sent < nb_parts:
+                await self.stop(session, "BackPressureLimitExceeded")
+        self.metrics.messages_dropped += nb_messages
+        return len(sends)
+
+    async def stop(self, session: FanoutSession, reason: str) -> List[int]:
+        """
+        Unsubscribes a session from all its channels, sends it a SubscriptionsStopped message in the
+        ChannelSubscribe protocol. Returns the ids of the channels that were subscribed.
+        """
+        removed = self.unsubscribe(session.connection)
+        self.metrics.sessions_stopped += 1
+        if session.protocol == CommunicationProtocol.CHANNEL_SUBSCRIBE:
+            stopped = SubscriptionsStopped(
+                reason=reason,
+                channel_ids={
+                    str(i): channel_id for i, channel_id in enumerate(removed)
+                },
+            )
+            await session.send_bodies(
+                [EncodedBody.from_model(stopped)], force=True
+            )
+        return removed
+
+
+class FanoutChannelSubscribeHandler(ChannelSubscribeHandler):
+    """
+    ChannelSubscribeHandler of a store that sends the channel data of its connection with a :class:`ChannelFanout`.
+    The subscriptions get the data published after the SubscribeChannels message. The data before it (the start
+    index or the latest values of ChannelSubscribeInfo) are sent from the range_cache of the fan-out : a subscription
+    that asks for data that are not in the cache (or without cache) is refused with a NotSupportedError.
+
+        handler = FanoutChannelSubscribeHandler(connection, fanout)
+        connection.handlers[CommunicationProtocol.CHANNEL_SUBSCRIBE] = handler
+
+    :ivar connection: the connection of the handler
+    :ivar fanout: the fan-out, shared by the handlers of all the connections
+    """
+
+    def __init__(self, connection: ETPConnection, fanout: ChannelFanout):
+        self.connection = connection
+        self.fanout = fanout
+
+    async def check_subscription(
+        self,
+        subscription: ChannelSubscribeInfo,
+        client_info: Union[None, ClientInfo] = None,
+    ) -> None:
+        """Raises an ETPError if the channel can not be subscribed (e.g. NotFoundError for an unknown channel)"""
+
+    async def on_subscribe_channels(
+        self,
+        msg: SubscribeChannels,
+        msg_header: MessageHeader,
+        client_info: Union[None, ClientInfo] = None,
+    ) -> AsyncGenerator[Optional[Message], None]:
+        success = {}
+        errors = {}
+        # the data before the subscription, if the cache drops them before they are sent
+        checked = {}
+        for key, subscription in msg.channels.items():
+            try:
+                await self.check_subscription(subscription, client_info)
+                checked[key] = self._previous_data(subscription)
+                if checked[key] is None:
+                    raise NotSupportedError()
+                success[key] = ""
+            except ETPError as err:
+                errors[key] = err.to_etp_error()
+        if len(success) > 0 or len(errors) == 0:
+            yield Message.get_object_message(
+                SubscribeChannelsResponse(success=success),
+                correlation_id=msg_header.message_id,
+            )
+        if len(success) > 0:
+            # once the response is sent, and without waiting : the previous data are followed by the published data
+            await self._subscribe(
+                [msg.channels[key] for key in success],
+                [checked[key] for key in success],
+                msg_header.message_id,
+            )
+        if len(errors) > 0:
+            yield Message.get_object_message(
+                ProtocolException(errors=errors),
+                correlation_id=msg_header.message_id,
+            )
+
+    async def _subscribe(
+        self,
+        subscriptions: List[ChannelSubscribeInfo],
+        checked: List[Any],
+        correlation_id: int,
+    ) -> None:
+        session = self.fanout.subscribe(
+            self.connection,
+            [subscription.channel_id for subscription in subscriptions],
+            correlation_id=correlation_id,
+        )
+        channel_ids = []
+        indexes = []
+        values = []
+        for subscription, checked_data in zip(subscriptions, checked):
+            data = self._previous_data(subscription)
+            if data is None:
+                data = checked_data
+            if len(data[0]) == 0:
+                continue
+            channel_ids.append(np.full(len(data[0]), subscription.channel_id))
+            indexes.append(data[0])
+            values.append(data[1])
+        if len(channel_ids) == 0:
+            return
+        columns = ChannelDataColumns(
+            np.concatenate(channel_ids),
+            [np.concatenate(indexes)],
+            np.concatenate(values),
+        )
+        # put at once (forced, without waiting) : no data is published to the session before them
+        await session.send_bodies(
+            [
+                EncodedBody(session.channel_data_class, part)
+                for part in encode_bodies(columns, session.max_body_size())
+            ],
+            force=True,
+        )
+
+    def _previous_data(
+        self, subscription: ChannelSubscribeInfo
+    ) -> Optional[Tuple[Any, Any]]:
+        """
+        Returns the indexes and values of the data asked for before the subscription (empty arrays if there are
+        none), None if they are not in the range_cache of the fan-out
+        """
+        start = subscription.start_index.item
+        count = subscription.request_latest_index_count
+        if count == 0 or (count is None and start is None):
+            return np.empty(0), np.empty(0)
+        if self.fanout.range_cache is None or (
+            count is None and not isinstance(start, (int, float))
+        ):
+            return None
+        # the latest values take precedence over the start index
+        return self.fanout.range_cache.latest(
+            subscription.channel_id, start=start, count=count
+        )
+
+    async def on_unsubscribe_channels(
+        self,
+        msg: UnsubscribeChannels,
+        msg_header: MessageHeader,
+        client_info: Union[None, ClientInfo] = None,
+    ) -> AsyncGenerator[Optional[Message], None]:
+        self.fanout.unsubscribe(self.connection, msg.channel_ids.values())
+        yield Message.get_object_message(
+            SubscriptionsStopped(
+                reason="Unsubscribed", channel_ids=msg.channel_ids
+            ),
+            correlation_id=msg_header.message_id,
+        )
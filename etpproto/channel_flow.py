@@ -0,0 +1,231 @@
+# Copyright (c) 2022-2023 Geosiris.
+# SPDX-License-Identifier: Apache-2.0
+"""
+Flow control of the ChannelData producers (ChannelStreaming, ChannelDataLoad and ChannelSubscribe protocols).
+
+A :class:`ChannelDataBatcher` gathers the points of a producer (e.g. the task started by
+``ChannelStreamingHandler.on_start_streaming`` or ``ChannelDataLoadHandler.on_open_channels``) in ChannelData
+messages : a batch is sent when it reaches its size target, or when its oldest point has waited ``max_latency``.
+
+The size target is adapted to the time spent sending the batches (additive increase while the sends are faster than
+``target_send_latency``, halved when they are slower). ETP 1.2 has no credit message for these protocols : the
+credits of the producer are given by the outbound_queue of the connection (see etpproto.outbound). While the peer
+lags (slow sends or a suspended queue), the producer is limited to ``max_rate`` points per second.
+
+    async with ChannelDataBatcher(connection, correlation_id=msg_header.message_id) as batcher:
+        async for columns in points:
+            await batcher.add(columns)
+
+Requires numpy (see etpproto.channel_data).
+"""
+
+import asyncio
+import time
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, List, Optional, Union
+
+from etpproto.channel_cache import ChannelRangeCache
+from etpproto.channel_data import ChannelDataColumns
+from etpproto.channel_fanout import FanoutSession, encode_bodies
+from etpproto.connection import CommunicationProtocol, ETPConnection
+from etpproto.messages import EncodedBody
+
+# number of points encoded to estimate the size of a point before the first batch
+_SAMPLE_SIZE = 64
+
+
+@dataclass
+class FlowStats:
+    """
+    :ivar points: number of points sent
+    :ivar messages: number of ChannelData messages sent
+    :ivar bytes: number of bytes sent
+    :ivar size_flushes: number of batches sent because they reached their size target
+    :ivar latency_flushes: number of batches sent because they reached max_latency
+    :ivar decreases: number of times the size target has been halved
+    :ivar send_time: total time (in seconds) spent sending the batches
+    :ivar rate_limited_time: total time (in seconds) the producer has waited because of max_rate
+    """
+
+    points: int = 0
+    messages: int = 0
+    bytes: int = 0
+    size_flushes: int = 0
+    latency_flushes: int = 0
+    decreases: int = 0
+    send_time: float = 0.0
+    rate_limited_time: float = 0.0
+
+
+class ChannelDataBatcher:
+    """
+    Batches the points of a producer in ChannelData messages sent on a connection.
+    :param protocol: protocol of the ChannelData messages (ChannelStreaming, ChannelDataLoad or ChannelSubscribe)
+    :param correlation_id: correlation id of the ChannelData messages
+    :param send: sends a binary message, if None the messages are put in the outbound_queue of the connection
+    :param max_batch_bytes: max size target of a batch (the messages are also bounded by the max payload size)
+    :param min_batch_bytes: min size target of a batch, and the step of the additive increase
+    :param max_latency: max time (in seconds) a point waits before its batch is sent
+    :param target_send_latency: time (in seconds) above which sending a batch means that the peer lags
+    :param max_rate: max number of points per second while the peer lags (None for no limit)
+    :param range_cache: if not None, the sent points are added to it (see etpproto.channel_cache)
+    :ivar batch_bytes: the current size target of a batch
+    :ivar lagging: True if the last batch was sent slowly, or left the outbound_queue above its high watermark
+    :ivar stats: the statistics of the producer
+
+    An error raised while a batch is sent after max_latency (in the background) is raised by the next call
+    to :meth:`add` or :meth:`close`.
+    """
+
+    def __init__(
+        self,
+        connection: ETPConnection,
+        protocol: CommunicationProtocol = CommunicationProtocol.CHANNEL_STREAMING,
+        correlation_id: int = 0,
+        send: Optional[Callable[[bytes], Awaitable[None]]] = None,
+        max_batch_bytes: int = 64 << 10,
+        min_batch_bytes: int = 4 << 10,
+        max_latency: float = 0.05,
+        target_send_latency: float = 0.01,
+        max_rate: Optional[float] = None,
+        range_cache: Optional[ChannelRangeCache] = None,
+    ) -> None:
+        if not 0 < min_batch_bytes <= max_batch_bytes:
+            raise ValueError("0 < min_batch_bytes <= max_batch_bytes")
+        self.session = FanoutSession(
+            connection,
+            protocol=protocol,
+            correlation_id=correlation_id,
+            send=send,
+        )
+        self.max_batch_bytes = max_batch_bytes
+        self.min_batch_bytes = min_batch_bytes
+        self.max_latency = max_latency
+        self.target_send_latency = target_send_latency
+        self.max_rate = max_rate
+        self.range_cache = range_cache
+        self.batch_bytes = min_batch_bytes
+        self.lagging = False
+        self.stats = FlowStats()
+        self._pending: List[ChannelDataColumns] = []
+        self._pending_points = 0
+        self._point_size: Optional[float] = None
+        self._next_time = 0.0
+        self._timer: Optional["asyncio.Future[None]"] = None
+        self._error: Optional[Exception] = None
+        self._lock = asyncio.Lock()
+
+    def _size_target(self) -> int:
+        max_body_size = self.session.max_body_size()
+        if max_body_size > 0:
+            return min(self.batch_bytes, max_body_size)
+        return self.batch_bytes
+
+    async def add(self, data: Union[ChannelDataColumns, Any]) -> None:
+        """
+        Adds points (ChannelDataColumns or DataItems) to the current batch, and sends it if it reaches its
+        size target. Waits while the peer lags and the producer exceeds max_rate.
+        """
+        self._raise_error()
+        if not isinstance(data, ChannelDataColumns):
+            data = ChannelDataColumns.from_data_items(data)
+        if len(data) == 0:
+            return
+        await self._limit_rate(len(data))
+        if self._point_size is None:
+            sample = data.take(slice(0, _SAMPLE_SIZE))
+            self._point_size = len(sample.encode()) / len(sample)
+        self._pending.append(data)
+        self._pending_points += len(data)
+        if self._pending_points * self._point_size >= self._size_target():
+            self.stats.size_flushes += 1
+            await self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.ensure_future(self._flush_later())
+
+    async def _limit_rate(self, nb_points: int) -> None:
+        now = time.monotonic()
+        if not self.lagging or self.max_rate is None:
+            self._next_time = now
+            return
+        delay = self._next_time - now
+        if delay > 0:
+            self.stats.rate_limited_time += delay
+            await asyncio.sleep(delay)
+        self._next_time = max(now, self._next_time) + nb_points / self.max_rate
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(self.max_latency)
+        # the timer is not cancelled while it sends the batch
+        self._timer = None
+        if self._pending_points > 0:
+            self.stats.latency_flushes += 1
+            try:
+                await self.flush()
+            except Exception as error:
+                # nobody awaits the timer : the error is raised to the producer
+                self._error = error
+
+    def _raise_error(self) -> None:
+        error, self._error = self._error, None
+        if error is not None:
+            raise error
+
+    async def flush(self) -> int:
+        """Sends the current batch, returns the number of ChannelData messages sent"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        async with self._lock:
+            if self._pending_points == 0:
+                return 0
+            columns = ChannelDataColumns.concat(self._pending)
+            self._pending = []
+            self._pending_points = 0
+            if self.range_cache is not None:
+                self.range_cache.add(columns)
+
+            parts = encode_bodies(columns, self.session.max_body_size())
+            nb_bytes = sum(map(len, parts))
+            self._point_size = nb_bytes / len(columns)
+            object_class = self.session.channel_data_class
+            start = time.monotonic()
+            nb_sent, sent = await self.session.send_bodies(
+                [EncodedBody(object_class, part) for part in parts], wait=True
+            )
+            send_time = time.monotonic() - start
+            self._adapt(send_time)
+
+            self.stats.points += len(columns)
+            self.stats.messages += nb_sent
+            self.stats.bytes += sent
+            self.stats.send_time += send_time
+            return nb_sent
+
+    def _adapt(self, send_time: float) -> None:
+        queue = (
+            self.session.connection.outbound_queue
+            if self.session.send is None
+            else None
+        )
+        self.lagging = send_time > self.target_send_latency or (
+            queue is not None and not queue.is_writable()
+        )
+        if self.lagging:
+            self.stats.decreases += 1
+            self.batch_bytes = max(self.min_batch_bytes, self.batch_bytes // 2)
+        else:
+            self.batch_bytes = min(
+                self.max_batch_bytes, self.batch_bytes + self.min_batch_bytes
+            )
+
+    async def close(self) -> None:
+        """Sends the current batch"""
+        self._raise_error()
+        await self.flush()
+
+    async def __aenter__(self) -> "ChannelDataBatcher":
+        return self
+
+    async def __aexit__(self, *exc_info: Any) -> None:
+        await self.close()
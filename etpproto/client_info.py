@@ -2,7 +2,7 @@
 # SPDX-License-Identifier: Apache-2.0
 import logging
 
-from typing import Any, ClassVar, Dict, Union
+from typing import Any, ClassVar, Dict, Optional, Union
 
 from dataclasses import dataclass, field
 
@@ -11,6 +11,7 @@ from etptypes.energistics.etp.v12.protocol.core.request_session import (
     RequestSession,
 )
 
+from etpproto.compression import get_compressor
 from etpproto.endpoint_capability_kind import kind_from_name
 
 
@@ -27,6 +28,8 @@ class ClientInfo:
     login: str = field(default="anonymousUser")
     ip: str = field(default="0.0.0.0")
     authenticated: bool = field(default=False)
+    #: the compression of the message bodies, negotiated in OpenSession ("" for no compression)
+    compression: str = field(default="")
 
     def __post_init__(self):
         self._id = self.count_instance
@@ -65,10 +68,18 @@ class ClientInfo:
                     f"{str(self)}: @clientinfo.negotiate Error with {k}, {v}"
                 )
 
+        if isinstance(msg, OpenSession):
+            self.set_compression(msg.supported_compression)
+
         logging.debug(f"Negotiated capa : {self.endpoint_capabilities}")
         # else:
         # logging.debug(f"No capability found for name '{k}'")
 
+    def set_compression(self, name: Optional[str]) -> None:
+        """Sets the compression announced in an OpenSession, or no compression if it is not supported"""
+        compressor = get_compressor(name)
+        self.compression = compressor.name if compressor is not None else ""
+
     def __str__(self) -> str:
         return (
             "ClientInfo["
@@ -0,0 +1,391 @@
+# Copyright (c) 2022-2023 Geosiris.
+# SPDX-License-Identifier: Apache-2.0
+
+import json
+from dataclasses import dataclass, field
+from functools import lru_cache
+from io import BytesIO
+from collections.abc import Mapping, Sequence
+from typing import IO, Any, Dict, Iterator, NamedTuple, Optional, Tuple, Type
+
+import etptypes.energistics.etp.v12.datatypes.message_header as mh
+from etptypes import ETPModel, avro_schema
+from fastavro import parse_schema, schemaless_reader, schemaless_writer
+from pydantic.fields import SHAPE_SINGLETON
+
+from etpproto.utils import ProtocolDict
+
+
+@dataclass(frozen=True)
+class MessageCodec:
+    """
+    Avro codec of a single ETP type.
+    The avro schema is parsed (json and fastavro) only once, when the codec is created.
+    :ivar object_class: the etptypes class described by the schema
+    :ivar protocol: the ETP protocol id, -1 if the type is not a message (e.g. MessageHeader)
+    :ivar message_type: the ETP message type id, -1 if the type is not a message
+    :ivar schema: the json schema, as a dict
+    :ivar parsed_schema: the schema parsed by fastavro
+    """
+
+    object_class: Type[ETPModel]
+    protocol: int
+    message_type: int
+    schema: Dict[str, Any] = field(repr=False)
+    parsed_schema: Any = field(repr=False)
+
+    @classmethod
+    def from_class(cls, object_class: Type[ETPModel]) -> "MessageCodec":
+        schema = json.loads(avro_schema(object_class))
+        return cls(
+            object_class=object_class,
+            protocol=int(schema.get("protocol", -1)),
+            message_type=int(schema.get("messageType", -1)),
+            schema=schema,
+            parsed_schema=parse_schema(schema),
+        )
+
+    def write(self, fo: IO, record: Any) -> None:
+        """Writes the avro encoding of a record (dict) in the stream fo"""
+        schemaless_writer(fo, self.parsed_schema, record)
+
+    def encode(self, record: Any) -> bytes:
+        bio = BytesIO()
+        self.write(bio, record)
+        return bio.getvalue()
+
+    def read(self, fo: IO) -> Any:
+        """Reads a record from the stream fo. The result is the raw fastavro record (no pydantic validation)"""
+        return schemaless_reader(
+            fo,
+            self.parsed_schema,
+            return_record_name=True,
+            return_record_name_override=True,
+        )
+
+
+class CodecRegistry:
+    """
+    Cache of MessageCodec, indexed by ETP class and by (protocol, messageType).
+    :ivar use_numpy: if True and numpy is installed, the arrays of the DataArray protocol messages are encoded
+        from and decoded to numpy arrays (see etpproto.numpy_codec). It is False by default : the DataArray
+        messages are encoded by fastavro and decoded to lists. Changing it clears the cached codecs.
+    :ivar numpy_views: if True, the decoded numpy arrays are read-only views of the received messages
+        instead of copies
+    The ChannelData messages can always be encoded from columns (see etpproto.channel_data).
+    A connection may have its own registry (see ETPConnection.codec_registry), e.g. to use numpy arrays
+    without changing the codecs of the other connections :
+
+        connection = ETPConnection(codec_registry=CodecRegistry(use_numpy=True))
+    """
+
+    def __init__(
+        self, use_numpy: bool = False, numpy_views: bool = False
+    ) -> None:
+        self._use_numpy = use_numpy
+        self.numpy_views = numpy_views
+        self._by_class: Dict[Type[ETPModel], MessageCodec] = {}
+        self._by_key: Dict[Tuple[int, int], MessageCodec] = {}
+
+    @property
+    def use_numpy(self) -> bool:
+        return self._use_numpy
+
+    @use_numpy.setter
+    def use_numpy(self, use_numpy: bool) -> None:
+        if use_numpy != self._use_numpy:
+            self._use_numpy = use_numpy
+            self.clear()
+
+    def for_class(self, object_class: Type[ETPModel]) -> MessageCodec:
+        codec = self._by_class.get(object_class)
+        if codec is None:
+            # local imports : numpy_codec and channel_data import this module (numpy is imported lazily)
+            from etpproto.channel_data import channel_data_codec
+
+            codec = channel_data_codec(MessageCodec.from_class(object_class))
+            if self.use_numpy:
+                from etpproto.numpy_codec import numpy_codec
+
+                codec = numpy_codec(codec, views=self.numpy_views)
+            self._by_class[object_class] = codec
+            if codec.protocol >= 0:
+                self._by_key.setdefault(
+                    (codec.protocol, codec.message_type), codec
+                )
+        return codec
+
+    def get(
+        self,
+        protocol: int,
+        message_type: int,
+        dict_map_pro_to_class: Optional[ProtocolDict] = None,
+    ) -> MessageCodec:
+        """
+        Returns the codec of the message (protocol, message_type).
+        If the codec is not known yet, its class is searched in :param dict_map_pro_to_class:
+        Raises a KeyError if no class is found.
+        """
+        codec = self._by_key.get((protocol, message_type))
+        if codec is None:
+            if dict_map_pro_to_class is None:
+                raise KeyError((protocol, message_type))
+            codec = self.for_class(
+                dict_map_pro_to_class[str(protocol)][str(message_type)]
+            )
+            self._by_key[(protocol, message_type)] = codec
+        return codec
+
+    def header(self) -> MessageCodec:
+        return self.for_class(mh.MessageHeader)
+
+    def clear(self) -> None:
+        self._by_class.clear()
+        self._by_key.clear()
+
+
+#: Process wide registry, used by all encode/decode functions of etpproto (and by the connections
+#: without their own registry)
+codec_registry = CodecRegistry()
+
+
+def get_codec_for_class(object_class: Type[ETPModel]) -> MessageCodec:
+    return codec_registry.for_class(object_class)
+
+
+def get_codec(
+    protocol: int,
+    message_type: int,
+    dict_map_pro_to_class: Optional[ProtocolDict] = None,
+) -> MessageCodec:
+    return codec_registry.get(protocol, message_type, dict_map_pro_to_class)
+
+
+def get_header_codec() -> MessageCodec:
+    return codec_registry.header()
+
+
+#: max size of the avro zig-zag varint encoding of each primitive type
+_MAX_VARINT_SIZES = {"int": 5, "long": 10}
+
+#: max size of an encoded MessageHeader (computed from its avro schema)
+MAX_HEADER_SIZE = sum(
+    _MAX_VARINT_SIZES[field["type"]]
+    for field in json.loads(avro_schema(mh.MessageHeader))["fields"]
+)
+
+
+class FieldInfo(NamedTuple):
+    """
+    Description of an ETPModel field, used to read/write avro records without pydantic.
+    :ivar alias: the avro name of the field
+    :ivar model: the ETPModel class of the field values, None if values are not records
+    :ivar singleton: False if the field is a list or a map of values
+    :ivar may_contain_models: True if the values may be ETPModel (e.g. a union with a record type)
+    """
+
+    alias: str
+    model: Optional[Type[ETPModel]]
+    singleton: bool
+    may_contain_models: bool
+
+
+@lru_cache(maxsize=None)
+def get_field_table(object_class: Type[ETPModel]) -> Dict[str, FieldInfo]:
+    """Returns the table {python field name: FieldInfo} of an ETPModel class"""
+    table = {}
+    for name, model_field in object_class.__fields__.items():
+        sub_type = model_field.type_
+        model = sub_type if _is_model_class(sub_type) else None
+        table[name] = FieldInfo(
+            alias=model_field.alias,
+            model=model,
+            singleton=model_field.shape == SHAPE_SINGLETON,
+            may_contain_models=model is not None
+            or any(
+                _is_model_class(t) for t in getattr(sub_type, "__args__", ())
+            ),
+        )
+    return table
+
+
+@lru_cache(maxsize=None)
+def get_alias_table(object_class: Type[ETPModel]) -> Dict[str, str]:
+    """Returns the table {avro field name (alias): python field name} of an ETPModel class"""
+    return {
+        info.alias: name
+        for name, info in get_field_table(object_class).items()
+    }
+
+
+def _is_model_class(t: Any) -> bool:
+    return isinstance(t, type) and issubclass(t, ETPModel)
+
+
+class RecordView:
+    """
+    Read-only attribute access over a raw fastavro record, using the python field names of the ETPModel class.
+    No pydantic validation is done : nested records are wrapped in views when they are accessed,
+    other values (lists of numbers, bytes, ...) are returned as they were read by fastavro.
+    Use :meth:`to_model` to get the validated ETPModel.
+    """
+
+    __slots__ = ("record", "object_class", "_model")
+
+    def __init__(self, record: Dict[str, Any], object_class: Type[ETPModel]):
+        self.record = record
+        self.object_class = object_class
+        self._model: Optional[ETPModel] = None
+
+    def __getattr__(self, name: str) -> Any:
+        info = get_field_table(self.object_class).get(name)
+        alias = info.alias if info is not None else name
+        try:
+            value = self.record[alias]
+        except (KeyError, TypeError):
+            raise AttributeError(
+                f"{self.object_class.__name__} has no attribute {name}"
+            )
+        if info is None or info.model is None or value is None:
+            return value
+        if info.singleton:
+            return RecordView(value, info.model)
+        if isinstance(value, dict):
+            return {k: RecordView(v, info.model) for k, v in value.items()}
+        return [RecordView(v, info.model) for v in value]
+
+    def to_model(self) -> ETPModel:
+        """Validates the record (only once) and returns the ETPModel"""
+        if self._model is None:
+            self._model = self.object_class.parse_obj(self.record)
+        return self._model
+
+    def __repr__(self) -> str:
+        return f"RecordView[{self.object_class.__name__}]({self.record})"
+
+
+def header_from_record(record: Dict[str, Any]) -> mh.MessageHeader:
+    """Builds a MessageHeader from a raw record, without validation"""
+    return mh.MessageHeader.construct(
+        **{
+            name: record[info.alias]
+            for name, info in get_field_table(mh.MessageHeader).items()
+        }
+    )
+
+
+def long_size(value: int) -> int:
+    """Returns the size in bytes of an avro int/long (zig-zag varint encoding)"""
+    value = (value << 1) ^ (value >> 63)
+    size = 1
+    while value > 0x7F:
+        value >>= 7
+        size += 1
+    return size
+
+
+def encoded_size(value: Any) -> int:
+    """
+    Returns the size in bytes of the avro encoding of a value.
+    ETPModel are encoded with their own schema, so the size does not include a possible union index.
+    Python floats are counted as avro doubles.
+    """
+    if value is None:
+        return 0
+    if isinstance(value, ETPModel):
+        return len(
+            get_codec_for_class(type(value)).encode(as_avro_record(value))
+        )
+    if isinstance(value, str):
+        value = value.encode("utf-8")
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return long_size(len(value)) + len(value)
+    if isinstance(value, bool):
+        return 1
+    if isinstance(value, int):
+        return long_size(value)
+    if isinstance(value, float):
+        return 8
+    if isinstance(value, dict):
+        if len(value) == 0:
+            return 1
+        return (
+            long_size(len(value))
+            + sum(encoded_size(k) + encoded_size(v) for k, v in value.items())
+            + 1
+        )
+    if isinstance(value, (list, tuple)):
+        if len(value) == 0:
+            return 1
+        return long_size(len(value)) + sum(encoded_size(v) for v in value) + 1
+    raise TypeError(f"Unsupported type for avro size : {type(value)}")
+
+
+def header_to_record(header: mh.MessageHeader) -> Dict[str, Any]:
+    return {
+        "protocol": header.protocol,
+        "messageType": header.message_type,
+        "correlationId": header.correlation_id,
+        "messageId": header.message_id,
+        "messageFlags": header.message_flags,
+    }
+
+
+def as_avro_record(value: Any) -> Any:
+    """
+    Returns a value that fastavro can write, without copying the ETPModel tree (as .dict(by_alias=True) does) :
+    models are wrapped in ModelRecord, the other values (lists of numbers, bytes...) are given as is to fastavro.
+    """
+    if isinstance(value, ETPModel):
+        if type(value).dict is not ETPModel.dict:
+            # models with union of records (AnyArray, DataValue) give the record name with their own dict()
+            return value.dict(by_alias=True)
+        return ModelRecord(value)
+    if isinstance(value, (list, tuple)):
+        return _ModelSequence(value)
+    if isinstance(value, dict):
+        return {k: as_avro_record(v) for k, v in value.items()}
+    return value
+
+
+class ModelRecord(Mapping):
+    """Read-only mapping {avro field name: value} over an ETPModel, used to write it with fastavro"""
+
+    __slots__ = ("model", "_aliases")
+
+    def __init__(self, model: ETPModel):
+        self.model = model
+        self._aliases = get_alias_table(type(model))
+
+    def __getitem__(self, alias: str) -> Any:
+        name = self._aliases[alias]
+        value = getattr(self.model, name)
+        if value is None or not (
+            get_field_table(type(self.model))[name].may_contain_models
+        ):
+            return value
+        return as_avro_record(value)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._aliases)
+
+    def __len__(self) -> int:
+        return len(self._aliases)
+
+
+class _ModelSequence(Sequence):
+    """Lazy sequence wrapping ETPModel items of a list"""
+
+    __slots__ = ("values",)
+
+    def __init__(self, values: Sequence):
+        self.values = values
+
+    def __getitem__(self, index):
+        return as_avro_record(self.values[index])
+
+    def __iter__(self):
+        return map(as_avro_record, self.values)
+
+    def __len__(self) -> int:
+        return len(self.values)
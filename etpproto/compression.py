@@ -0,0 +1,184 @@
+# Copyright (c) 2022-2023 Geosiris.
+# SPDX-License-Identifier: Apache-2.0
+"""
+Compression of ETP message bodies (see ETP 3.7.4 : only the body is compressed, the header is not).
+
+"gzip" (zlib, from the standard library) is always available. "zstd" and "lz4" are available
+if the optional packages zstandard and lz4 are installed (``pip install etpproto[zstd,lz4]``).
+
+A decompressed body is bounded (by ETPConnection.max_decompressed_size) : a MaxSizeExceededError is raised
+instead of inflating a body larger than this size.
+"""
+
+import threading
+import zlib
+from dataclasses import dataclass
+from io import BytesIO
+from typing import Callable, Dict, List, Optional, Sequence, Union
+
+from etpproto.codec import get_header_codec
+from etpproto.error import CompressionNotSupportedError, MaxSizeExceededError
+from etpproto.messages import MessageFlags
+
+#: message types that can never be compressed : RequestSession, OpenSession, ProtocolException and Acknowledge
+#: (ProtocolException and Acknowledge may be sent with the id of any protocol)
+UNCOMPRESSED_MESSAGE_TYPES = {1000, 1001}
+UNCOMPRESSED_CORE_MESSAGE_TYPES = {1, 2}
+
+#: default max size of a decompressed body (see ETPConnection.max_decompressed_size)
+DEFAULT_MAX_DECOMPRESSED_SIZE = 1 << 27
+
+
+@dataclass(frozen=True)
+class Compressor:
+    """
+    :ivar name: the name used in RequestSession.supportedCompression and OpenSession.supportedCompression
+    :ivar magic: the first bytes of the compressed data, used to recognize the format on decoding
+    :ivar decompress: decompresses at most max_size bytes (and more only if the data is larger)
+    """
+
+    name: str
+    magic: bytes
+    compress: Callable[[bytes], bytes]
+    decompress: Callable[[bytes, int], bytes]
+
+
+def _gzip_compress(data: bytes) -> bytes:
+    # wbits=31 : gzip container
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _gzip_decompress(data: bytes, max_size: int) -> bytes:
+    return zlib.decompressobj(31).decompress(data, max_size + 1)
+
+
+#: available compressors, by order of preference
+compressors: Dict[str, Compressor] = {
+    "gzip": Compressor("gzip", b"\x1f\x8b", _gzip_compress, _gzip_decompress),
+}
+
+try:
+    import zstandard
+
+    # the contexts are reused by the messages, but are not thread safe (the handlers may run in worker
+    # threads, see HandlerScope.WORKER) : each thread has its own contexts
+    _zstd_contexts = threading.local()
+
+    def _zstd_compress(data: bytes) -> bytes:
+        compressor = getattr(_zstd_contexts, "compressor", None)
+        if compressor is None:
+            compressor = _zstd_contexts.compressor = zstandard.ZstdCompressor()
+        return compressor.compress(data)
+
+    def _zstd_decompress(data: bytes, max_size: int) -> bytes:
+        decompressor = getattr(_zstd_contexts, "decompressor", None)
+        if decompressor is None:
+            decompressor = _zstd_contexts.decompressor = (
+                zstandard.ZstdDecompressor()
+            )
+        # decompress(max_output_size=) is ignored when the frame gives its content size
+        with decompressor.stream_reader(data) as reader:
+            return reader.read(max_size + 1)
+
+    compressors["zstd"] = Compressor(
+        "zstd", b"\x28\xb5\x2f\xfd", _zstd_compress, _zstd_decompress
+    )
+except ImportError:
+    pass
+
+try:
+    import lz4.frame
+
+    def _lz4_decompress(data: bytes, max_size: int) -> bytes:
+        # a decompressor keeps the state of a single frame
+        return lz4.frame.LZ4FrameDecompressor().decompress(
+            data, max_length=max_size + 1
+        )
+
+    compressors["lz4"] = Compressor(
+        "lz4", b"\x04\x22\x4d\x18", lz4.frame.compress, _lz4_decompress
+    )
+except ImportError:
+    pass
+
+
+def supported_compressions() -> List[str]:
+    return list(compressors)
+
+
+def get_compressor(name: Optional[str]) -> Optional[Compressor]:
+    """Returns the compressor named :param name: (case insensitive), None if it is not supported"""
+    if not name:
+        return None
+    return compressors.get(name.lower())
+
+
+def negotiate_compression(
+    requested: Union[str, Sequence[str], None],
+    preferred: Optional[Sequence[str]] = None,
+) -> str:
+    """
+    Returns the compression to answer in OpenSession.supportedCompression,
+    for the compressions in RequestSession.supportedCompression : the first of :param preferred:
+    (by default, all supported compressions) that is requested, or "" if there is none.
+    """
+    if requested is None:
+        return ""
+    if isinstance(requested, str):
+        requested = [requested]
+    requested_names = {r.lower() for r in requested}
+    for name in preferred if preferred is not None else compressors:
+        if name.lower() in requested_names and get_compressor(name):
+            return name.lower()
+    return ""
+
+
+def can_compress(protocol: int, message_type: int) -> bool:
+    return message_type not in UNCOMPRESSED_MESSAGE_TYPES and not (
+        protocol == 0 and message_type in UNCOMPRESSED_CORE_MESSAGE_TYPES
+    )
+
+
+def compress_message(
+    binary: bytes, compressor: Compressor, threshold: int = 0
+) -> bytes:
+    """
+    Compresses the body of an encoded message, if it is larger than :param threshold: bytes
+    and if the message type can be compressed. The COMPRESSED flag is set in the header.
+    The message is returned unchanged if the compression does not reduce its size.
+    """
+    fo = BytesIO(binary)
+    header = get_header_codec().read(fo)
+    body_start = fo.tell()
+    if (
+        len(binary) - body_start <= threshold
+        or header["messageFlags"] & MessageFlags.COMPRESSED
+        or not can_compress(header["protocol"], header["messageType"])
+    ):
+        return binary
+    header["messageFlags"] |= MessageFlags.COMPRESSED
+    compressed = get_header_codec().encode(header) + compressor.compress(
+        memoryview(binary)[body_start:]
+    )
+    return compressed if len(compressed) < len(binary) else binary
+
+
+def decompress_body(
+    data: Union[bytes, memoryview],
+    max_size: Optional[int] = None,
+) -> bytes:
+    """
+    Decompresses a message body, its format is recognized by its first bytes.
+    Raises a CompressionNotSupportedError if the format is not supported, and a MaxSizeExceededError
+    if the body is larger than :param max_size: bytes (DEFAULT_MAX_DECOMPRESSED_SIZE if None or not positive).
+    """
+    if max_size is None or max_size <= 0:
+        max_size = DEFAULT_MAX_DECOMPRESSED_SIZE
+    for compressor in compressors.values():
+        if bytes(data[: len(compressor.magic)]) == compressor.magic:
+            body = compressor.decompress(data, max_size)
+            if len(body) > max_size:
+                raise MaxSizeExceededError()
+            return body
+    raise CompressionNotSupportedError()
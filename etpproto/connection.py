@@ -2,19 +2,24 @@
 # SPDX-License-Identifier: Apache-2.0
 from __future__ import annotations
 
+import asyncio
 import logging
+import threading
 
 from dataclasses import dataclass, field
 from enum import Enum
+from io import BytesIO
 from typing import (
     Generator,
     AsyncGenerator,
     Callable,
     ClassVar,
     Final,
+    Iterable,
     List,
     Dict,
     Optional,
+    Set,
     Tuple,
     Type,
     Union,
@@ -41,21 +46,41 @@ from etptypes.energistics.etp.v12.protocol.core.request_session import (
 from etptypes.energistics.etp.v12.datatypes.message_header import MessageHeader
 
 from etpproto.client_info import ClientInfo
+from etpproto.codec import CodecRegistry, get_header_codec
+from etpproto.compression import (
+    DEFAULT_MAX_DECOMPRESSED_SIZE,
+    compress_message,
+    get_compressor,
+)
 from etpproto.error import (
     ETPError,
     InvalidMessageError,
+    LimitExceededError,
+    MultipartCancelledError,
     UnsupportedProtocolError,
     NotSupportedError,
     InvalidStateError,
     AuthorizationRequired,
+    MaxSizeExceededError,
+)
+from etpproto.messages import (
+    ChunkReassembler,
+    EncodedBody,
+    Message,
+    ResponseBuilder,
 )
-from etpproto.messages import Message
-from etpproto.utils import ProtocolDict, get_all_etp_protocol_classes
+from etpproto.outbound import OutboundQueue
+from etpproto.protocol_index import ProtocolTable
+from etpproto.utils import ProtocolDict
 
 # import time
 
 
 class Protocol:
+    #: If True, the messages of this protocol are handled one at a time, in the order they are received,
+    #: even when the connection handles the requests concurrently (see ETPConnection.concurrent_handling)
+    serialized: ClassVar[bool] = False
+
     def handle_message(
         self,
         etp_object: object,
@@ -120,22 +145,162 @@ class CommunicationProtocol(Enum):
     WITSML_SOAP = 2000
 
 
+def supported_protocol_list(
+    protocols: Iterable[CommunicationProtocol],
+) -> List[SupportedProtocol]:
+    supported_protocols: List[SupportedProtocol] = []
+    for protocol in protocols:
+        if protocol.value != CommunicationProtocol.CORE:
+            supported_protocols.append(
+                SupportedProtocol(
+                    protocol=protocol.value,
+                    protocol_version={
+                        "major": 1,
+                        "minor": 2,
+                        "patch": 0,
+                        "revision": 0,
+                    },
+                    role="server",
+                    protocol_capabilities={},
+                )
+            )
+    return supported_protocols
+
+
+class HandlerScope(Enum):
+    """Lifetime of the protocol handlers created by a HandlerRegistry."""
+
+    #: One handler instance for each connection : the handler can keep the state of its session without lock
+    CONNECTION = 0
+    #: One handler instance for each worker thread, shared by the connections handled in this thread
+    WORKER = 1
+    #: One handler instance shared by all the connections that use the registry
+    SHARED = 2
+
+
 @dataclass
+class HandlerRegistry:
+    """
+    Protocol handlers of a server (or of a client), used to create the handlers of each connection.
+    Several registries can be used in the same process, e.g. one for a read-only replica and one for a primary store.
+
+    Example :
+        registry = HandlerRegistry()
+
+        @registry.on(CommunicationProtocol.STORE)
+        class MyStoreHandler(StoreHandler):
+            ...
+
+        connection = ETPConnection(handler_registry=registry)
+
+    :ivar factories: For each protocol, the function that creates a handler, and the scope of the handlers it creates
+    """
+
+    factories: Dict[
+        CommunicationProtocol, Tuple[Callable[[], Protocol], HandlerScope]
+    ] = field(default_factory=dict)
+
+    _shared: Dict[CommunicationProtocol, Protocol] = field(
+        default_factory=dict, init=False, repr=False
+    )
+
+    _worker: threading.local = field(
+        default_factory=threading.local, init=False, repr=False
+    )
+
+    def register(
+        self,
+        protocol: CommunicationProtocol,
+        factory: Callable[[], Protocol],
+        scope: HandlerScope = HandlerScope.CONNECTION,
+    ) -> None:
+        """:param factory: is called without parameter to create a handler (e.g. the handler class)"""
+        self.factories[protocol] = (factory, scope)
+        self._shared.pop(protocol, None)
+        if hasattr(self._worker, "handlers"):
+            self._worker.handlers.pop(protocol, None)
+
+    def on(
+        self,
+        protocol: CommunicationProtocol,
+        scope: HandlerScope = HandlerScope.CONNECTION,
+    ) -> Callable[[Type[Protocol]], Type[Protocol]]:
+        """Should only be used to decorate classes."""
+
+        def decorate(cls_protocol: Type[Protocol]) -> Type[Protocol]:
+            self.register(protocol, cls_protocol, scope)
+            return cls_protocol
+
+        return decorate
+
+    def create_transition_table(
+        self,
+    ) -> Dict[CommunicationProtocol, Protocol]:
+        """Returns the handlers of a new connection"""
+        if not hasattr(self._worker, "handlers"):
+            self._worker.handlers = {}
+        table = {}
+        for protocol, (factory, scope) in self.factories.items():
+            if scope == HandlerScope.CONNECTION:
+                table[protocol] = factory()
+            else:
+                instances = (
+                    self._shared
+                    if scope == HandlerScope.SHARED
+                    else self._worker.handlers
+                )
+                if protocol not in instances:
+                    instances[protocol] = factory()
+                table[protocol] = instances[protocol]
+        return table
+
+    def get_supported_protocol_list(self) -> List[SupportedProtocol]:
+        return supported_protocol_list(self.factories)
+
+
+# eq=False : the connections are compared and hashed by identity (e.g. as dict keys, see etpproto.channel_fanout)
+@dataclass(eq=False)
 class ETPConnection:
     """
     Main class to start an ETP Connection.
-    :cvar generic_transition_table:
+    :cvar generic_transition_table: The table {protocol: {messageType: ETP class}}, classes are imported when they are used
     :ivar server_capabilities: The capabilities of the current ETP connection (client or server)
-    :ivar transition_table: The table that maps a communication protocol to an actual protocol implementation
+    :cvar transition_table: The table that maps a communication protocol to an actual protocol implementation,
+        shared by the connections without handler_registry (see :meth:`on`)
+    :ivar handler_registry: If set, the handlers of the connection are created by this registry
+    :ivar handlers: The table that maps a communication protocol to the handler used by this connection
+        (by default, the transition_table)
+    :ivar concurrent_handling: if True, the independent requests received with :meth:`submit_bytes` are handled
+        in asyncio tasks, at most max_concurrent_requests at a time, and their answers are put in the outbound_queue
+        as soon as they are produced. The handlers with a True "serialized" attribute still handle their messages
+        one at a time, in the order they are received.
+    :ivar compression_threshold: the message bodies larger than this size (in bytes) are compressed, if a compression
+        has been negotiated in the OpenSession (see etpproto.compression)
+    :ivar max_decompressed_size: the maximum size (in bytes) of a received compressed body, once decompressed
+        (None for the default of etpproto.compression). MaxWebSocketMessagePayloadSize only bounds the compressed
+        message received on the websocket.
+    :ivar max_concurrent_requests: the maximum count of requests handled at the same time, for this connection
+    :ivar max_outbound_bytes: the maximum count of bytes in the outbound_queue (None for no limit)
+    :ivar max_outbound_messages: the maximum count of messages in the outbound_queue (None for no limit).
+        The handlers are suspended before each answer while the outbound_queue is above its high watermark
+        (see etpproto.outbound) : the answers and the waiting producers are bounded by these limits.
     :ivar is_connected:
-    :ivar chunk_msg_cache: Mapping a msgId to list of partial msg (). Is is ONLY used for RECIEVED messages
+    :ivar chunk_reassembler: Reassembles the chunked messages, indexed by msgId. Is is ONLY used for RECIEVED messages.
+        Its limits are the MaxConcurrentMultipart and MultipartMessageTimeoutPeriod capabilities of the connection
+        (the ChunkReassembler defaults if they are not set). The expired messages are evicted on each received
+        message (see :meth:`evict_expired_multipart`).
+    :ivar max_multipart_bytes: the maximum count of chunk bytes kept in the chunk_reassembler (None for no limit)
+    :ivar lazy_validation: if True, received messages are not validated by pydantic : handlers receive a RecordView
+        (see etpproto.codec) and can call its to_model() method to get the validated ETPModel.
+        Core protocol messages are always validated.
+    :ivar codec_registry: the codecs of the messages of the connection (e.g. CodecRegistry(use_numpy=True) to
+        decode the arrays of the DataArray messages to numpy arrays, see etpproto.codec), the process wide
+        etpproto.codec.codec_registry if None
     """
 
     SUB_PROTOCOL: Final[str] = "etp12.energistics.org"
 
-    generic_transition_table: ClassVar[ProtocolDict] = (
-        get_all_etp_protocol_classes()
-    )
+    generic_transition_table: ClassVar[ProtocolDict] = ProtocolTable()
 
     transition_table: ClassVar[Dict[CommunicationProtocol, Protocol]] = {}
 
@@ -147,6 +312,36 @@ class ETPConnection:
 
     message_id: int = field(default=1)
 
+    lazy_validation: bool = field(default=False)
+
+    codec_registry: Optional[CodecRegistry] = field(default=None)
+
+    handler_registry: Optional[HandlerRegistry] = field(default=None)
+
+    handlers: Optional[Dict[CommunicationProtocol, Protocol]] = field(
+        default=None
+    )
+
+    concurrent_handling: bool = field(default=False)
+
+    max_concurrent_requests: int = field(default=16)
+
+    _outbound_queue: Optional[OutboundQueue] = field(
+        default=None, init=False, repr=False
+    )
+
+    _request_semaphore: Optional[asyncio.Semaphore] = field(
+        default=None, init=False, repr=False
+    )
+
+    _protocol_locks: Dict[CommunicationProtocol, asyncio.Lock] = field(
+        default_factory=dict, init=False, repr=False
+    )
+
+    _pending_tasks: Set[asyncio.Task] = field(
+        default_factory=set, init=False, repr=False
+    )
+
     #    ______           __                                      __             ________                __
     #   / ____/___ ______/ /_  ___     ____  ____  __  _______   / /__  _____   / ____/ /_  __  ______  / /_______   ____ ___  ___  ______________ _____ ____
     #  / /   / __ `/ ___/ __ \/ _ \   / __ \/ __ \/ / / / ___/  / / _ \/ ___/  / /   / __ \/ / / / __ \/ //_/ ___/  / __ `__ \/ _ \/ ___/ ___/ __ `/ __ `/ _ \
@@ -154,15 +349,23 @@ class ETPConnection:
     # \____/\__,_/\___/_/ /_/\___/  / .___/\____/\__,_/_/     /_/\___/____/   \____/_/ /_/\__,_/_/ /_/_/|_/____/  /_/ /_/ /_/\___/____/____/\__,_/\__, /\___/
     #                              /_/                                                                                                           /____/
 
-    chunk_msg_cache: Dict[int, List[Message]] = field(
-        default_factory=lambda: {}
+    chunk_reassembler: ChunkReassembler = field(
+        default_factory=ChunkReassembler
     )
 
-    error_msg_cache: Dict[int, List[Optional[Message]]] = field(
-        default_factory=lambda: {}
+    max_multipart_bytes: Optional[int] = field(default=1 << 30)
+
+    client_info: ClientInfo = field(default_factory=ClientInfo)
+
+    compression_threshold: int = field(default=1024)
+
+    max_decompressed_size: Optional[int] = field(
+        default=DEFAULT_MAX_DECOMPRESSED_SIZE
     )
 
-    client_info: ClientInfo = field(default=ClientInfo())
+    max_outbound_bytes: Optional[int] = field(default=64 << 20)
+
+    max_outbound_messages: Optional[int] = field(default=1 << 16)
 
     connection_type: ConnectionType = field(default=ConnectionType.SERVER)
     # TODO : last msg recieve date
@@ -174,18 +377,77 @@ class ETPConnection:
         elif self.connection_type == ConnectionType.CLIENT:
             self.message_id = 2
             self.auth_required = False  # auth is only required on server side
+        if self.handlers is None:
+            self.handlers = (
+                self.handler_registry.create_transition_table()
+                if self.handler_registry is not None
+                else self.transition_table
+            )
+
+    def get_handler(
+        self, protocol: CommunicationProtocol
+    ) -> Optional[Protocol]:
+        """Returns the handler of a protocol for this connection, None if the protocol is not supported"""
+        handlers = (
+            self.handlers
+            if self.handlers is not None
+            else self.transition_table
+        )
+        return handlers.get(protocol)
+
+    def _update_multipart_limits(self) -> None:
+        max_concurrent_multipart = self.client_info.getCapability(
+            "MaxConcurrentMultipart"
+        )
+        timeout_period = self.client_info.getCapability(
+            "MultipartMessageTimeoutPeriod"
+        )
+        self.chunk_reassembler.max_concurrent_multipart = (
+            max_concurrent_multipart
+            if max_concurrent_multipart is not None
+            else ChunkReassembler.DEFAULT_MAX_CONCURRENT_MULTIPART
+        )
+        self.chunk_reassembler.timeout_period = (
+            timeout_period
+            if timeout_period is not None
+            else ChunkReassembler.DEFAULT_TIMEOUT_PERIOD
+        )
+        self.chunk_reassembler.max_bytes = self.max_multipart_bytes
+
+    def evict_expired_multipart(self) -> List[Message]:
+        """
+        Cancels the received multipart messages whose last part is older than the MultipartMessageTimeoutPeriod,
+        and returns the MultipartCancelled errors to send for them.
+        It is called for each received message, and can be called by a timer of the server.
+        """
+        self._update_multipart_limits()
+        return [
+            MultipartCancelledError().to_etp_message(
+                msg_id=self.consume_msg_id(),
+                correlation_id=expired_id,
+            )
+            for expired_id in self.chunk_reassembler.evict_expired()
+        ]
 
     def _handle_answer_and_error(
         self,
-        msg: Optional[Union[Message, ETPError]],
+        msg: Optional[Union[Message, ResponseBuilder, ETPError]],
         req_msg: Message,
         request_msg_id: int,
-    ) -> Optional[Message]:
+    ) -> Optional[Union[Message, ResponseBuilder]]:
         # Si on a repondu un message c'est que tout s'est bien passé
         if msg:
-            if isinstance(msg, Message):
+            if isinstance(msg, ResponseBuilder):
+                # the messages are built when the answer is encoded
+                return msg
+            elif isinstance(msg, Message):
                 msg.header.message_id = self.consume_msg_id()
                 msg.set_final_msg(True)
+                if isinstance(msg.body, OpenSession):
+                    # the compression is the one announced to the client
+                    self.client_info.set_compression(
+                        msg.body.supported_compression
+                    )
                 return msg
 
             # conversion de l'erreur en msg etp si besoin
@@ -194,12 +456,18 @@ class ETPConnection:
         return None
 
     async def _handle_message_generator(
-        self, etp_input_msg: Optional[Message]
-    ) -> AsyncGenerator[Optional[Message], None]:
-        if (
+        self, etp_input_msg: Optional[Union[Message, ETPError]]
+    ) -> AsyncGenerator[Optional[Union[Message, ResponseBuilder]], None]:
+        if isinstance(etp_input_msg, ETPError):
+            # the message could not be decoded (see decode_message)
+            yield etp_input_msg.to_etp_message(msg_id=self.consume_msg_id())
+        elif (
             etp_input_msg is not None and etp_input_msg.header is not None
         ):  # si pas un message none
             current_msg_id = etp_input_msg.header.message_id
+            # the multipart messages of a peer that stopped sending them are evicted on its next message
+            for cancelled in self.evict_expired_multipart():
+                yield cancelled
             if not self.auth_required or (
                 self.client_info is not None
                 and (
@@ -261,38 +529,36 @@ class ETPConnection:
                                 if etp_input_msg.header.correlation_id != 0
                                 else etp_input_msg.header.message_id
                             )
-                            if cache_id not in self.chunk_msg_cache:
-                                self.chunk_msg_cache[cache_id] = []
-                            self.chunk_msg_cache[cache_id].append(
-                                etp_input_msg
-                            )
+                            try:
+                                accepted = self.chunk_reassembler.add(
+                                    cache_id, etp_input_msg
+                                )
+                            except LimitExceededError as limit_err:
+                                logging.error(
+                                    f"{self.client_info.ip}: multipart message {cache_id} cancelled : {limit_err.msg}"
+                                )
+                                yield limit_err.to_etp_message(
+                                    msg_id=self.consume_msg_id(),
+                                    correlation_id=cache_id,
+                                )
+                                accepted = False
 
                             # si final on rassemble et on handle.
-                            if etp_input_msg.is_final_msg():
+                            if accepted and etp_input_msg.is_final_msg():
                                 logging.debug(
-                                    f"Reassemble chunks :{self.chunk_msg_cache[cache_id]}",
+                                    f"Reassemble chunks of message {cache_id}",
                                 )
+                                error_msgs: List[Optional[Message]] = []
                                 try:
                                     async for (
                                         msg
                                     ) in self._handle_message_generator(
-                                        Message.reassemble_chunk(
-                                            self.chunk_msg_cache[cache_id]
-                                        )
+                                        self.chunk_reassembler.pop(cache_id)
                                     ):
                                         if msg is not None:
                                             yield msg
                                         else:
-                                            if (
-                                                cache_id
-                                                not in self.error_msg_cache
-                                            ):
-                                                self.error_msg_cache[
-                                                    cache_id
-                                                ] = []
-                                            self.error_msg_cache[
-                                                cache_id
-                                            ].append(
+                                            error_msgs.append(
                                                 InvalidMessageError().to_etp_message(
                                                     msg_id=self.consume_msg_id()
                                                 )
@@ -304,36 +570,25 @@ class ETPConnection:
                                     )
                                     raise e
 
-                                if cache_id in self.error_msg_cache:
-                                    for err_msg in self.error_msg_cache[
-                                        cache_id
-                                    ]:
-                                        if err_msg is not None:
-                                            yield err_msg
-                                    self.error_msg_cache.pop(cache_id)
-
-                                if cache_id in self.chunk_msg_cache:
-                                    self.chunk_msg_cache.pop(cache_id)
+                                for err_msg in error_msgs:
+                                    if err_msg is not None:
+                                        yield err_msg
 
                         else:  # ce n'est pas un message envoye en chunks
                             # now try to have an answer
                             try:
                                 # Test si le protocol est supporte par le serveur
-                                if (
+                                handler = self.get_handler(
                                     CommunicationProtocol(
                                         etp_input_msg.header.protocol
                                     )
-                                    in self.transition_table
-                                ):
+                                )
+                                if handler is not None:
                                     # demande la reponse au protocols du serveur
                                     try:
                                         async for (
                                             handled
-                                        ) in self.transition_table[
-                                            CommunicationProtocol(
-                                                etp_input_msg.header.protocol
-                                            )
-                                        ].handle_message(
+                                        ) in handler.handle_message(
                                             etp_object=etp_input_msg.body,
                                             msg_header=etp_input_msg.header,
                                             client_info=self.client_info,
@@ -399,33 +654,36 @@ class ETPConnection:
             # err_msg.header.message_id = self.message_id
             # self.message_id += 2
 
-            for msg_part in msg.encode_message_generator(
-                self.client_info.getCapability(
-                    "MaxWebSocketMessagePayloadSize"
-                ),
-                self,
-            ):
+            for msg_part in self.encode_message_generator(msg):
                 yield (current_msg_id, msg_part)
 
             if err_msg:
-                for msg_part in err_msg.encode_message_generator(
-                    self.client_info.getCapability(
-                        "MaxWebSocketMessagePayloadSize"
-                    ),
-                    self,
-                ):
+                for msg_part in self.encode_message_generator(err_msg):
                     yield (current_msg_id, msg_part)
 
         elif err_msg:
             # logging.debug(f"{self.client_info.ip} : Encoding error")
-            for msg_part in err_msg.encode_message_generator(
-                self.client_info.getCapability(
-                    "MaxWebSocketMessagePayloadSize"
-                ),
-                self,
-            ):
+            for msg_part in self.encode_message_generator(err_msg):
                 yield (current_msg_id, msg_part)
 
+    def decode_message(
+        self, msg_data: bytes
+    ) -> Optional[Union[Message, ETPError]]:
+        """
+        Decodes a received binary message. Returns the ETPError to answer if its compressed body is larger
+        than max_decompressed_size once decompressed, and None if it can not be decoded.
+        """
+        try:
+            return Message.decode_binary_message(
+                msg_data,
+                ETPConnection.generic_transition_table,
+                lazy_validation=self.lazy_validation,
+                max_decompressed_size=self.max_decompressed_size,
+                registry=self.codec_registry,
+            )
+        except MaxSizeExceededError as error:
+            return error
+
     async def handle_bytes_generator(
         self, msg_data: bytes
     ) -> AsyncGenerator[bytes, None]:
@@ -433,21 +691,276 @@ class ETPConnection:
         Returns a generator of binary messages to send
         """
 
-        etp_input_msg = Message.decode_binary_message(
-            msg_data, ETPConnection.generic_transition_table
+        etp_input_msg = self.decode_message(msg_data)
+        logging.debug(f"### MSG {etp_input_msg}")
+
+        async for msg_part in self._encoded_answers_generator(etp_input_msg):
+            yield msg_part
+
+    async def handle_bytes_batch(
+        self,
+        frames: Iterable[bytes],
+        max_concurrency: Optional[int] = None,
+    ) -> List[bytes]:
+        """
+        Handles several binary messages (e.g. all the frames read from the websocket at once),
+        and returns the binary messages to send : the answers of each message, in the order of :param frames:.
+        The independent requests (see :meth:`is_independent_msg`) that follow each other are handled concurrently,
+        at most :param max_concurrency: at a time (no limit if None) : their answers are collected separately,
+        so the parts of a multipart answer are not mixed with the answers of other requests (see
+        :meth:`_in_request_order`). The other messages are handled one by one.
+        """
+        decoded = [self.decode_message(frame) for frame in frames]
+
+        semaphore = (
+            asyncio.Semaphore(max_concurrency)
+            if max_concurrency is not None
+            else None
         )
+
+        async def handle(
+            etp_input_msg: Optional[Union[Message, ETPError]]
+        ) -> List[bytes]:
+            if semaphore is None:
+                return [
+                    msg_part
+                    async for msg_part in self._encoded_answers_generator(
+                        etp_input_msg
+                    )
+                ]
+            async with semaphore:
+                return [
+                    msg_part
+                    async for msg_part in self._encoded_answers_generator(
+                        etp_input_msg
+                    )
+                ]
+
+        answers: List[bytes] = []
+
+        async def handle_concurrently(requests: List[Message]) -> None:
+            answers.extend(
+                self._in_request_order(
+                    await asyncio.gather(*map(handle, requests))
+                )
+            )
+
+        independents: List[Message] = []
+        for etp_input_msg in decoded:
+            if isinstance(etp_input_msg, Message) and self.is_independent_msg(
+                etp_input_msg
+            ):
+                independents.append(etp_input_msg)
+                continue
+            if independents:
+                await handle_concurrently(independents)
+                independents = []
+            answers.extend(await handle(etp_input_msg))
+        if independents:
+            await handle_concurrently(independents)
+        return answers
+
+    @staticmethod
+    def _in_request_order(answers: List[List[bytes]]) -> List[bytes]:
+        """
+        Joins the answers of requests handled concurrently, in the order of the requests.
+        Their message ids were taken when they were produced : the same ids are given again to the joined
+        answers, in increasing order (and the correlation ids that refer to them are changed too).
+        """
+        frames = [
+            frame for request_answers in answers for frame in request_answers
+        ]
+        header_codec = get_header_codec()
+        headers = []
+        for frame in frames:
+            fo = BytesIO(frame)
+            headers.append((header_codec.read(fo), fo.tell()))
+        ids = [header["messageId"] for header, _ in headers]
+        if ids == sorted(ids):
+            return frames
+        new_ids = dict(zip(ids, sorted(ids)))
+        renumbered = []
+        for frame, (header, header_size) in zip(frames, headers):
+            header["messageId"] = new_ids[header["messageId"]]
+            header["correlationId"] = new_ids.get(
+                header["correlationId"], header["correlationId"]
+            )
+            renumbered.append(
+                header_codec.encode(header) + frame[header_size:]
+            )
+        return renumbered
+
+    @property
+    def outbound_queue(self) -> OutboundQueue:
+        """Queue of the binary messages to send, filled by :meth:`submit_bytes`"""
+        if self._outbound_queue is None:
+            self._outbound_queue = OutboundQueue(
+                max_bytes=self.max_outbound_bytes,
+                max_messages=self.max_outbound_messages,
+                on_back_pressure=self._back_pressure_messages,
+            )
+        return self._outbound_queue
+
+    def _back_pressure_messages(self, error: ETPError) -> Iterable[bytes]:
+        msg = error.to_etp_message(msg_id=self.consume_msg_id())
+        if msg is None:
+            return []
+        msg.set_final_msg(True)
+        return list(self.encode_message_generator(msg))
+
+    async def submit_bytes(self, msg_data: bytes) -> None:
+        """
+        Handles a received binary message, the binary messages to send are put in the outbound_queue.
+        If concurrent_handling is True, an independent request (see :meth:`is_independent_msg`) is handled
+        in a new task and this method returns without waiting for its answers (see :meth:`wait_pending_requests`).
+        Other messages are handled before this method returns.
+        """
+        etp_input_msg = self.decode_message(msg_data)
         logging.debug(f"### MSG {etp_input_msg}")
 
+        if (
+            self.concurrent_handling
+            and isinstance(etp_input_msg, Message)
+            and self.is_independent_msg(etp_input_msg)
+        ):
+            task = asyncio.ensure_future(
+                self._handle_request_task(
+                    etp_input_msg,
+                    self._get_protocol_lock(etp_input_msg.header.protocol),
+                )
+            )
+            self._pending_tasks.add(task)
+            task.add_done_callback(self._on_request_task_done)
+        else:
+            await self._put_answers(etp_input_msg)
+
+    async def wait_pending_requests(self) -> None:
+        """Waits for the end of the requests handled in tasks"""
+        while self._pending_tasks:
+            await asyncio.gather(*self._pending_tasks, return_exceptions=True)
+
+    def cancel_pending_requests(self) -> None:
+        """Cancels the requests handled in tasks (e.g. when the websocket is closed)"""
+        for task in self._pending_tasks:
+            task.cancel()
+
+    def _get_protocol_lock(self, protocol: int) -> Optional[asyncio.Lock]:
+        try:
+            communication_protocol = CommunicationProtocol(protocol)
+        except ValueError:
+            return None
+        handler = self.get_handler(communication_protocol)
+        if handler is None or not getattr(handler, "serialized", False):
+            return None
+        lock = self._protocol_locks.get(communication_protocol)
+        if lock is None:
+            lock = self._protocol_locks[communication_protocol] = (
+                asyncio.Lock()
+            )
+        return lock
+
+    async def _handle_request_task(
+        self, etp_input_msg: Message, lock: Optional[asyncio.Lock]
+    ) -> None:
+        # the lock is taken first : the tasks are started in the order of the messages, and asyncio locks are fair
+        if lock is not None:
+            async with lock:
+                await self._handle_request_with_limit(etp_input_msg)
+        else:
+            await self._handle_request_with_limit(etp_input_msg)
+
+    async def _handle_request_with_limit(self, etp_input_msg: Message) -> None:
+        if self._request_semaphore is None:
+            self._request_semaphore = asyncio.Semaphore(
+                self.max_concurrent_requests
+            )
+        async with self._request_semaphore:
+            await self._put_answers(etp_input_msg)
+
+    async def _put_answers(
+        self, etp_input_msg: Optional[Union[Message, ETPError]]
+    ) -> None:
+        queue = self.outbound_queue
+        answers = self._encoded_answers_generator(etp_input_msg)
+        # the message ids are given when the answers are produced : the handler waits until the queue is writable
+        # before producing each message, which is then put at once (forced), so the ids are put in order.
+        # The queue exceeds its limits by at most a message per request handled at the same time.
+        while True:
+            await queue.wait_writable()
+            try:
+                msg_part = await answers.__anext__()
+            except StopAsyncIteration:
+                break
+            queue.put_nowait(msg_part, force=True)
+
+    def _on_request_task_done(self, task: asyncio.Task) -> None:
+        self._pending_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logging.error(
+                f"{self.client_info.ip}: _SERVER_ not handled exception",
+                exc_info=task.exception(),
+            )
+
+    def is_independent_msg(self, etp_input_msg: Message) -> bool:
+        """
+        Returns True if the message can be handled concurrently with other messages :
+        a message that is not a part of a multipart message, outside of the Core protocol, on an open session.
+        """
+        return (
+            self.is_connected
+            and etp_input_msg.header.protocol
+            != CommunicationProtocol.CORE.value
+            and not etp_input_msg.is_multipart_msg()
+        )
+
+    async def _encoded_answers_generator(
+        self, etp_input_msg: Optional[Union[Message, ETPError]]
+    ) -> AsyncGenerator[bytes, None]:
         async for msg in self._handle_message_generator(etp_input_msg):
-            if msg is not None:
-                for msg_part in msg.encode_message_generator(
-                    self.client_info.getCapability(
-                        "MaxWebSocketMessagePayloadSize"
-                    ),
-                    self,
+            if isinstance(msg, ResponseBuilder):
+                # each message is sent as soon as the handler has produced its values
+                async for built_msg in msg.messages(
+                    self.max_payload_size(), self
                 ):
+                    for msg_part in self.encode_message_generator(built_msg):
+                        yield msg_part
+            elif msg is not None:
+                for msg_part in self.encode_message_generator(msg):
                     yield msg_part
 
+    def max_payload_size(self) -> int:
+        return self.client_info.getCapability("MaxWebSocketMessagePayloadSize")
+
+    def encode_message_generator(self, msg: Message) -> Generator[bytes, None]:
+        """
+        Encodes a message to send, in one or several parts of at most MaxWebSocketMessagePayloadSize bytes.
+        The bodies are compressed with the negotiated compression.
+        A message with an EncodedBody is sent without encoding its body again.
+        """
+        compressor = get_compressor(self.client_info.compression)
+        if isinstance(msg.body, EncodedBody):
+            # only the header is encoded, the compressed body is kept by the EncodedBody
+            max_size = self.max_payload_size()
+            frame = msg.body.encode_message(
+                msg.header.message_id,
+                msg.header.correlation_id,
+                msg.header.message_flags,
+                compressor,
+                self.compression_threshold,
+            )
+            if max_size is None or max_size <= 0 or len(frame) <= max_size:
+                yield frame
+                return
+        for msg_part in msg.encode_message_generator(
+            self.max_payload_size(),
+            self,
+        ):
+            if compressor is not None:
+                msg_part = compress_message(
+                    msg_part, compressor, self.compression_threshold
+                )
+            yield msg_part
+
     def consume_msg_id(self):
         tmp_msg_id = self.message_id
         self.message_id += 2
@@ -457,7 +970,10 @@ class ETPConnection:
     def on(
         cls: Type[ETPConnection], protocol: CommunicationProtocol
     ) -> Callable[[Type[Protocol]], Type[Protocol]]:
-        """Should only be used to decorate classes."""
+        """
+        Should only be used to decorate classes.
+        The handler instance is shared by all the connections without handler_registry (see HandlerRegistry).
+        """
 
         def decorate(cls_protocol: Type[Protocol]) -> Type[Protocol]:
             cls.transition_table[protocol] = cls_protocol()
@@ -481,20 +997,4 @@ class ETPConnection:
     def get_supported_protocol_list(
         cls: Type[ETPConnection],
     ) -> List[SupportedProtocol]:
-        supported_protocols: List[SupportedProtocol] = []
-        for protocol in cls.transition_table:
-            if protocol.value != CommunicationProtocol.CORE:
-                supported_protocols.append(
-                    SupportedProtocol(
-                        protocol=protocol.value,
-                        protocol_version={
-                            "major": 1,
-                            "minor": 2,
-                            "patch": 0,
-                            "revision": 0,
-                        },
-                        role="server",
-                        protocol_capabilities={},
-                    )
-                )
-        return supported_protocols
+        return supported_protocol_list(cls.transition_table)
@@ -0,0 +1,394 @@
+# Copyright (c) 2022-2023 Geosiris.
+# SPDX-License-Identifier: Apache-2.0
+"""
+Data arrays stored in memory-mapped files, sent and received in tiles (DataArray protocol).
+
+A customer streams a file (a .npy file, a raw file or an mmap.mmap with its dtype and shape) as
+PutDataSubarrays messages that fit in MaxWebSocketMessagePayloadSize with :func:`iter_put_data_subarrays`.
+A store writes the received tiles in memory-mapped .npy files with :class:`MappedDataArrayHandler`.
+The pages of each tile are released once it is sent or written, so that the resident memory stays bounded
+by the size of a message whatever the size of the array.
+
+Requires numpy (see etpproto.numpy_codec).
+"""
+
+import mmap
+import os
+from math import prod
+from typing import (
+    Any,
+    AsyncGenerator,
+    Dict,
+    Iterator,
+    Optional,
+    Sequence,
+    Union,
+)
+
+from etptypes.energistics.etp.v12.datatypes.data_array_types.data_array_identifier import (
+    DataArrayIdentifier,
+)
+from etptypes.energistics.etp.v12.datatypes.data_array_types.data_array_metadata import (
+    DataArrayMetadata,
+)
+from etptypes.energistics.etp.v12.datatypes.data_array_types.put_data_subarrays_type import (
+    PutDataSubarraysType,
+)
+from etptypes.energistics.etp.v12.datatypes.message_header import MessageHeader
+from etptypes.energistics.etp.v12.protocol.data_array.put_data_subarrays import (
+    PutDataSubarrays,
+)
+from etptypes.energistics.etp.v12.protocol.data_array.put_data_subarrays_response import (
+    PutDataSubarraysResponse,
+)
+from etptypes.energistics.etp.v12.protocol.data_array.put_uninitialized_data_arrays import (
+    PutUninitializedDataArrays,
+)
+from etptypes.energistics.etp.v12.protocol.data_array.put_uninitialized_data_arrays_response import (
+    PutUninitializedDataArraysResponse,
+)
+
+from etpproto.client_info import ClientInfo
+from etpproto.error import (
+    ETPError,
+    InternalError,
+    InvalidArgumentError,
+    NotFoundError,
+    NotSupportedError,
+)
+from etpproto.messages import Message
+from etpproto.numpy_codec import np, to_any_array, to_numpy
+from etpproto.subarrays import (
+    DTYPE_ARRAY_TYPES,
+    TRANSPORT_TYPES,
+    TiledDataArrayHandler,
+    array_item_size,
+    array_types,
+    iter_tiles,
+    tile_counts,
+    tile_slices,
+)
+
+PathOrBuffer = Union[str, os.PathLike, mmap.mmap]
+
+#: {logical type: numpy dtype name}
+LOGICAL_DTYPES = {
+    logical_type: dtype
+    for dtype, (_, logical_type) in DTYPE_ARRAY_TYPES.items()
+}
+
+
+class MappedArray:
+    """
+    Array stored in C order in a memory-mapped file, read and written by tiles.
+    The pages of a tile are released (madvise) when it is done with, the file keeps its values.
+
+    :ivar values: the numpy array on the mapped file (read-only if the file is opened in "r" mode)
+    """
+
+    def __init__(
+        self,
+        buffer: mmap.mmap,
+        dtype: Any,
+        shape: Sequence[int],
+        offset: int = 0,
+    ) -> None:
+        self.buffer = buffer
+        self.dtype = np.dtype(dtype)
+        self.shape = tuple(shape)
+        self.offset = offset
+        self.values = np.ndarray(
+            self.shape, dtype=self.dtype, buffer=buffer, offset=offset
+        )
+
+    @classmethod
+    def open(
+        cls,
+        path: Union[str, os.PathLike],
+        mode: str = "r",
+        dtype: Optional[Any] = None,
+        shape: Optional[Sequence[int]] = None,
+        offset: int = 0,
+    ) -> "MappedArray":
+        """
+        Maps the file :param path: in "r" or "r+" :param mode:. Without :param dtype: the file is a .npy file,
+        else it is a raw file with the array of :param shape: at :param offset:.
+        """
+        if mode not in ("r", "r+"):
+            raise ValueError(f"Unsupported mode : {mode}")
+        with open(path, "rb" if mode == "r" else "r+b") as f:
+            if dtype is None:
+                version = np.lib.format.read_magic(f)
+                read_header = (
+                    np.lib.format.read_array_header_1_0
+                    if version == (1, 0)
+                    else np.lib.format.read_array_header_2_0
+                )
+                shape, fortran_order, dtype = read_header(f)
+                if fortran_order:
+                    raise ValueError(f"{path} is in Fortran order")
+                offset = f.tell()
+            elif shape is None:
+                raise ValueError("The shape of a raw file is required")
+            buffer = mmap.mmap(
+                f.fileno(),
+                0,
+                access=mmap.ACCESS_READ if mode == "r" else mmap.ACCESS_WRITE,
+            )
+        return cls(buffer, dtype, shape, offset)
+
+    @classmethod
+    def create(
+        cls, path: Union[str, os.PathLike], dtype: Any, shape: Sequence[int]
+    ) -> "MappedArray":
+        """Creates the .npy file :param path: (sparse, its values are 0) and maps it"""
+        dtype = np.dtype(dtype)
+        with open(path, "wb") as f:
+            np.lib.format.write_array_header_1_0(
+                f,
+                {
+                    "descr": np.lib.format.dtype_to_descr(dtype),
+                    "fortran_order": False,
+                    "shape": tuple(shape),
+                },
+            )
+            f.truncate(f.tell() + dtype.itemsize * prod(shape))
+        return cls.open(path, mode="r+")
+
+    def read(self, starts: Sequence[int], counts: Sequence[int]) -> Any:
+        """Returns a view on a tile (call :meth:`release` once it is sent)"""
+        return self.values[self._slices(starts, counts)]
+
+    def write(
+        self, starts: Sequence[int], counts: Sequence[int], values: Any
+    ) -> None:
+        """Writes the values of a tile, and releases its pages"""
+        tile = self.values[self._slices(starts, counts)]
+        values = np.asarray(values)
+        if values.size != tile.size:
+            raise ValueError(
+                f"{values.size} values for a tile of counts {list(counts)}"
+            )
+        tile[...] = values.reshape(tile.shape)
+        self.release(starts, counts)
+
+    def release(self, starts: Sequence[int], counts: Sequence[int]) -> None:
+        """Removes the pages of a tile from the memory of the process"""
+        if not hasattr(mmap, "MADV_DONTNEED") or 0 in counts:
+            return
+        item_size = self.dtype.itemsize
+        first = self.offset + item_size * int(
+            np.ravel_multi_index(tuple(starts), self.shape)
+        )
+        last = self.offset + item_size * (
+            int(
+                np.ravel_multi_index(
+                    tuple(s + c - 1 for s, c in zip(starts, counts)),
+                    self.shape,
+                )
+            )
+            + 1
+        )
+        first -= first % mmap.PAGESIZE
+        self.buffer.madvise(mmap.MADV_DONTNEED, first, last - first)
+
+    def close(self) -> None:
+        """Unmaps the file (the arrays returned by :meth:`read` must not be used anymore)"""
+        del self.values
+        self.buffer.close()
+
+    def _slices(self, starts: Sequence[int], counts: Sequence[int]) -> Any:
+        if len(starts) != len(self.shape) or len(counts) != len(self.shape):
+            raise ValueError(
+                f"Tile of {len(starts)} dimensions in an array of {len(self.shape)} dimensions"
+            )
+        if any(
+            s < 0 or c < 0 or s + c > d
+            for s, c, d in zip(starts, counts, self.shape)
+        ):
+            raise ValueError(
+                f"Tile {list(starts)}+{list(counts)} out of an array of shape {self.shape}"
+            )
+        return tile_slices(starts, counts)
+
+
+def iter_put_data_subarrays(
+    uid: DataArrayIdentifier,
+    source: Union[PathOrBuffer, MappedArray],
+    max_payload_size: Optional[int],
+    dtype: Optional[Any] = None,
+    shape: Optional[Sequence[int]] = None,
+    offset: int = 0,
+    key_prefix: str = "",
+) -> Iterator[PutDataSubarrays]:
+    """
+    Yields the PutDataSubarrays messages of the array :param source: for the data array :param uid:,
+    each one fitting in :param max_payload_size: bytes (a single tile if it is None or not positive).
+    The source is a .npy file, a raw file or an mmap.mmap with the array of :param dtype: and :param shape:
+    at :param offset:, or a :class:`MappedArray`.
+    A message must be encoded before the next one is asked for : the pages of its tile are then released.
+    A file given by its path is closed when the generator ends (or is closed).
+    Raises a NotSupportedError if the dtype of the array has no ETP array type (e.g. uint64).
+    The data array is created before with PutUninitializedDataArrays (see etpproto.subarrays.data_array_metadata).
+
+        for body in iter_put_data_subarrays(uid, "grid.npy", connection.max_payload_size()):
+            msg = Message.get_object_message(body, msg_id=connection.consume_msg_id())
+            for msg_part in connection.encode_message_generator(msg):
+                await websocket.send(msg_part)
+    """
+    if isinstance(source, MappedArray):
+        array = source
+    elif isinstance(source, mmap.mmap):
+        if dtype is None or shape is None:
+            raise ValueError("The dtype and shape of a mmap are required")
+        array = MappedArray(source, dtype, shape, offset)
+    else:
+        array = MappedArray.open(
+            source, dtype=dtype, shape=shape, offset=offset
+        )
+    try:
+        # raises a NotSupportedError if the values can not be sent
+        array_types(array.dtype)
+        if max_payload_size is None or max_payload_size <= 0:
+            tile_dimensions = list(array.shape)
+        else:
+            # the uid is repeated in each tile
+            uid_size = len(uid.uri.encode()) + len(
+                uid.path_in_resource.encode()
+            )
+            tile_dimensions = tile_counts(
+                array.shape,
+                array_item_size(array.values),
+                max_payload_size - uid_size,
+            )
+        for i, (starts, counts) in enumerate(
+            iter_tiles(array.shape, tile_dimensions)
+        ):
+            yield PutDataSubarrays.construct(
+                data_subarrays={
+                    f"{key_prefix}{i}": PutDataSubarraysType.construct(
+                        uid=uid,
+                        data=to_any_array(array.read(starts, counts)),
+                        starts=starts,
+                        counts=counts,
+                    )
+                }
+            )
+            array.release(starts, counts)
+    finally:
+        # only the file opened here is closed, the MappedArray and mmap sources belong to the caller
+        if array is not source and not isinstance(source, mmap.mmap):
+            array.close()
+
+
+class MappedDataArrayHandler(TiledDataArrayHandler):
+    """
+    DataArrayHandler of a store that keeps its data arrays in memory-mapped .npy files, given by :meth:`array_path`.
+    PutUninitializedDataArrays creates the files, the tiles of PutDataSubarrays are written straight in them,
+    and the arrays are answered in tiles as by a :class:`etpproto.subarrays.TiledDataArrayHandler`.
+
+    :ivar arrays: the {path: MappedArray} of the files opened
+    """
+
+    def __init__(self) -> None:
+        self.arrays: Dict[str, MappedArray] = {}
+
+    def array_path(
+        self,
+        uid: DataArrayIdentifier,
+        client_info: Union[None, ClientInfo] = None,
+    ) -> str:
+        """Returns the path of the .npy file of the data array :param uid:"""
+        raise NotSupportedError()
+
+    def open_array(
+        self,
+        uid: DataArrayIdentifier,
+        client_info: Union[None, ClientInfo] = None,
+    ) -> MappedArray:
+        path = self.array_path(uid, client_info)
+        if path not in self.arrays:
+            if not os.path.exists(path):
+                raise NotFoundError()
+            self.arrays[path] = MappedArray.open(path, mode="r+")
+        return self.arrays[path]
+
+    async def get_array(
+        self,
+        uid: DataArrayIdentifier,
+        client_info: Union[None, ClientInfo] = None,
+    ) -> Any:
+        return self.open_array(uid, client_info).values
+
+    async def on_put_uninitialized_data_arrays(
+        self,
+        msg: PutUninitializedDataArrays,
+        msg_header: MessageHeader,
+        client_info: Union[None, ClientInfo] = None,
+    ) -> AsyncGenerator[Optional[Message], None]:
+        success = {}
+        errors = {}
+        for key, data_array in msg.data_arrays.items():
+            try:
+                path = self.array_path(data_array.uid, client_info)
+                previous = self.arrays.pop(path, None)
+                if previous is not None:
+                    previous.close()
+                self.arrays[path] = MappedArray.create(
+                    path,
+                    self._dtype(data_array.metadata),
+                    data_array.metadata.dimensions,
+                )
+                success[key] = ""
+            except ETPError as err:
+                errors[key] = err.to_etp_error()
+            except OSError as err:
+                # e.g. a missing directory, a full disk or a permission error
+                errors[key] = InternalError(
+                    f"Can not create the data array : {err}"
+                ).to_etp_error()
+        for answer in self._answers(
+            PutUninitializedDataArraysResponse(success=success),
+            success,
+            errors,
+            msg_header,
+        ):
+            yield answer
+
+    async def on_put_data_subarrays(
+        self,
+        msg: PutDataSubarrays,
+        msg_header: MessageHeader,
+        client_info: Union[None, ClientInfo] = None,
+    ) -> AsyncGenerator[Optional[Message], None]:
+        success = {}
+        errors = {}
+        for key, subarray in msg.data_subarrays.items():
+            try:
+                array = self.open_array(subarray.uid, client_info)
+                try:
+                    array.write(
+                        subarray.starts,
+                        subarray.counts,
+                        to_numpy(subarray.data),
+                    )
+                except ValueError:
+                    raise InvalidArgumentError()
+                success[key] = ""
+            except ETPError as err:
+                errors[key] = err.to_etp_error()
+        for answer in self._answers(
+            PutDataSubarraysResponse(success=success),
+            success,
+            errors,
+            msg_header,
+        ):
+            yield answer
+
+    @staticmethod
+    def _dtype(metadata: DataArrayMetadata) -> str:
+        if metadata.logical_array_type in LOGICAL_DTYPES:
+            return LOGICAL_DTYPES[metadata.logical_array_type]
+        if metadata.transport_array_type in TRANSPORT_TYPES:
+            return TRANSPORT_TYPES[metadata.transport_array_type][0]
+        raise InvalidArgumentError()
@@ -3,26 +3,48 @@
 
 from __future__ import annotations
 
-import json
 import logging
 import re
+import time
 import uuid as pyUUID
 from abc import ABC
-from copy import deepcopy
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from enum import IntFlag
 from io import BytesIO
 from math import ceil
-from typing import Generator, Dict, List, Optional, Tuple, Any, Union
+from typing import (
+    Any,
+    AsyncGenerator,
+    AsyncIterable,
+    Callable,
+    ClassVar,
+    Dict,
+    Generator,
+    Iterable,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
 
 import etptypes.energistics.etp.v12.datatypes.message_header as mh
-from etptypes import ETPModel, avro_schema
-from etptypes.energistics.etp.v12.datatypes.object.data_object import (
-    DataObject,
-)
+from etptypes import ETPModel
 from etptypes.energistics.etp.v12.datatypes.uuid import Uuid
-from fastavro import schemaless_reader, schemaless_writer
 
+from etpproto.codec import (
+    CodecRegistry,
+    RecordView,
+    as_avro_record,
+    codec_registry,
+    encoded_size,
+    get_codec,
+    get_codec_for_class,
+    get_header_codec,
+    header_from_record,
+    header_to_record,
+    long_size,
+)
 from etpproto.utils import (
     ProtocolDict,
     concat,
@@ -62,18 +84,57 @@ class MessageFlags(
 
 @dataclass
 class Message(ABC):
+    """
+    :ivar encoded_size: the size in bytes of the binary message it was decoded from (with its body
+        decompressed), None if it was not decoded
+    """
+
     header: mh.MessageHeader
-    body: ETPModel
+    body: Union[ETPModel, RecordView, EncodedBody]
+    encoded_size: Optional[int] = field(
+        default=None, init=False, repr=False, compare=False
+    )
 
-    def encode_message(self) -> bytes:
+    def body_class(self) -> type:
+        """Returns the ETP class of the body, even if it is a not validated RecordView or an EncodedBody"""
+        if isinstance(self.body, (RecordView, EncodedBody)):
+            return self.body.object_class
+        return type(self.body)
+
+    def body_model(self) -> ETPModel:
+        """Returns the body as a validated ETPModel"""
+        body = (
+            self.body.to_model()
+            if isinstance(self.body, EncodedBody)
+            else self.body
+        )
+        if isinstance(body, RecordView):
+            return body.to_model()
+        return body
+
+    def _body_record(self) -> Any:
+        if isinstance(self.body, RecordView):
+            return self.body.record
+        return as_avro_record(self.body)
+
+    def _write_body(
+        self, fo: BytesIO, registry: Optional[CodecRegistry] = None
+    ) -> None:
+        if isinstance(self.body, EncodedBody):
+            fo.write(self.body.data)
+        else:
+            (registry or codec_registry).for_class(self.body_class()).write(
+                fo, self._body_record()
+            )
+
+    def encode_message(
+        self, registry: Optional[CodecRegistry] = None
+    ) -> bytes:
+        """Encodes the message with the codecs of :param registry: (the process wide registry if None)"""
         bio = BytesIO()
         if self.header:
-            header_schema = json.loads(mh.avro_schema)
-            schemaless_writer(
-                bio, header_schema, self.header.dict(by_alias=True)
-            )
-        obj_schema = json.loads(avro_schema(type(self.body)))
-        schemaless_writer(bio, obj_schema, self.body.dict(by_alias=True))
+            get_header_codec().write(bio, header_to_record(self.header))
+        self._write_body(bio, registry)
 
         value = bio.getvalue()
 
@@ -93,100 +154,53 @@ class Message(ABC):
     def encode_message_generator(  # noqa
         self, max_bytes_per_msg, connection
     ) -> Generator[bytes, None]:
-        # si requete on met le correlation_id sur le l'id du premier message
-        # si self a un correlation_id alors c'est que ce n'était pas le premier
-        correlation_id = (
-            self.header.correlation_id
-            if self.header.correlation_id != 0
-            else self.header.message_id
-        )
-        is_a_request = (
-            not type(self.body).__name__.lower().endswith("response")
-        )
-
         from etpproto.error import ETPError, MaxSizeExceededError
 
         # Header encoding
-        header_schema = json.loads(mh.avro_schema)
         out_h0 = BytesIO()
         if self.header:
-            schemaless_writer(
-                out_h0, header_schema, self.header.dict(by_alias=True)
-            )
+            get_header_codec().write(out_h0, header_to_record(self.header))
 
-        # Body encoding
+        # Body encoding, with the codecs of the connection
+        registry = getattr(connection, "codec_registry", None)
         out_body = BytesIO()
-        obj_schema = json.loads(avro_schema(type(self.body)))
-        schemaless_writer(out_body, obj_schema, self.body.dict(by_alias=True))
+        self._write_body(out_body, registry)
 
         # Size computation
         header_size = int(out_h0.getbuffer().nbytes)
         body_size = int(out_body.getbuffer().nbytes)
+        if 0 < max_bytes_per_msg < header_size + body_size and isinstance(
+            self.body, EncodedBody
+        ):
+            # the message is split from the model of the body
+            for part in Message(
+                self.header, self.body.to_model()
+            ).encode_message_generator(max_bytes_per_msg, connection):
+                yield part
+            return
         try:
             if 0 < max_bytes_per_msg < header_size + body_size:
                 # Message exceed the max_bytes_per_msg
                 if self.is_plural_msg():
-                    msg1 = deepcopy(self)
-                    # get the first dict attribute
-                    # split it in x factor (as the message is x times too large)
+                    # get the first dict attribute (or list if no dict is found)
                     cuttable_attrib_name = get_first_dict_attribute_name(
-                        msg1.body
+                        self.body
                     )
-
-                    values = []
-                    if cuttable_attrib_name is not None:  # on a bien un dict
-                        values = getattr(msg1.body, cuttable_attrib_name)
-                    else:
+                    if cuttable_attrib_name is None:
                         cuttable_attrib_name = get_first_list_attribute_name(
-                            msg1.body
+                            self.body
                         )
-                        values = getattr(msg1.body, cuttable_attrib_name)
+                    values = (
+                        getattr(self.body, cuttable_attrib_name)
+                        if cuttable_attrib_name is not None
+                        else []
+                    )
 
                     if len(values) > 1:
-                        msg2 = deepcopy(self)
-                        msg2.header.message_id = connection.consume_msg_id()
-
-                        # si msg1 etait un vrai premier message on met le suivant au bon correlation id
-                        if msg1.header.correlation_id == 0:
-                            msg2.header.correlation_id = msg1.header.message_id
-
-                        if is_a_request:
-                            msg2.header.correlation_id = correlation_id
-                        # else : # rien a changer le correlation_id est deja sur le meme que self car c'est celui de la requete recu
-
-                        d0: Union[list, Dict[Any, Any]] = {}
-                        d1: Union[list, Dict[Any, Any]] = {}
-
-                        if isinstance(values, dict):  # on a bien un dict
-                            # splitting dict in 2 parts
-                            for k, v in values.items():
-                                if len(d0) < len(values) / 2:
-                                    d0[k] = v
-                                else:
-                                    d1[k] = v
-                        else:
-                            d0 = []
-                            d1 = []
-                            # splitting list in 2 parts
-                            for v in values:
-                                if len(d0) < len(values) / 2:
-                                    d0.append(v)
-                                else:
-                                    d1.append(v)
-
-                        setattr(msg1.body, cuttable_attrib_name, d0)
-                        setattr(msg2.body, cuttable_attrib_name, d1)
-
-                        msg1.add_header_flag(MessageFlags.MULTIPART)
-                        msg2.add_header_flag(MessageFlags.MULTIPART)
-
-                        msg1.set_final_msg(False)
-                        for part in msg1.encode_message_generator(
-                            max_bytes_per_msg, connection
-                        ):
-                            yield part
-                        for part in msg2.encode_message_generator(
-                            max_bytes_per_msg, connection
+                        for part in self._encode_plural_message_generator(
+                            cuttable_attrib_name,
+                            max_bytes_per_msg,
+                            connection,
                         ):
                             yield part
                     else:
@@ -197,7 +211,6 @@ class Message(ABC):
                         ):
                             for part in _encode_message_generator_chunk(
                                 chunkable_msg=self,
-                                encoded_msg_size=body_size,
                                 max_bytes_per_msg=max_bytes_per_msg,
                                 connection=connection,
                             ):
@@ -220,13 +233,129 @@ class Message(ABC):
             )
             if msg_err is not None:
                 msg_err.set_final_msg(True)
-                for part in msg_err.encode_message_generator(
-                    -1, connection
-                ):
+                for part in msg_err.encode_message_generator(-1, connection):
                     yield part
             else:
                 raise err
 
+    def _encode_plural_message_generator(
+        self,
+        cuttable_attrib_name: str,
+        max_bytes_per_msg: int,
+        connection,
+        safety_margin: int = 0,
+    ) -> Generator[bytes, None]:
+        """
+        Splits a plural message in several parts of at most max_bytes_per_msg bytes.
+        Each entry of the map/list is encoded once to get its size, then the entries are packed
+        greedily in the parts. Every part has the MULTIPART flag, only the last one keeps the
+        FINALPART flag of the original message.
+        The first part keeps the message id of the original message, the next ones take a new id
+        and the correlation id of the original message (or its message id if it is a request).
+        """
+        # si requete on met le correlation_id sur le l'id du premier message
+        # si self a un correlation_id alors c'est que ce n'était pas le premier
+        correlation_id = (
+            self.header.correlation_id
+            if self.header.correlation_id != 0
+            else self.header.message_id
+        )
+        was_final = self.is_final_msg()
+
+        values = getattr(self.body, cuttable_attrib_name)
+        is_dict = isinstance(values, dict)
+
+        def make_part(part_values: Union[list, Dict[Any, Any]]) -> Message:
+            return Message(
+                self.header.copy(),
+                self.body.copy(update={cuttable_attrib_name: part_values}),
+            )
+
+        empty_body_size = len(
+            get_codec_for_class(self.body_class()).encode(
+                as_avro_record(make_part({} if is_dict else []).body)
+            )
+        )
+        # next parts have greater message ids, their header may be a bit larger
+        header_size = (
+            len(get_header_codec().encode(header_to_record(self.header))) + 2
+        )
+        available_size = (
+            max_bytes_per_msg - header_size - empty_body_size - safety_margin
+        )
+
+        def emit(
+            part: Message, is_first: bool, is_last: bool
+        ) -> Generator[bytes, None]:
+            if not is_first:
+                part.header.message_id = connection.consume_msg_id()
+                part.header.correlation_id = correlation_id
+            part.add_header_flag(MessageFlags.MULTIPART)
+            part.set_final_msg(is_last and was_final)
+            nb_values = len(getattr(part.body, cuttable_attrib_name))
+            if nb_values > 1:
+                encoded = part.encode_message(
+                    getattr(connection, "codec_registry", None)
+                )
+                if len(encoded) <= max_bytes_per_msg:
+                    yield encoded
+                else:
+                    # the size estimation was too small, we split this part with a larger margin
+                    for sub_part in part._encode_plural_message_generator(
+                        cuttable_attrib_name,
+                        max_bytes_per_msg,
+                        connection,
+                        safety_margin + len(encoded) - max_bytes_per_msg,
+                    ):
+                        yield sub_part
+            else:
+                # a single value : the part is sent as it is, or chunked or refused if it is too large
+                for sub_part in part.encode_message_generator(
+                    max_bytes_per_msg, connection
+                ):
+                    yield sub_part
+
+        pending: Optional[Message] = None
+        pending_is_first = True
+        current: Union[list, Dict[Any, Any]] = {} if is_dict else []
+        current_size = 0
+
+        for item in values.items() if is_dict else values:
+            if is_dict:
+                item_size = encoded_size(item[0]) + encoded_size(item[1])
+            else:
+                item_size = encoded_size(item)
+
+            if (
+                len(current) > 0
+                and current_size + item_size + long_size(len(current) + 1)
+                > available_size
+            ):
+                if pending is not None:
+                    for part in emit(pending, pending_is_first, False):
+                        yield part
+                    pending_is_first = False
+                pending = make_part(current)
+                current = {} if is_dict else []
+                current_size = 0
+
+            if is_dict:
+                current[item[0]] = item[1]  # type: ignore[call-overload]
+            else:
+                current.append(item)  # type: ignore[union-attr]
+            current_size += item_size
+
+        if len(current) > 0:
+            if pending is not None:
+                for part in emit(pending, pending_is_first, False):
+                    yield part
+                pending_is_first = False
+            pending = make_part(current)
+
+        if pending is not None:
+            for part in emit(pending, pending_is_first, True):
+                yield part
+
     def is_partial(self) -> bool:
         return isinstance(self.body, bytes)
 
@@ -262,13 +391,13 @@ class Message(ABC):
     def is_plural_msg(self):
         if self.body:
             return (
-                re.fullmatch(r".*s(Response)?$", type(self.body).__name__)
+                re.fullmatch(r".*s(Response)?$", self.body_class().__name__)
                 is not None
             )
         return False
 
     def is_chunk_msg(self) -> bool:
-        return type(self.body).__name__.lower() == "chunk"
+        return self.body_class().__name__.lower() == "chunk"
 
     def is_chunkable(self) -> bool:
         return hasattr(self.body, "data_objects")
@@ -300,94 +429,65 @@ class Message(ABC):
     def reassemble_chunk(
         cls, multipart_msg: List[Message]
     ) -> Optional[Message]:
-        referencer: Optional[Message] = None
-
-        # on rassemble tout dans un seul msg (concat de toutes les map)
+        """
+        Reassembles the parts (referencers and chunks) of a chunked message.
+        Returns None if no referencer is found in :param multipart_msg:
+        """
+        reassembler = ChunkReassembler()
         for msg in multipart_msg:
-            if msg.is_chunk_msg_referencer():
-                if referencer is None:
-                    referencer = msg
-                else:
-                    # assert referencer.body is not None
-                    referencer.body.data_objects = (  # type: ignore[attr-defined]
-                        msg.body.data_objects  # type: ignore[attr-defined]
-                        if referencer.body.data_objects is None  # type: ignore[attr-defined]
-                        else concat(
-                            referencer.body.data_objects,  # type: ignore[attr-defined]
-                            msg.body.data_objects,  # type: ignore[attr-defined]
-                        )
-                    )
-
-        result = None
-
-        assert referencer is not None
-        do_collection = referencer.body.data_objects  # type: ignore[attr-defined]
-
-        # todo : faire un sort ?
-        if referencer is not None and do_collection is not None:
-
-            def inner_operate_data_object(data_object: DataObject):
-                for msg in multipart_msg:
-                    if (
-                        msg.is_chunk_msg()
-                        and msg.body.blob_id == data_object.blob_id  # type: ignore[attr-defined]
-                    ):
-                        data_object.data = (
-                            msg.body.data  # type: ignore[attr-defined]
-                            if data_object.data is None
-                            or len(data_object.data) == 0
-                            else data_object.data + msg.body.data  # type: ignore[attr-defined]
-                        )
-                    # TODO : on ne test pas le "is_final" du dernier chunk mais peut importe
-
-                if data_object.data is not None and len(data_object.data) > 0:
-                    data_object.blob_id = (
-                        None  # pas de blob_id ET data en meme temps
-                    )
-                return data_object
-
-            if isinstance(do_collection, list):
-                for do in do_collection:
-                    inner_operate_data_object(do)
-            elif isinstance(do_collection, dict):
-                for k, do in do_collection.items():
-                    inner_operate_data_object(do)
-            else:
-                logging.error(
-                    f"#etpproto.message@reassemble_chunk : not supported chunckable message data_objects type : {type(do_collection)}"
-                )
-            result = referencer
-
-        return result
+            reassembler.add(0, msg)
+        return reassembler.pop(0)
 
     @classmethod
     def decode_binary_message(
-        cls, binary: bytes, dict_map_pro_to_class: ProtocolDict
+        cls,
+        binary: bytes,
+        dict_map_pro_to_class: ProtocolDict,
+        lazy_validation: bool = False,
+        max_decompressed_size: Optional[int] = None,
+        registry: Optional[CodecRegistry] = None,
     ) -> Optional[Message]:
+        """
+        Decodes an ETP message, with the codecs of :param registry: (the process wide registry if None).
+        If :param lazy_validation: is True, the pydantic validation is skipped (except for Core protocol
+        and chunkable multipart messages, that are needed by the connection itself) :
+        the body is a RecordView over the fastavro record and the header is not validated.
+        A compressed body is decompressed up to :param max_decompressed_size: bytes (see etpproto.compression),
+        a MaxSizeExceededError is raised if it is larger.
+        """
         fo = BytesIO(binary)
-        recMH = schemaless_reader(
-            fo=fo,
-            writer_schema=json.loads(mh.avro_schema),
-            return_record_name=True,
-            return_record_name_override=True,
-        )
+        recMH = get_header_codec().read(fo)
         posAfterHeaderRead = fo.tell()
+        header_size = posAfterHeaderRead
 
         assert isinstance(recMH, dict)
+        if recMH.get("messageFlags", 0) & MessageFlags.COMPRESSED:
+            from etpproto.error import MaxSizeExceededError
+
+            try:
+                fo = _decompressed_body_stream(
+                    binary, posAfterHeaderRead, max_decompressed_size
+                )
+            except MaxSizeExceededError:
+                raise
+            except Exception as e:
+                logging.error(f"@decode_binary_message : {e}")
+                return None
+            posAfterHeaderRead = 0
+        body_start = posAfterHeaderRead
         if recMH.get("protocol", -1) >= 0:
+            lazy = lazy_validation and recMH["protocol"] != 0
             try:
-                object_class = dict_map_pro_to_class[str(recMH["protocol"])][
-                    str(recMH["messageType"])
-                ]
+                codec = (registry or codec_registry).get(
+                    recMH["protocol"],
+                    recMH["messageType"],
+                    dict_map_pro_to_class,
+                )
+                object_class = codec.object_class
 
                 # logging.debug("##> len : {len(binary)} posAfterHeaderRead {posAfterHeaderRead} fotell {fo.tell()}")
 
-                object_res = schemaless_reader(
-                    fo,
-                    json.loads(avro_schema(object_class)),
-                    return_record_name=True,
-                    return_record_name_override=True,
-                )
+                object_res = codec.read(fo)
 
                 logging.debug("HEADER %s", recMH)
 
@@ -396,30 +496,22 @@ class Message(ABC):
                 )
                 logging.debug(" ==> object_class  %s", object_class)
 
-                return Message(
-                    mh.MessageHeader.parse_obj(recMH),
-                    object_class.parse_obj(object_res),
-                )
+                msg = _build_message(recMH, object_class, object_res, lazy)
+                msg.encoded_size = header_size + fo.tell() - body_start
+                return msg
             except Exception as e:
                 logging.error(f"{e}")
                 # error, now we try to read it as an error, because error has now the protocol of the message send by the client
                 # try:
-                object_class = dict_map_pro_to_class["0"][
-                    str(recMH["messageType"])
-                ]
+                codec = (registry or codec_registry).get(
+                    0, recMH["messageType"], dict_map_pro_to_class
+                )
+                object_class = codec.object_class
 
                 logging.debug(f" ==> object_class {object_class}")
 
-                object_res = schemaless_reader(
-                    fo,
-                    json.loads(avro_schema(object_class)),
-                    return_record_name=True,
-                    return_record_name_override=True,
-                )
-                return Message(
-                    mh.MessageHeader.parse_obj(recMH),
-                    object_class.parse_obj(object_res),
-                )
+                object_res = codec.read(fo)
+                return _build_message(recMH, object_class, object_res, lazy)
                 # except Exception:
                 #     traceback.print_exc()
                 #     logging.error("### ERR : in decode_binary_message")
@@ -433,7 +525,7 @@ class Message(ABC):
     @classmethod
     def get_object_message(
         cls,
-        etp_object: ETPModel,
+        etp_object: Union[ETPModel, EncodedBody],
         msg_id: int = -1,
         has_header: bool = True,
         correlation_id: int = 0,
@@ -443,12 +535,16 @@ class Message(ABC):
             logging.debug(f"get_object_message {etp_object}")
             logging.debug(f"get_object_message {type(etp_object)}")
 
-            obj_schema = json.loads(avro_schema(type(etp_object)))
+            codec = get_codec_for_class(
+                etp_object.object_class
+                if isinstance(etp_object, EncodedBody)
+                else type(etp_object)
+            )
 
             if has_header:
                 header = mh.MessageHeader(
-                    protocol=int(obj_schema["protocol"]),
-                    messageType=int(obj_schema["messageType"]),
+                    protocol=codec.protocol,
+                    messageType=codec.message_type,
                     correlationId=correlation_id,
                     messageId=msg_id,
                     messageFlags=message_flags,
@@ -457,6 +553,509 @@ class Message(ABC):
         return None
 
 
+class EncodedBody:
+    """
+    A message body encoded once, to be sent in several messages : only their header is encoded
+    (e.g. retransmitted messages, notifications sent to many sessions, answers that do not change).
+    A handler can answer with it as with an ETP object :
+
+        types = EncodedBody.from_model(GetSupportedTypesResponse(supported_types=...))
+        ...
+        yield Message.get_object_message(types, correlation_id=msg_header.message_id)
+
+    The compressed versions of the body are kept too (one per compressor).
+    :ivar object_class: the ETP class of the body
+    :ivar data: the avro encoding of the body
+    :ivar model: the body, if it is known. A message larger than the max payload size is split from it.
+    """
+
+    def __init__(
+        self,
+        object_class: type,
+        data: bytes,
+        model: Optional[Union[ETPModel, RecordView]] = None,
+    ) -> None:
+        self.object_class = object_class
+        self.data = data
+        self.model = model
+        codec = get_codec_for_class(object_class)
+        self.protocol = codec.protocol
+        self.message_type = codec.message_type
+        self._compressed: Dict[str, Optional[bytes]] = {}
+
+    @classmethod
+    def from_model(cls, body: Union[ETPModel, RecordView]) -> EncodedBody:
+        if isinstance(body, RecordView):
+            object_class, record = body.object_class, body.record
+        else:
+            object_class, record = type(body), as_avro_record(body)
+        return cls(
+            object_class,
+            get_codec_for_class(object_class).encode(record),
+            body,
+        )
+
+    def to_model(self) -> Union[ETPModel, RecordView]:
+        """Returns the body (decoded from its encoding if it is not known)"""
+        if self.model is None:
+            self.model = self.object_class.parse_obj(
+                get_codec_for_class(self.object_class).read(BytesIO(self.data))
+            )
+        return self.model
+
+    def compressed(
+        self, compressor: Any, threshold: int = 0
+    ) -> Optional[bytes]:
+        """
+        Returns the body compressed by :param compressor: (see etpproto.compression), None if it is not larger
+        than :param threshold: bytes, if its message type can not be compressed or if the compression is useless
+        """
+        from etpproto.compression import can_compress
+
+        if len(self.data) <= threshold or not can_compress(
+            self.protocol, self.message_type
+        ):
+            return None
+        if compressor.name not in self._compressed:
+            compressed = compressor.compress(self.data)
+            self._compressed[compressor.name] = (
+                compressed if len(compressed) < len(self.data) else None
+            )
+        return self._compressed[compressor.name]
+
+    def encode_message(
+        self,
+        message_id: int,
+        correlation_id: int = 0,
+        message_flags: int = MessageFlags.FINALPART,
+        compressor: Any = None,
+        compression_threshold: int = 0,
+    ) -> bytes:
+        """
+        Returns a message with this body and a new header. The body is compressed by :param compressor:
+        (if it is not None) as in etpproto.compression.compress_message.
+        """
+        data = self.data
+        if compressor is not None:
+            compressed = self.compressed(compressor, compression_threshold)
+            if compressed is not None:
+                data = compressed
+                message_flags |= MessageFlags.COMPRESSED
+        return (
+            get_header_codec().encode(
+                {
+                    "protocol": self.protocol,
+                    "messageType": self.message_type,
+                    "correlationId": correlation_id,
+                    "messageId": message_id,
+                    "messageFlags": message_flags,
+                }
+            )
+            + data
+        )
+
+
+class ResponseBuilder:
+    """
+    Response built incrementally by a handler : the values of a plural attribute of the response body
+    (e.g. GetResourcesResponse.resources or GetDataArraysResponse.dataArrays) are produced by an iterable
+    (or an async iterable), and are packed in multipart messages of at most MaxWebSocketMessagePayloadSize bytes
+    as soon as they are produced. Only the values of the message in progress are kept in memory.
+    A handler yields the builder instead of a Message :
+
+        async def on_get_resources(self, msg, msg_header, client_info=None):
+            yield ResponseBuilder(
+                GetResourcesResponse(resources=[]),
+                "resources",
+                backend.iter_resources(msg.context),  # yields the Resources one by one
+                correlation_id=msg_header.message_id,
+            )
+
+    For a map attribute, the iterable gives (key, value) pairs.
+    An ETPError raised by the iterable ends the response with its ProtocolException.
+    :ivar body: the response body, without values for :ivar attribute: (the other attributes are sent in each message)
+    :ivar attribute: the python name of the plural attribute
+    :ivar values: the values of the attribute
+    :ivar correlation_id: the message id of the request
+    :ivar encoded_bodies: bodies of the response already encoded (e.g. from columns, see etpproto.channel_data),
+        each one sent in a message before the values. They must fit in a message.
+    """
+
+    def __init__(
+        self,
+        body: ETPModel,
+        attribute: str,
+        values: Union[Iterable[Any], AsyncIterable[Any]],
+        correlation_id: int = 0,
+        encoded_bodies: Sequence[EncodedBody] = (),
+    ) -> None:
+        self.body = body
+        self.attribute = attribute
+        self.values = values
+        self.correlation_id = correlation_id
+        self.encoded_bodies = encoded_bodies
+        self.is_dict = isinstance(getattr(body, attribute), dict)
+
+    async def _iter_values(self) -> AsyncGenerator[Any, None]:
+        if isinstance(self.values, AsyncIterable):
+            async for value in self.values:
+                yield value
+        else:
+            for value in self.values:
+                yield value
+
+    def _make_message(
+        self, values: Union[list, Dict[Any, Any]], connection
+    ) -> Message:
+        msg = Message.get_object_message(
+            self.body.copy(update={self.attribute: values}),
+            msg_id=connection.consume_msg_id(),
+            correlation_id=self.correlation_id,
+        )
+        assert msg is not None
+        return msg
+
+    async def messages(
+        self, max_bytes_per_msg: int, connection
+    ) -> AsyncGenerator[Message, None]:
+        """
+        Yields the messages of the response, each one as soon as it is full (or when the values are exhausted).
+        The values are packed greedily with their encoded size (a message larger than :param max_bytes_per_msg:
+        because of an estimation error is split again when it is encoded).
+        max_bytes_per_msg : negative number for infinite size
+        """
+        from etpproto.error import ETPError
+
+        empty_msg = Message.get_object_message(
+            self.body.copy(
+                update={self.attribute: {} if self.is_dict else []}
+            ),
+            msg_id=connection.message_id,
+            correlation_id=self.correlation_id,
+        )
+        assert empty_msg is not None
+        # next messages have greater message ids, their header may be a bit larger
+        available_size = (
+            max_bytes_per_msg - len(empty_msg.encode_message()) - 2
+            if max_bytes_per_msg > 0
+            else None
+        )
+
+        current: Union[list, Dict[Any, Any]] = {} if self.is_dict else []
+        current_size = 0
+        nb_sent = 0
+        # the message of the last encoded body, that is the final one if there are no values
+        pending: Optional[Message] = None
+        for encoded_body in self.encoded_bodies:
+            if pending is not None:
+                yield pending
+                nb_sent += 1
+            pending = Message.get_object_message(
+                encoded_body,
+                msg_id=connection.consume_msg_id(),
+                correlation_id=self.correlation_id,
+                message_flags=MessageFlags.MULTIPART,
+            )
+        try:
+            async for item in self._iter_values():
+                if pending is not None:
+                    yield pending
+                    nb_sent += 1
+                    pending = None
+                if self.is_dict:
+                    item_size = encoded_size(item[0]) + encoded_size(item[1])
+                else:
+                    item_size = encoded_size(item)
+
+                if (
+                    available_size is not None
+                    and len(current) > 0
+                    and current_size + item_size + long_size(len(current) + 1)
+                    > available_size
+                ):
+                    msg = self._make_message(current, connection)
+                    msg.add_header_flag(MessageFlags.MULTIPART)
+                    yield msg
+                    nb_sent += 1
+                    current = {} if self.is_dict else []
+                    current_size = 0
+
+                if self.is_dict:
+                    current[item[0]] = item[1]  # type: ignore[call-overload]
+                else:
+                    current.append(item)  # type: ignore[union-attr]
+                current_size += item_size
+        except ETPError as err:
+            if pending is not None:
+                yield pending
+                nb_sent += 1
+            msg_err = err.to_etp_message(
+                msg_id=connection.consume_msg_id(),
+                correlation_id=self.correlation_id,
+            )
+            if msg_err is None:
+                raise err
+            if nb_sent > 0:
+                msg_err.add_header_flag(MessageFlags.MULTIPART)
+            msg_err.set_final_msg(True)
+            yield msg_err
+            return
+
+        if pending is not None:
+            if nb_sent == 0 and len(self.encoded_bodies) == 1:
+                pending.remove_header_flag(MessageFlags.MULTIPART)
+            pending.set_final_msg(True)
+            yield pending
+            return
+        msg = self._make_message(current, connection)
+        if nb_sent > 0:
+            msg.add_header_flag(MessageFlags.MULTIPART)
+        msg.set_final_msg(True)
+        yield msg
+
+
+class ChunkedMessage:
+    """
+    Parts of a chunked message, received so far.
+    Chunk data are appended to a bytearray per blob_id as soon as they are received,
+    the chunk messages themselves are not kept.
+    :ivar protocol: the protocol of the message
+    :ivar referencer: the first referencer message (data objects with a blob_id and no data)
+    :ivar blobs: the data received for each blob_id
+    :ivar size: the count of bytes received in chunks and referencer messages
+    :ivar last_update: the time when the last part has been received
+    """
+
+    __slots__ = ("protocol", "referencer", "blobs", "size", "last_update")
+
+    def __init__(self, protocol: int = 0) -> None:
+        self.protocol = protocol
+        self.referencer: Optional[Message] = None
+        self.blobs: Dict[bytes, bytearray] = {}
+        self.size = 0
+        self.last_update = 0.0
+
+    def add(self, msg: Message) -> None:
+        if msg.is_chunk_msg():
+            blob = self.blobs.get(msg.body.blob_id)  # type: ignore[union-attr]
+            if blob is None:
+                blob = self.blobs[msg.body.blob_id] = bytearray()  # type: ignore[union-attr]
+            blob += msg.body.data  # type: ignore[union-attr]
+            self.size += len(msg.body.data)  # type: ignore[union-attr]
+        elif msg.is_chunk_msg_referencer():
+            # the size of a received message is known, the others are encoded to get it
+            self.size += (
+                msg.encoded_size
+                if msg.encoded_size is not None
+                else len(msg.encode_message())
+            )
+            if self.referencer is None:
+                self.referencer = msg
+            else:
+                self.referencer.body.data_objects = (  # type: ignore[union-attr]
+                    msg.body.data_objects  # type: ignore[union-attr]
+                    if self.referencer.body.data_objects is None  # type: ignore[union-attr]
+                    else concat(
+                        self.referencer.body.data_objects,  # type: ignore[union-attr]
+                        msg.body.data_objects,  # type: ignore[union-attr]
+                    )
+                )
+
+    def build(self) -> Optional[Message]:
+        """
+        Gives the reassembled data to the data objects of the referencer, and returns it.
+        Data objects whose data is received lose their blob_id (no blob_id AND data at the same time,
+        as before the incremental reassembly) : the handlers get complete data objects and do not need it.
+        Returns None if the data of a data object is missing.
+        """
+        if self.referencer is None:
+            return None
+        do_collection = self.referencer.body.data_objects  # type: ignore[union-attr]
+        if isinstance(do_collection, dict):
+            do_collection = do_collection.values()
+        elif not isinstance(do_collection, list):
+            logging.error(
+                f"#etpproto.message@reassemble_chunk : not supported chunckable message data_objects type : {type(do_collection)}"
+            )
+            return self.referencer
+        for data_object in do_collection:
+            blob = self.blobs.pop(data_object.blob_id, None)
+            if blob is None:
+                logging.error(
+                    f"#etpproto.message@reassemble_chunk : no chunk received for blob {data_object.blob_id!r}"
+                )
+                return None
+            data_object.data = bytes(blob)
+            data_object.blob_id = None
+        return self.referencer
+
+
+class ChunkReassembler:
+    """
+    Incremental reassembly of chunked messages (see ETP 3.7.3.2), indexed by the id of the multipart message
+    (the correlation id of its parts, or the message id of the first part).
+    Each message is added when it is received, and the full message is built once the final part is received.
+
+    The messages in progress are bounded (None for no limit) :
+    :ivar max_concurrent_multipart: the maximum count of messages in progress for a protocol (MaxConcurrentMultipart)
+    :ivar timeout_period: the maximum time in seconds between 2 parts of a message (MultipartMessageTimeoutPeriod),
+        see :meth:`evict_expired`
+    :ivar max_bytes: the maximum count of bytes (chunks and referencer messages) kept for all the messages
+        in progress
+    :ivar size: the count of bytes kept for all the messages in progress
+    A message that exceeds a limit is cancelled : its next parts are ignored. The ids of the last
+    MAX_CANCELLED cancelled messages are kept, for at most timeout_period.
+    """
+
+    DEFAULT_MAX_CONCURRENT_MULTIPART: ClassVar[int] = 16
+    DEFAULT_TIMEOUT_PERIOD: ClassVar[float] = 300.0
+    DEFAULT_MAX_BYTES: ClassVar[int] = 1 << 30
+    MAX_CANCELLED: ClassVar[int] = 1024
+
+    def __init__(
+        self,
+        max_concurrent_multipart: Optional[
+            int
+        ] = DEFAULT_MAX_CONCURRENT_MULTIPART,
+        timeout_period: Optional[float] = DEFAULT_TIMEOUT_PERIOD,
+        max_bytes: Optional[int] = DEFAULT_MAX_BYTES,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.max_concurrent_multipart = max_concurrent_multipart
+        self.timeout_period = timeout_period
+        self.max_bytes = max_bytes
+        self.clock = clock
+        self.size = 0
+        # entries are sorted by last update : the oldest ones are the first to expire
+        self._messages: Dict[int, ChunkedMessage] = {}
+        self._cancelled: Dict[int, float] = {}
+
+    def add(self, cache_id: int, msg: Message) -> bool:
+        """
+        Adds a part of a chunked message.
+        Returns False if the part is ignored because its message has been cancelled.
+        Raises a LimitExceededError, and cancels the message, if a limit is exceeded.
+        """
+        from etpproto.error import LimitExceededError
+
+        now = self.clock()
+        if cache_id in self._cancelled:
+            del self._cancelled[cache_id]
+            self._cancel(cache_id, msg, now)
+            return False
+
+        chunked = self._messages.pop(cache_id, None)
+        if chunked is None:
+            if (
+                self.max_concurrent_multipart is not None
+                and self.count(msg.header.protocol)
+                >= self.max_concurrent_multipart
+            ):
+                self._cancel(cache_id, msg, now)
+                raise LimitExceededError()
+            chunked = ChunkedMessage(msg.header.protocol)
+        self._messages[cache_id] = chunked
+        chunked.last_update = now
+
+        previous_size = chunked.size
+        chunked.add(msg)
+        self.size += chunked.size - previous_size
+        if self.max_bytes is not None and self.size > self.max_bytes:
+            self.discard(cache_id)
+            self._cancel(cache_id, msg, now)
+            raise LimitExceededError()
+        return True
+
+    def pop(self, cache_id: int) -> Optional[Message]:
+        """Removes the parts of a message from the reassembler and returns the reassembled message"""
+        chunked = self._messages.pop(cache_id, None)
+        if chunked is None:
+            return None
+        self.size -= chunked.size
+        return chunked.build()
+
+    def discard(self, cache_id: int) -> None:
+        chunked = self._messages.pop(cache_id, None)
+        if chunked is not None:
+            self.size -= chunked.size
+
+    def evict_expired(self) -> List[int]:
+        """
+        Cancels the messages whose last part is older than :attr:`timeout_period`.
+        Returns the ids of the cancelled messages.
+        """
+        if self.timeout_period is None:
+            return []
+        now = self.clock()
+        limit = now - self.timeout_period
+        expired = []
+        for cache_id, chunked in self._messages.items():
+            if chunked.last_update > limit:
+                break
+            expired.append(cache_id)
+        for cache_id in expired:
+            self.discard(cache_id)
+        for cache_id, cancel_time in list(self._cancelled.items()):
+            if cancel_time > limit:
+                break
+            del self._cancelled[cache_id]
+        for cache_id in expired:
+            self._cancelled[cache_id] = now
+        while len(self._cancelled) > self.MAX_CANCELLED:
+            del self._cancelled[next(iter(self._cancelled))]
+        return expired
+
+    def count(self, protocol: int) -> int:
+        """Returns the count of messages in progress for a protocol"""
+        return sum(
+            1 for c in self._messages.values() if c.protocol == protocol
+        )
+
+    def _cancel(self, cache_id: int, msg: Message, now: float) -> None:
+        if not msg.is_final_msg():
+            self._cancelled[cache_id] = now
+            if len(self._cancelled) > self.MAX_CANCELLED:
+                del self._cancelled[next(iter(self._cancelled))]
+
+    def __contains__(self, cache_id: object) -> bool:
+        return cache_id in self._messages
+
+    def __len__(self) -> int:
+        return len(self._messages)
+
+
+def _build_message(
+    header_record: Dict[str, Any],
+    object_class: type,
+    body_record: Any,
+    lazy_validation: bool = False,
+) -> Message:
+    if lazy_validation and not (
+        header_record["messageFlags"] & MessageFlags.MULTIPART != 0
+        and (
+            object_class.__name__.lower() == "chunk"
+            or "data_objects" in object_class.__fields__
+        )
+    ):
+        # chunks and their referencer are validated because they are modified during the reassembly
+        return Message(
+            header_from_record(header_record),
+            RecordView(body_record, object_class),
+        )
+    return Message(
+        mh.MessageHeader.parse_obj(header_record),
+        object_class.parse_obj(body_record),
+    )
+
+
+def _decompressed_body_stream(
+    binary: bytes, body_start: int, max_size: Optional[int] = None
+) -> BytesIO:
+    from etpproto.compression import decompress_body
+
+    return BytesIO(decompress_body(memoryview(binary)[body_start:], max_size))
+
+
 def header_has_flag(header: mh.MessageHeader, flag: MessageFlags):
     return header.message_flags & flag != 0
 
@@ -465,22 +1064,15 @@ def decode_binary_message(
     binary: bytes, dict_map_pro_to_class: ProtocolDict
 ) -> Tuple[mh.MessageHeader, ETPModel]:
     fo = BytesIO(binary)
-    recMH = schemaless_reader(
-        fo=fo,
-        writer_schema=json.loads(mh.avro_schema),
-        return_record_name=True,
-        return_record_name_override=True,
-    )
+    recMH = get_header_codec().read(fo)
     assert isinstance(recMH, dict)
-    object_class = dict_map_pro_to_class[str(recMH.get("protocol", -1))][
-        str(recMH["messageType"])
-    ]
-    object_res = schemaless_reader(
-        fo=fo,
-        writer_schema=json.loads(avro_schema(object_class)),
-        return_record_name=True,
-        return_record_name_override=True,
+    if recMH.get("messageFlags", 0) & MessageFlags.COMPRESSED:
+        fo = _decompressed_body_stream(binary, fo.tell())
+    codec = get_codec(
+        recMH.get("protocol", -1), recMH["messageType"], dict_map_pro_to_class
     )
+    object_class = codec.object_class
+    object_res = codec.read(fo)
 
     logging.debug("decode_binary_message %s", object_res)
 
@@ -490,17 +1082,28 @@ def decode_binary_message(
     )
 
 
+#: size of the non binary part of a Chunk body : blobId (avro fixed, 16 bytes) and final (boolean, 1 byte)
+CHUNK_ENVELOPE_SIZE = 16 + 1
+
+
+def chunk_payload_size(available: int) -> int:
+    """
+    Returns the max number of data bytes of a Chunk, if :param available: bytes remain
+    in the frame for its data (the data is encoded with its length before it)
+    """
+    payload = available - long_size(available)
+    if payload + 1 + long_size(payload + 1) <= available:
+        payload += 1
+    return max(payload, 0)
+
+
 # When calling thins function we are supposed to have only one entry in the data_objects map/list
 def _encode_message_generator_chunk(
     chunkable_msg: Message,
-    encoded_msg_size: int,
     max_bytes_per_msg: int,
     connection,
 ) -> Generator[bytes, None]:
-    from etpproto.error import InternalError
-
-    secure_size = 50  # TODO : ameliorer pour que le chunk fasse vraiment la taille max d'un message (il faudrait connaitre la taille de ce qui n'est pas binaire dans le chunk message)
-    size_of_chunks = max_bytes_per_msg - secure_size
+    from etpproto.error import InternalError, MaxSizeExceededError
 
     data_objs = chunkable_msg.body.data_objects  # type: ignore[attr-defined]
     msg_was_final = chunkable_msg.is_final_msg()
@@ -514,12 +1117,6 @@ def _encode_message_generator_chunk(
     # else : # rien a changer le correlation_id est deja sur le meme que self car c'est celui de la requete recu
 
     if data_objs:  # si on a une list/Map de dataObjects
-        nb_chunks = ceil(
-            encoded_msg_size / size_of_chunks
-        )  # substract 50 for header part (header takes 5?) and non binary part of the chunk message
-        logging.debug(
-            f"Size of chunks : {size_of_chunks} msgS {encoded_msg_size}"
-        )
         # get the chunks class
         chunk_class = get_class_from_protocol_and_name(
             str(chunkable_msg.header.protocol),
@@ -528,115 +1125,96 @@ def _encode_message_generator_chunk(
         )
 
         if chunk_class is not None:
-            lst_chunks = []  # all chunks of all dataObjects
-
             # for blob_id see 3.7.3.2 of the documentation :
             # blob_id is assign to one entire DataObject and is refered in all chunck of this dataObject
+            blobs: List[Tuple[Uuid, memoryview]] = []
+
+            def to_referencer(do: Any) -> Any:
+                blob_id = Uuid(pyUUID.uuid4().bytes)
+                blobs.append((blob_id, memoryview(do.data)))
+                # removing the data from the message when blob_id is populated
+                return do.copy(update={"blob_id": blob_id, "data": b""})
+
+            referencer_objs: Union[list, Dict[Any, Any]] = (
+                {k: to_referencer(do) for k, do in data_objs.items()}
+                if isinstance(data_objs, dict)
+                else [to_referencer(do) for do in data_objs]
+            )
 
-            if isinstance(data_objs, dict):
-                for k, do in data_objs.items():
-                    data = do.data
-                    blob_id = Uuid(pyUUID.uuid4().bytes)
-
-                    # nb_chunks = ceil(len(data)/size_of_chunks)
-                    for c_i in range(nb_chunks):
-                        # create chunk msg
-                        chunk_msg = chunk_class(
-                            blob_id=blob_id,
-                            data=data[
-                                c_i * size_of_chunks : c_i * size_of_chunks
-                                + size_of_chunks
-                            ],
-                            final=False,
-                        )
-                        lst_chunks.append(chunk_msg)
-
-                    if len(lst_chunks) > 0:
-                        lst_chunks[-1].final = True
-                    do.blob_id = blob_id
-                    do.data = b""  # removing the data from the message when blob_id is populated
-            elif isinstance(data_objs, list):
-                # on parcourt la liste des DataObjects
-                # on cree plusieurs chunk pour chacuns
-                for do in data_objs:
-                    data = do.data
-                    blob_id = Uuid(pyUUID.uuid4().bytes)
-
-                    # nb_chunks = ceil(len(data)/size_of_chunks)
-                    logging.debug(f"Nb chunks : {nb_chunks}")
-                    for c_i in range(nb_chunks):
-                        # create chunk msg
-                        chunk_msg = chunk_class(
-                            blob_id=blob_id,
-                            data=data[
-                                c_i * size_of_chunks : c_i * size_of_chunks
-                                + size_of_chunks
-                            ],
-                            final=False,
-                        )
-                        lst_chunks.append(chunk_msg)
-
-                    if len(lst_chunks) > 0:
-                        lst_chunks[-1].final = True
-                    do.blob_id = blob_id
-                    do.data = b""  # removing the data from the message when blob_id is populated
-
-            # chunkable_msg.data_objects = data_objs  # useless ?
-            # send the message
-            chunkable_msg.set_final_msg(False)
-            chunkable_msg.add_header_flag(MessageFlags.MULTIPART)
-            for part in chunkable_msg.encode_message_generator(
+            # send the message (a copy : the data objects of the original message are not modified)
+            referencer_msg = Message(
+                chunkable_msg.header.copy(),
+                chunkable_msg.body.copy(
+                    update={"data_objects": referencer_objs}
+                ),
+            )
+            referencer_msg.set_final_msg(False)
+            referencer_msg.add_header_flag(MessageFlags.MULTIPART)
+            for part in referencer_msg.encode_message_generator(
                 max_bytes_per_msg, connection
             ):
                 yield part
 
-            # send chunks
-            for chunk in lst_chunks[:-1]:
-                current_chunk_msg = Message.get_object_message(
-                    etp_object=chunk,
-                    msg_id=connection.consume_msg_id(),
-                    has_header=True,
-                    correlation_id=correlation_id,
-                    message_flags=MessageFlags.MULTIPART,
-                )
-                if current_chunk_msg is not None:
-                    for (
-                        part
-                    ) in current_chunk_msg.encode_message_generator(
-                        max_bytes_per_msg, connection
-                    ):
-                        yield part
-                else:
-                    raise InternalError(
-                        "@Message : error during chunk creation "
-                        + str(chunkable_msg.header.protocol)
-                    )
-
-            # denier chunk, mettre le final a True
-            final_chunk_msg = Message.get_object_message(
-                etp_object=lst_chunks[-1],
-                msg_id=connection.consume_msg_id(),
-                has_header=True,
-                correlation_id=correlation_id,
-                message_flags=(
-                    MessageFlags.MULTIPART_AND_FINALPART
-                    if msg_was_final
-                    else MessageFlags.MULTIPART
-                ),
+            # send chunks : each chunk is written directly in its frame, from a slice (without copy) of the data.
+            # The chunks of each data object are sized with the exact encoded size of their header and envelope,
+            # so that each frame is filled up to max_bytes_per_msg.
+            header_codec = get_header_codec()
+            chunk_codec = get_codec_for_class(chunk_class)
+            header_record = {
+                "protocol": chunk_codec.protocol,
+                "messageType": chunk_codec.message_type,
+                "correlationId": correlation_id,
+            }
+            fixed_header_size = (
+                long_size(chunk_codec.protocol)
+                + long_size(chunk_codec.message_type)
+                + long_size(correlation_id)
+                # MULTIPART and MULTIPART_AND_FINALPART have the same size
+                + long_size(MessageFlags.MULTIPART)
             )
-            if final_chunk_msg is not None:
-                for part in final_chunk_msg.encode_message_generator(
-                    max_bytes_per_msg, connection
-                ):
-                    yield part
+            for do_i, (blob_id, data) in enumerate(blobs):
+                offset = 0
+                is_last_chunk = False
+                while not is_last_chunk:
+                    msg_id = connection.consume_msg_id()
+                    payload_size = chunk_payload_size(
+                        max_bytes_per_msg
+                        - fixed_header_size
+                        - long_size(msg_id)
+                        - CHUNK_ENVELOPE_SIZE
+                    )
+                    if payload_size == 0 and len(data) > 0:
+                        raise MaxSizeExceededError()
+                    end = min(offset + payload_size, len(data))
+                    is_last_chunk = end == len(data)
+
+                    frame = BytesIO()
+                    header_codec.write(
+                        frame,
+                        {
+                            **header_record,
+                            "messageId": msg_id,
+                            "messageFlags": (
+                                MessageFlags.MULTIPART_AND_FINALPART
+                                if msg_was_final
+                                and is_last_chunk
+                                and do_i == len(blobs) - 1
+                                else MessageFlags.MULTIPART
+                            ),
+                        },
+                    )
+                    chunk_codec.write(
+                        frame,
+                        {
+                            "blobId": blob_id,
+                            "data": data[offset:end],
+                            "final": is_last_chunk,
+                        },
+                    )
+                    offset = end
+                    yield frame.getvalue()
 
                 # TODO : potentielle erreur de MultipartCancelledError si le nb de reponse depasse le nombre max
-            else:
-                raise InternalError(
-                    "@Message : error during chunk creation "
-                    + str(chunkable_msg.header.protocol)
-                )
-
         else:
             raise InternalError(
                 "@Message : No chunck class found for protocol "
@@ -0,0 +1,636 @@
+# Copyright (c) 2022-2023 Geosiris.
+# SPDX-License-Identifier: Apache-2.0
+"""
+NumPy encoding of the arrays of the DataArray protocol.
+
+If numpy is installed and a codec registry uses it (``CodecRegistry(use_numpy=True)`` given to a connection,
+or the process wide ``codec_registry.use_numpy = True``, see etpproto.codec), the messages of the DataArray
+protocol are encoded and decoded by a :class:`NumpyMessageCodec` : the values of the ArrayOfBoolean, ArrayOfInt,
+ArrayOfLong, ArrayOfFloat and ArrayOfDouble records are read as numpy arrays, and written from numpy arrays
+(or lists) without converting each value to a python object. Boolean, float and double values are copied as
+they are (avro encodes them in little-endian fixed width), int and long values are zig-zag varints and are
+converted with vectorized numpy operations. The rest of the messages (identifiers, dimensions, custom data...)
+is encoded and decoded by fastavro.
+
+Decoded arrays are copies, or read-only views of the received message with ``CodecRegistry(use_numpy=True,
+numpy_views=True)`` (no copy, but an array keeps the whole message in memory). The handlers receive them in the models,
+e.g. ``msg.data_arrays["0"].data.item.values`` is a numpy array. Use :func:`to_any_array` to build
+an AnyArray from a numpy array, and :func:`to_numpy` to get the values of an AnyArray as a numpy array.
+"""
+
+import importlib.util
+from collections.abc import Mapping
+from dataclasses import dataclass, field
+from functools import lru_cache
+from io import BytesIO
+from typing import IO, Any, Dict, List, Optional, Set, Tuple
+
+from etptypes import ETPModel
+from etptypes.energistics.etp.v12.datatypes.any_array import AnyArray
+from etptypes.energistics.etp.v12.datatypes.array_of_boolean import (
+    ArrayOfBoolean,
+)
+from etptypes.energistics.etp.v12.datatypes.array_of_double import (
+    ArrayOfDouble,
+)
+from etptypes.energistics.etp.v12.datatypes.array_of_float import ArrayOfFloat
+from etptypes.energistics.etp.v12.datatypes.array_of_int import ArrayOfInt
+from etptypes.energistics.etp.v12.datatypes.array_of_long import ArrayOfLong
+from fastavro import parse_schema, schemaless_reader, schemaless_writer
+
+from etpproto.codec import MessageCodec, ModelRecord
+from etpproto.error import NotSupportedError
+
+
+class _LazyNumpy:
+    """
+    The numpy module, imported the first time one of its attributes is used :
+    the messages that do not need numpy are encoded and decoded without importing it.
+    """
+
+    def __getattr__(self, name: str) -> Any:
+        import numpy
+
+        # the next lookups find the attributes of numpy without calling __getattr__
+        self.__dict__.update(vars(numpy))
+        return getattr(numpy, name)
+
+
+#: the numpy module (imported lazily), used by the numpy features of etpproto
+np: Any = _LazyNumpy()
+
+#: protocols whose messages are encoded with numpy arrays : DataArray (9)
+NUMPY_PROTOCOLS = {9}
+
+#: numpy dtype of the avro array items that are read as numpy arrays
+ITEM_DTYPES = {
+    "boolean": "?",
+    "int": "<i4",
+    "long": "<i8",
+    "float": "<f4",
+    "double": "<f8",
+}
+
+#: records whose "values" are read as numpy arrays, and the avro type of their values
+NUMPY_ARRAY_ITEMS = {
+    ArrayOfBoolean.__name__: "boolean",
+    ArrayOfInt.__name__: "int",
+    ArrayOfLong.__name__: "long",
+    ArrayOfFloat.__name__: "float",
+    ArrayOfDouble.__name__: "double",
+}
+
+_DTYPE_ARRAY_CLASSES = {
+    "bool": ArrayOfBoolean,
+    "int8": ArrayOfInt,
+    "int16": ArrayOfInt,
+    "int32": ArrayOfInt,
+    "uint8": ArrayOfInt,
+    "uint16": ArrayOfInt,
+    "int64": ArrayOfLong,
+    "uint32": ArrayOfLong,
+    "float32": ArrayOfFloat,
+    "float64": ArrayOfDouble,
+}
+
+_NAMED_TYPES = {"record", "enum", "fixed"}
+
+#: {name : schema} of the named types (records, enums and fixed) of a schema
+NamedTypes = Dict[str, Dict[str, Any]]
+
+
+@lru_cache(maxsize=None)
+def is_available() -> bool:
+    """True if numpy is installed (without importing it)"""
+    return importlib.util.find_spec("numpy") is not None
+
+
+def to_any_array(values: Any) -> AnyArray:
+    """
+    Builds an AnyArray from a numpy array (flattened), without converting its values to python objects.
+    The ArrayOf* type is chosen from the dtype (e.g. float32 -> ArrayOfFloat, int64 -> ArrayOfLong).
+    Raises a NotSupportedError if the dtype has no ArrayOf* type.
+    """
+    values = np.ravel(values)
+    array_class = _DTYPE_ARRAY_CLASSES.get(values.dtype.name)
+    if array_class is None:
+        # e.g. uint64, strings or objects
+        raise NotSupportedError()
+    return AnyArray.construct(item=array_class.construct(values=values))
+
+
+def to_numpy(any_array: Any) -> Any:
+    """Returns the values of an AnyArray (or of an ArrayOf* record) as a numpy array"""
+    item = getattr(any_array, "item", any_array)
+    if isinstance(item, (bytes, bytearray, memoryview)):
+        return np.frombuffer(item, dtype=np.uint8)
+    item_type = NUMPY_ARRAY_ITEMS.get(type(item).__name__)
+    if item_type is None:
+        return np.asarray(item.values)
+    return np.asarray(item.values, dtype=ITEM_DTYPES[item_type])
+
+
+# Varints
+
+
+def encode_long(value: int) -> bytes:
+    value = (value << 1) ^ (value >> 63)
+    result = bytearray()
+    while value > 0x7F:
+        result.append((value & 0x7F) | 0x80)
+        value >>= 7
+    result.append(value)
+    return bytes(result)
+
+
+def decode_long(buffer: Any, pos: int) -> Tuple[int, int]:
+    """Reads a zig-zag varint at :param pos:, returns its value and the position after it"""
+    value = 0
+    shift = 0
+    while True:
+        b = buffer[pos]
+        pos += 1
+        value |= (b & 0x7F) << shift
+        if b < 0x80:
+            return (value >> 1) ^ -(value & 1), pos
+        shift += 7
+
+
+def varint_groups(values: Any) -> Tuple[Any, Any]:
+    """
+    Returns the zig-zag varints of an array of integers as a (len(values), max size) matrix of bytes,
+    and the mask of the bytes of each varint in this matrix
+    """
+    values = np.asarray(values, dtype=np.int64)
+    zigzag = ((values << 1) ^ (values >> 63)).view(np.uint64)
+    # count of 7 bits groups of each value
+    sizes = np.ones(len(zigzag), dtype=np.intp)
+    rest = zigzag >> np.uint64(7)
+    while rest.any():
+        sizes += rest != 0
+        rest >>= np.uint64(7)
+    max_size = int(sizes.max()) if len(sizes) > 0 else 1
+    shifts = np.arange(max_size, dtype=np.uint64) * np.uint64(7)
+    groups = ((zigzag[:, None] >> shifts) & np.uint64(0x7F)).astype(np.uint8)
+    group_index = np.arange(max_size)
+    groups[group_index < sizes[:, None] - 1] |= 0x80
+    return groups, group_index < sizes[:, None]
+
+
+def encode_varints(values: Any) -> bytes:
+    """Encodes an array of integers as consecutive zig-zag varints"""
+    if len(values) == 0:
+        return b""
+    groups, mask = varint_groups(values)
+    return groups[mask].tobytes()
+
+
+def decode_varints(buffer: Any, pos: int, count: int) -> Tuple[Any, int]:
+    """Reads :param count: consecutive zig-zag varints, returns them (int64 array) and the position after them"""
+    if count == 0:
+        return np.empty(0, dtype=np.int64), pos
+    # a varint takes at most 10 bytes
+    raw = np.frombuffer(
+        buffer,
+        dtype=np.uint8,
+        count=min(len(buffer) - pos, count * 10),
+        offset=pos,
+    )
+    ends = np.flatnonzero(raw < 0x80)[:count]
+    if len(ends) < count:
+        raise EOFError("Truncated avro array")
+    size = int(ends[-1]) + 1
+    starts = np.empty(count, dtype=np.intp)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    group_index = np.arange(size) - np.repeat(starts, ends - starts + 1)
+    groups = (raw[:size] & 0x7F).astype(np.uint64) << (
+        group_index.astype(np.uint64) * np.uint64(7)
+    )
+    zigzag = np.bitwise_or.reduceat(groups, starts)
+    values = (zigzag >> np.uint64(1)).astype(np.int64) ^ -(
+        zigzag & np.uint64(1)
+    ).astype(np.int64)
+    return values, pos + size
+
+
+# Numeric arrays
+
+
+def write_array(fo: IO, item_type: str, values: Any) -> None:
+    """Writes an avro array of boolean/int/long/float/double from a numpy array or a sequence"""
+    values = np.ravel(np.asarray(values))
+    if len(values) > 0:
+        fo.write(encode_long(len(values)))
+        if item_type in ("int", "long"):
+            fo.write(encode_varints(values))
+        else:
+            fo.write(
+                np.ascontiguousarray(values, dtype=ITEM_DTYPES[item_type]).data
+            )
+    fo.write(b"\x00")
+
+
+def _read_block_count(buffer: Any, pos: int) -> Tuple[int, int]:
+    count, pos = decode_long(buffer, pos)
+    if count < 0:
+        # the block size (in bytes) is given before the items
+        count = -count
+        _, pos = decode_long(buffer, pos)
+    return count, pos
+
+
+def read_array(
+    buffer: Any, pos: int, item_type: str, views: bool = False
+) -> Tuple[Any, int]:
+    """
+    Reads an avro array of boolean/int/long/float/double as a numpy array.
+    If :param views: is True, the boolean, float and double values are a read-only view of :param buffer:
+    (if it is a single block), else they are copied.
+    """
+    dtype = np.dtype(ITEM_DTYPES[item_type])
+    blocks = []
+    while True:
+        count, pos = _read_block_count(buffer, pos)
+        if count == 0:
+            break
+        if item_type in ("int", "long"):
+            block, pos = decode_varints(buffer, pos, count)
+            block = block.astype(dtype, copy=False)
+        else:
+            block = np.frombuffer(buffer, dtype=dtype, count=count, offset=pos)
+            if not views:
+                block = block.copy()
+            pos += count * dtype.itemsize
+        blocks.append(block)
+    if len(blocks) == 0:
+        return np.empty(0, dtype=dtype), pos
+    if len(blocks) == 1:
+        return blocks[0], pos
+    return np.concatenate(blocks), pos
+
+
+# Avro encoding : fastavro, except for the values of the ArrayOf* records
+
+
+def collect_named_types(
+    schema: Any, names: Optional[NamedTypes] = None
+) -> NamedTypes:
+    """Returns the named types of the schema, by full name and by name"""
+    if names is None:
+        names = {}
+    if isinstance(schema, list):
+        for branch in schema:
+            collect_named_types(branch, names)
+    elif isinstance(schema, dict):
+        schema_type = schema["type"]
+        if schema_type in _NAMED_TYPES:
+            names[schema["name"]] = schema
+            if "namespace" in schema:
+                names[f"{schema['namespace']}.{schema['name']}"] = schema
+            for f in schema.get("fields", []):
+                collect_named_types(f["type"], names)
+        elif schema_type == "array":
+            collect_named_types(schema["items"], names)
+        elif schema_type == "map":
+            collect_named_types(schema["values"], names)
+        elif isinstance(schema_type, (dict, list)):
+            collect_named_types(schema_type, names)
+    return names
+
+
+def _resolve(schema: Any, names: NamedTypes) -> Any:
+    if isinstance(schema, str):
+        return names.get(schema, schema)
+    if isinstance(schema, dict) and isinstance(schema["type"], (dict, list)):
+        return _resolve(schema["type"], names)
+    if isinstance(schema, dict) and schema["type"] in names:
+        return names[schema["type"]]
+    return schema
+
+
+def _type_name(schema: Any) -> str:
+    if isinstance(schema, list):
+        return "union"
+    return schema if isinstance(schema, str) else schema["type"]
+
+
+def _full_name(schema: Dict[str, Any]) -> str:
+    if "namespace" in schema:
+        return f"{schema['namespace']}.{schema['name']}"
+    return schema["name"]
+
+
+def _field_value(record: Any, name: str, default: Any = None) -> Any:
+    if isinstance(record, Mapping):
+        return record.get(name, default)
+    return getattr(record, name, default)
+
+
+def has_numpy_values(
+    schema: Any, names: NamedTypes, seen: Optional[Set[str]] = None
+) -> bool:
+    """True if the values of a part of a schema contain ArrayOf* records read as numpy arrays"""
+    schema = _resolve(schema, names)
+    schema_type = _type_name(schema)
+    if schema_type == "record":
+        if schema["name"] in NUMPY_ARRAY_ITEMS:
+            return True
+        seen = set() if seen is None else seen
+        if schema["name"] in seen:
+            return False
+        seen.add(schema["name"])
+        return any(
+            has_numpy_values(f["type"], names, seen) for f in schema["fields"]
+        )
+    if schema_type == "array":
+        return has_numpy_values(schema["items"], names, seen)
+    if schema_type == "map":
+        return has_numpy_values(schema["values"], names, seen)
+    if schema_type == "union":
+        return any(has_numpy_values(b, names, seen) for b in schema)
+    return False
+
+
+class _Node:
+    """Writes and reads the values of a part of a schema"""
+
+    def write(self, fo: IO, value: Any) -> None:
+        raise NotImplementedError()
+
+    def read(self, fo: BytesIO, buffer: Any) -> Any:
+        """Reads a value at the position of :param fo:, whose content is :param buffer:"""
+        raise NotImplementedError()
+
+
+class _FastavroNode(_Node):
+    """
+    A part of the schema without numpy arrays : its values are written and read by fastavro.
+    The schema is the single field of a record (that has the same encoding), so that fastavro gets a parsed
+    schema with the named types of the message, even for a union or a reference to a named type.
+    """
+
+    def __init__(self, schema: Any, fastavro_names: Dict[str, Any]) -> None:
+        self.parsed_schema = parse_schema(
+            {
+                "type": "record",
+                "name": "NumpyCodecValue",
+                "fields": [{"name": "value", "type": schema}],
+            },
+            named_schemas=dict(fastavro_names),
+        )
+
+    def write(self, fo: IO, value: Any) -> None:
+        schemaless_writer(fo, self.parsed_schema, {"value": value})
+
+    def read(self, fo: BytesIO, buffer: Any) -> Any:
+        return schemaless_reader(
+            fo,
+            self.parsed_schema,
+            None,
+            return_record_name=True,
+            return_record_name_override=True,
+        )["value"]
+
+
+class _ValuesNode(_Node):
+    """An ArrayOf* record, whose values are written from and read as a numpy array"""
+
+    def __init__(self, item_type: str, views: bool) -> None:
+        self.item_type = item_type
+        self.views = views
+
+    def write(self, fo: IO, value: Any) -> None:
+        write_array(fo, self.item_type, _field_value(value, "values"))
+
+    def read(self, fo: BytesIO, buffer: Any) -> Any:
+        values, end = read_array(
+            buffer, fo.tell(), self.item_type, views=self.views
+        )
+        fo.seek(end)
+        return {"values": values}
+
+
+class _RecordNode(_Node):
+    def __init__(self, fields: List[Tuple[str, Any, _Node]]) -> None:
+        self.fields = fields
+
+    def write(self, fo: IO, value: Any) -> None:
+        for name, default, node in self.fields:
+            node.write(fo, _field_value(value, name, default))
+
+    def read(self, fo: BytesIO, buffer: Any) -> Any:
+        return {name: node.read(fo, buffer) for name, _, node in self.fields}
+
+
+def _read_count(fo: BytesIO, buffer: Any) -> int:
+    count, pos = _read_block_count(buffer, fo.tell())
+    fo.seek(pos)
+    return count
+
+
+class _ArrayNode(_Node):
+    def __init__(self, items: _Node) -> None:
+        self.items = items
+
+    def write(self, fo: IO, value: Any) -> None:
+        if len(value) > 0:
+            fo.write(encode_long(len(value)))
+            for item in value:
+                self.items.write(fo, item)
+        fo.write(b"\x00")
+
+    def read(self, fo: BytesIO, buffer: Any) -> Any:
+        items = []
+        count = _read_count(fo, buffer)
+        while count > 0:
+            items.extend(self.items.read(fo, buffer) for _ in range(count))
+            count = _read_count(fo, buffer)
+        return items
+
+
+class _MapNode(_Node):
+    def __init__(self, values: _Node) -> None:
+        self.values = values
+
+    def write(self, fo: IO, value: Any) -> None:
+        if len(value) > 0:
+            fo.write(encode_long(len(value)))
+            for k, v in value.items():
+                key = k.encode("utf-8")
+                fo.write(encode_long(len(key)))
+                fo.write(key)
+                self.values.write(fo, v)
+        fo.write(b"\x00")
+
+    def read(self, fo: BytesIO, buffer: Any) -> Any:
+        entries = {}
+        count = _read_count(fo, buffer)
+        while count > 0:
+            for _ in range(count):
+                size, pos = decode_long(buffer, fo.tell())
+                fo.seek(pos + size)
+                key = bytes(buffer[pos : pos + size]).decode("utf-8")
+                entries[key] = self.values.read(fo, buffer)
+            count = _read_count(fo, buffer)
+        return entries
+
+
+class _UnionNode(_Node):
+    """
+    A union with ArrayOf* records (e.g. AnyArray.item, DataValue.item) : the branches with numpy arrays
+    are written and read by their node, the other values by fastavro.
+    """
+
+    def __init__(
+        self,
+        others: _Node,
+        branches: Dict[int, Tuple[str, str, _Node]],
+        with_name: bool,
+    ) -> None:
+        self.others = others
+        #: {index : (name, full name, node)} of the branches with numpy arrays
+        self.branches = branches
+        #: True if the records are read with their name, as fastavro does with return_record_name_override
+        self.with_name = with_name
+
+    def _branch(self, value: Any) -> Optional[Tuple[int, _Node, Any]]:
+        if (
+            isinstance(value, tuple)
+            and len(value) == 2
+            and isinstance(value[0], str)
+        ):
+            # (record name, record) as given by the dict() of the models with unions
+            name, value = value
+        elif isinstance(value, ModelRecord):
+            name = type(value.model).__name__
+        elif isinstance(value, ETPModel):
+            name = type(value).__name__
+        else:
+            return None
+        for index, (short_name, full_name, node) in self.branches.items():
+            if name in (short_name, full_name):
+                return index, node, value
+        return None
+
+    def write(self, fo: IO, value: Any) -> None:
+        branch = self._branch(value)
+        if branch is None:
+            self.others.write(fo, value)
+        else:
+            index, node, value = branch
+            fo.write(encode_long(index))
+            node.write(fo, value)
+
+    def read(self, fo: BytesIO, buffer: Any) -> Any:
+        start = fo.tell()
+        index, pos = decode_long(buffer, start)
+        branch = self.branches.get(index)
+        if branch is None:
+            fo.seek(start)
+            return self.others.read(fo, buffer)
+        _, full_name, node = branch
+        fo.seek(pos)
+        value = node.read(fo, buffer)
+        return (full_name, value) if self.with_name else value
+
+
+def compile_schema(
+    schema: Any,
+    names: NamedTypes,
+    fastavro_names: Dict[str, Any],
+    views: bool = False,
+) -> _Node:
+    """
+    Returns the node that writes and reads the values of :param schema: : only the records, arrays, maps and unions
+    that lead to ArrayOf* records are walked in python, the other parts of the schema are given to fastavro.
+    :param fastavro_names: the named types parsed by fastavro (see fastavro.parse_schema)
+    """
+    if not has_numpy_values(schema, names):
+        return _FastavroNode(schema, fastavro_names)
+    schema = _resolve(schema, names)
+    schema_type = _type_name(schema)
+    if schema_type == "record":
+        if schema["name"] in NUMPY_ARRAY_ITEMS:
+            return _ValuesNode(NUMPY_ARRAY_ITEMS[schema["name"]], views)
+        return _RecordNode(
+            [
+                (
+                    f["name"],
+                    f.get("default"),
+                    compile_schema(f["type"], names, fastavro_names, views),
+                )
+                for f in schema["fields"]
+            ]
+        )
+    if schema_type == "array":
+        return _ArrayNode(
+            compile_schema(schema["items"], names, fastavro_names, views)
+        )
+    if schema_type == "map":
+        return _MapNode(
+            compile_schema(schema["values"], names, fastavro_names, views)
+        )
+    # a union
+    branches = [_resolve(b, names) for b in schema]
+    return _UnionNode(
+        _FastavroNode(schema, fastavro_names),
+        {
+            i: (
+                branch["name"],
+                _full_name(branch),
+                compile_schema(branch, names, fastavro_names, views),
+            )
+            for i, branch in enumerate(branches)
+            if has_numpy_values(branch, names)
+        },
+        sum(1 for b in branches if _type_name(b) == "record") > 1,
+    )
+
+
+@dataclass(frozen=True)
+class NumpyMessageCodec(MessageCodec):
+    """
+    MessageCodec that writes and reads the values of the ArrayOf* records as numpy arrays.
+    The rest of the message is written and read by fastavro (see :func:`compile_schema`).
+    :ivar views: if True, the decoded boolean, float and double arrays are read-only views of the received
+        message (they keep it in memory), else they are copies
+    :ivar root: the node of the message schema
+    """
+
+    views: bool = False
+    root: _Node = field(default_factory=_Node, repr=False)
+
+    def write(self, fo: IO, record: Any) -> None:
+        self.root.write(fo, record)
+
+    def read(self, fo: IO) -> Any:
+        if not isinstance(fo, BytesIO):
+            fo = BytesIO(fo.read())
+        # the buffer of a BytesIO created from bytes is shared with it : the views do not copy the message
+        return self.root.read(fo, fo.getvalue())
+
+
+def numpy_codec(codec: MessageCodec, views: bool = False) -> MessageCodec:
+    """
+    Returns a NumpyMessageCodec for the messages of the :data:`NUMPY_PROTOCOLS` if numpy is installed,
+    else :param codec:. The arrays are read as views of the messages if :param views: is True.
+    """
+    if codec.protocol not in NUMPY_PROTOCOLS or not is_available():
+        return codec
+    fastavro_names: Dict[str, Any] = {}
+    parse_schema(codec.schema, named_schemas=fastavro_names)
+    return NumpyMessageCodec(
+        object_class=codec.object_class,
+        protocol=codec.protocol,
+        message_type=codec.message_type,
+        schema=codec.schema,
+        parsed_schema=codec.parsed_schema,
+        views=views,
+        root=compile_schema(
+            codec.schema,
+            collect_named_types(codec.schema),
+            fastavro_names,
+            views,
+        ),
+    )
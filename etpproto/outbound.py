@@ -0,0 +1,155 @@
+# Copyright (c) 2022-2023 Geosiris.
+# SPDX-License-Identifier: Apache-2.0
+"""
+Bounded queue of the binary messages to send on a connection (see ETPConnection.outbound_queue).
+
+The queue is measured in bytes and in messages. Above its high watermark, the producers that wait with
+:meth:`OutboundQueue.wait_writable` (e.g. the handlers answering the requests) are suspended until the queue is
+drained below its low watermark, and a ProtocolException with a BackPressureWarningError is sent to the peer.
+A message that would exceed the limits of the queue is refused with a BackPressureLimitExceededError (also sent
+to the peer), unless it is forced.
+"""
+
+import asyncio
+import time
+from dataclasses import dataclass
+from typing import Any, Callable, Iterable, Optional
+
+from etpproto.error import (
+    BackPressureLimitExceededError,
+    BackPressureWarningError,
+    ETPError,
+)
+
+
+@dataclass
+class OutboundStats:
+    """
+    :ivar messages: number of messages put in the queue
+    :ivar bytes: number of bytes put in the queue
+    :ivar peak_messages: max number of messages in the queue
+    :ivar peak_bytes: max number of bytes in the queue
+    :ivar warnings: number of BackPressureWarnings sent
+    :ivar refused: number of messages refused because of the limits of the queue
+    :ivar suspensions: number of times a producer has been suspended
+    :ivar suspended_time: total time (in seconds) the producers have been suspended
+    """
+
+    messages: int = 0
+    bytes: int = 0
+    peak_messages: int = 0
+    peak_bytes: int = 0
+    warnings: int = 0
+    refused: int = 0
+    suspensions: int = 0
+    suspended_time: float = 0.0
+
+
+class OutboundQueue(asyncio.Queue):
+    """
+    asyncio.Queue of binary messages, bounded by :param max_bytes: and :param max_messages: (None for no limit).
+    The high and low watermarks are fractions of these limits.
+    :param on_back_pressure: returns the binary messages that notify the peer of an error
+        (BackPressureWarningError or BackPressureLimitExceededError), they are put in the queue at once
+    :ivar nbytes: number of bytes in the queue
+    :ivar stats: the statistics of the queue
+    """
+
+    def __init__(
+        self,
+        max_bytes: Optional[int] = None,
+        max_messages: Optional[int] = None,
+        high_watermark: float = 0.75,
+        low_watermark: float = 0.25,
+        on_back_pressure: Optional[
+            Callable[[ETPError], Iterable[bytes]]
+        ] = None,
+    ) -> None:
+        if not 0 <= low_watermark <= high_watermark <= 1:
+            raise ValueError("0 <= low_watermark <= high_watermark <= 1")
+        super().__init__()
+        self.max_bytes = max_bytes
+        self.max_messages = max_messages
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.on_back_pressure = on_back_pressure
+        self.stats = OutboundStats()
+        self._paused = False
+        self._limit_reported = False
+        self._writable = asyncio.Event()
+        self._writable.set()
+
+    def _init(self, maxsize: int) -> None:
+        super()._init(maxsize)
+        self.nbytes = 0
+
+    def _put(self, item: Any) -> None:
+        super()._put(item)
+        self.nbytes += len(item)
+
+    def _get(self) -> Any:
+        item = super()._get()
+        self.nbytes -= len(item)
+        self._resume_if_drained()
+        return item
+
+    def _resume_if_drained(self) -> None:
+        if self._paused and not self._above(self.low_watermark):
+            self._paused = self._limit_reported = False
+            self._writable.set()
+
+    def _above(self, fraction: float, nbytes: int = 0, nb: int = 0) -> bool:
+        return (
+            self.max_bytes is not None
+            and self.nbytes + nbytes > fraction * self.max_bytes
+        ) or (
+            self.max_messages is not None
+            and self.qsize() + nb > fraction * self.max_messages
+        )
+
+    def put_nowait(self, item: Any, force: bool = False) -> None:
+        """
+        Puts a binary message in the queue. Raises a BackPressureLimitExceededError if the queue is full,
+        unless :param force: is True (e.g. for a message that already has its message id).
+        """
+        if not force and self._above(1, len(item), 1):
+            self.stats.refused += 1
+            if not self._limit_reported:
+                self._limit_reported = True
+                self._pause(BackPressureLimitExceededError())
+                # a message larger than the limits is refused, the producers are not suspended by it
+                self._resume_if_drained()
+            raise BackPressureLimitExceededError()
+        super().put_nowait(item)
+        self.stats.messages += 1
+        self.stats.bytes += len(item)
+        self.stats.peak_messages = max(self.stats.peak_messages, self.qsize())
+        self.stats.peak_bytes = max(self.stats.peak_bytes, self.nbytes)
+        if not self._paused and self._above(self.high_watermark):
+            self._pause(BackPressureWarningError())
+
+    def _pause(self, error: ETPError) -> None:
+        self._paused = True
+        self._writable.clear()
+        if isinstance(error, BackPressureWarningError):
+            self.stats.warnings += 1
+        if self.on_back_pressure is not None:
+            for frame in self.on_back_pressure(error):
+                super().put_nowait(frame)
+
+    def is_writable(self) -> bool:
+        """False from the high watermark until the queue is drained below the low watermark"""
+        return not self._paused
+
+    async def wait_writable(self) -> None:
+        """Waits until the queue is below its high watermark (or drained below its low watermark)"""
+        if self._paused:
+            self.stats.suspensions += 1
+            start = time.monotonic()
+            await self._writable.wait()
+            self.stats.suspended_time += time.monotonic() - start
+
+    async def put(self, item: Any) -> None:
+        """Waits until the queue is writable, and puts a binary message in it"""
+        await self.wait_writable()
+        self.put_nowait(item, force=True)
@@ -0,0 +1,187 @@
+# Copyright (c) 2022-2023 Geosiris.
+# SPDX-License-Identifier: Apache-2.0
+"""
+Lazy table of the ETP message classes, indexed by protocol and message type.
+
+The modules of etptypes are imported only when one of their messages is needed.
+The location of each message class is read from an index file (see :func:`write_protocol_index`)
+generated for the installed etptypes version. If the index does not exist or was generated
+for another etptypes version, the sources of etptypes are scanned (without importing them).
+
+Regenerate the index with :
+    python -m etpproto.protocol_index
+"""
+
+import ast
+import importlib
+import json
+import logging
+import os
+import re
+from collections.abc import Mapping
+from typing import Dict, Iterator, Optional, Type, Union
+
+import etptypes
+from etptypes import ETPModel
+
+#: Path of the prebuilt index shipped with etpproto
+INDEX_PATH = os.path.join(os.path.dirname(__file__), "protocol_index.json")
+
+PROTOCOL_PACKAGE = "etptypes.energistics.etp.v12.protocol"
+
+#: {protocol: {messageType: "module:ClassName"}}
+ProtocolIndex = Dict[str, Dict[str, str]]
+
+_schema_pattern = re.compile(
+    r"avro_schema\s*:[^=]*=\s*\(?\s*('(?:[^'\\]|\\.)*')", re.MULTILINE
+)
+
+
+def scan_protocol_classes() -> ProtocolIndex:
+    """Builds the index by reading the avro schemas in the sources of etptypes protocol modules"""
+    index: ProtocolIndex = {}
+    package_dir = os.path.join(
+        os.path.dirname(etptypes.__file__), *PROTOCOL_PACKAGE.split(".")[1:]
+    )
+    for dirpath, dirnames, filenames in os.walk(package_dir):
+        dirnames[:] = sorted(d for d in dirnames if d != "__pycache__")
+        for filename in sorted(filenames):
+            if not filename.endswith(".py") or filename == "__init__.py":
+                continue
+            with open(
+                os.path.join(dirpath, filename), encoding="utf-8"
+            ) as source:
+                found = _schema_pattern.search(source.read())
+            if found is None:
+                continue
+            try:
+                schema = json.loads(ast.literal_eval(found.group(1)))
+                protocol = schema["protocol"]
+                message_type = schema["messageType"]
+            except Exception:
+                continue
+            sub_packages = [
+                p
+                for p in os.path.relpath(dirpath, package_dir).split(os.sep)
+                if p != os.curdir
+            ]
+            module = ".".join(
+                [PROTOCOL_PACKAGE] + sub_packages + [filename[:-3]]
+            )
+            index.setdefault(str(protocol), {})[
+                str(message_type)
+            ] = f"{module}:{schema['name']}"
+    return index
+
+
+def load_protocol_index(path: str = INDEX_PATH) -> Optional[ProtocolIndex]:
+    """Returns the index saved in :param path:, or None if it does not exist or is not for the installed etptypes"""
+    try:
+        with open(path, encoding="utf-8") as f:
+            content = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if content.get("etptypes_version") != etptypes.__version__:
+        logging.debug(
+            f"@protocol_index : {path} is for etptypes {content.get('etptypes_version')}, not {etptypes.__version__}"
+        )
+        return None
+    return content["protocols"]
+
+
+def write_protocol_index(path: str = INDEX_PATH) -> ProtocolIndex:
+    """Scans the installed etptypes and saves the index in :param path:"""
+    index = scan_protocol_classes()
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(
+            {"etptypes_version": etptypes.__version__, "protocols": index},
+            f,
+            indent=1,
+            sort_keys=True,
+        )
+        f.write("\n")
+    return index
+
+
+class MessageTable(Mapping):
+    """
+    Read-only mapping {messageType: ETP class} of a protocol.
+    Each class is imported the first time it is accessed.
+    """
+
+    def __init__(self, paths: Dict[str, str]):
+        self.paths = paths
+        self._classes: Dict[str, Type[ETPModel]] = {}
+
+    def __getitem__(self, message_type: Union[str, int]) -> Type[ETPModel]:
+        key = str(message_type)
+        cls = self._classes.get(key)
+        if cls is None:
+            module, _, name = self.paths[key].partition(":")
+            cls = getattr(importlib.import_module(module), name)
+            self._classes[key] = cls
+        return cls
+
+    def find(self, name: str) -> Optional[Type[ETPModel]]:
+        """Returns the class named :param name: (case insensitive), importing only this class"""
+        name = name.lower()
+        for message_type, path in self.paths.items():
+            if path.rpartition(":")[2].lower() == name:
+                return self[message_type]
+        return None
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.paths)
+
+    def __len__(self) -> int:
+        return len(self.paths)
+
+    def __contains__(self, message_type: object) -> bool:
+        return str(message_type) in self.paths
+
+
+class ProtocolTable(Mapping):
+    """
+    Read-only mapping {protocol: {messageType: ETP class}}, used as the ProtocolDict of etpproto.
+    The index is loaded the first time the table is used, from :param index_path: if it exists
+    for the installed etptypes version, else by scanning etptypes.
+    """
+
+    def __init__(self, index_path: Optional[str] = INDEX_PATH):
+        self.index_path = index_path
+        self._protocols: Optional[Dict[str, MessageTable]] = None
+
+    @property
+    def protocols(self) -> Dict[str, MessageTable]:
+        if self._protocols is None:
+            index = (
+                load_protocol_index(self.index_path)
+                if self.index_path is not None
+                else None
+            )
+            if index is None:
+                index = scan_protocol_classes()
+            self._protocols = {
+                protocol: MessageTable(paths)
+                for protocol, paths in index.items()
+            }
+        return self._protocols
+
+    def __getitem__(self, protocol: Union[str, int]) -> MessageTable:
+        return self.protocols[str(protocol)]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.protocols)
+
+    def __len__(self) -> int:
+        return len(self.protocols)
+
+    def __contains__(self, protocol: object) -> bool:
+        return str(protocol) in self.protocols
+
+
+if __name__ == "__main__":
+    written = write_protocol_index()
+    print(
+        f"{INDEX_PATH} : {sum(len(m) for m in written.values())} messages for etptypes {etptypes.__version__}"
+    )
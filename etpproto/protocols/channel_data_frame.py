@@ -26,7 +26,7 @@ from etptypes.energistics.etp.v12.protocol.channel_data_frame.get_frame_response
 from etpproto.client_info import ClientInfo
 from etpproto.error import InvalidMessageTypeError, NotSupportedError
 from etpproto.messages import Message
-from etpproto.utils import snake_case
+from etpproto.utils import get_handler_method, get_object_class
 
 
 class ChannelDataFrameHandler(Protocol):
@@ -96,9 +96,7 @@ class ChannelDataFrameHandler(Protocol):
         msg_header: MessageHeader,
         client_info: Union[None, ClientInfo] = None,
     ) -> AsyncGenerator[Optional[Message], None]:
-        handling_func = getattr(
-            self, "on_" + snake_case(type(etp_object).__name__)
-        )
+        handling_func = get_handler_method(self, get_object_class(etp_object))
         if handling_func is not None:
             async for handled in handling_func(
                 msg=etp_object,
@@ -1,7 +1,7 @@
 # Copyright (c) 2022-2023 Geosiris.
 # SPDX-License-Identifier: Apache-2.0
 
-from typing import AsyncGenerator, Optional, Protocol, Union
+from typing import AsyncGenerator, ClassVar, Optional, Protocol, Union
 
 from etptypes.energistics.etp.v12.datatypes.message_header import MessageHeader
 from etptypes.energistics.etp.v12.protocol.transaction.commit_transaction import (
@@ -26,10 +26,13 @@ from etptypes.energistics.etp.v12.protocol.transaction.start_transaction_respons
 from etpproto.client_info import ClientInfo
 from etpproto.error import InvalidMessageTypeError, NotSupportedError
 from etpproto.messages import Message
-from etpproto.utils import snake_case
+from etpproto.utils import get_handler_method, get_object_class
 
 
 class TransactionHandler(Protocol):
+    #: the messages of a transaction are handled in the order they are received
+    serialized: ClassVar[bool] = True
+
     async def on_commit_transaction(
         self,
         msg: CommitTransaction,
@@ -96,9 +99,7 @@ class TransactionHandler(Protocol):
         msg_header: MessageHeader,
         client_info: Union[None, ClientInfo] = None,
     ) -> AsyncGenerator[Optional[Message], None]:
-        handling_func = getattr(
-            self, "on_" + snake_case(type(etp_object).__name__)
-        )
+        handling_func = get_handler_method(self, get_object_class(etp_object))
         if handling_func is not None:
             async for handled in handling_func(
                 msg=etp_object,
@@ -0,0 +1,608 @@
+# Copyright (c) 2022-2023 Geosiris.
+# SPDX-License-Identifier: Apache-2.0
+"""
+Tiling of the data arrays that are too large to be sent in a single message (DataArray protocol).
+
+A customer gets such an array in tiles with GetDataSubarrays : a :class:`SubarrayAssembler` computes
+tiles that fit in MaxWebSocketMessagePayloadSize and writes the received tiles in a preallocated numpy array.
+A store answers from numpy arrays with :class:`TiledDataArrayHandler` : the arrays too large for a message
+are refused by GetDataArrays (MaxSizeExceededError), and GetDataSubarrays answers their tiles.
+A client gets them with a :class:`SubarrayFetcher`, which keeps several GetDataSubarrays requests in flight.
+
+Requires numpy (see etpproto.numpy_codec).
+"""
+
+import asyncio
+import os
+from functools import lru_cache
+from itertools import product
+from typing import (
+    Any,
+    AsyncGenerator,
+    Awaitable,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    Union,
+)
+
+from etptypes.energistics.etp.v12.datatypes.any_array import AnyArray
+from etptypes.energistics.etp.v12.datatypes.any_array_type import (
+    AnyArrayType,
+)
+from etptypes.energistics.etp.v12.datatypes.any_logical_array_type import (
+    AnyLogicalArrayType,
+)
+from etptypes.energistics.etp.v12.datatypes.array_of_double import (
+    ArrayOfDouble,
+)
+from etptypes.energistics.etp.v12.datatypes.data_array_types.data_array import (
+    DataArray,
+)
+from etptypes.energistics.etp.v12.datatypes.data_array_types.data_array_identifier import (
+    DataArrayIdentifier,
+)
+from etptypes.energistics.etp.v12.datatypes.data_array_types.data_array_metadata import (
+    DataArrayMetadata,
+)
+from etptypes.energistics.etp.v12.datatypes.data_array_types.get_data_subarrays_type import (
+    GetDataSubarraysType,
+)
+from etptypes.energistics.etp.v12.datatypes.data_array_types.put_data_subarrays_type import (
+    PutDataSubarraysType,
+)
+from etptypes.energistics.etp.v12.datatypes.error_info import ErrorInfo
+from etptypes.energistics.etp.v12.datatypes.message_header import MessageHeader
+from etptypes.energistics.etp.v12.protocol.core.protocol_exception import (
+    ProtocolException,
+)
+from etptypes.energistics.etp.v12.protocol.data_array.get_data_array_metadata import (
+    GetDataArrayMetadata,
+)
+from etptypes.energistics.etp.v12.protocol.data_array.get_data_array_metadata_response import (
+    GetDataArrayMetadataResponse,
+)
+from etptypes.energistics.etp.v12.protocol.data_array.get_data_arrays import (
+    GetDataArrays,
+)
+from etptypes.energistics.etp.v12.protocol.data_array.get_data_arrays_response import (
+    GetDataArraysResponse,
+)
+from etptypes.energistics.etp.v12.protocol.data_array.get_data_subarrays import (
+    GetDataSubarrays,
+)
+from etptypes.energistics.etp.v12.protocol.data_array.get_data_subarrays_response import (
+    GetDataSubarraysResponse,
+)
+from etptypes.energistics.etp.v12.protocol.data_array.put_data_subarrays import (
+    PutDataSubarrays,
+)
+
+from etpproto.client_info import ClientInfo
+from etpproto.codec import MAX_HEADER_SIZE
+from etpproto.connection import ETPConnection
+from etpproto.error import (
+    ETPError,
+    InvalidArgumentError,
+    MaxSizeExceededError,
+    NotFoundError,
+    NotSupportedError,
+)
+from etpproto.messages import EncodedBody, Message
+from etpproto.numpy_codec import np, to_any_array, to_numpy
+from etpproto.protocols.data_array import DataArrayHandler
+
+#: {transport type: (numpy dtype, max size in bytes of an encoded value)}. Int and long are varints.
+TRANSPORT_TYPES = {
+    AnyArrayType.ARRAY_OF_BOOLEAN: ("?", 1),
+    AnyArrayType.ARRAY_OF_INT: ("<i4", 5),
+    AnyArrayType.ARRAY_OF_LONG: ("<i8", 10),
+    AnyArrayType.ARRAY_OF_FLOAT: ("<f4", 4),
+    AnyArrayType.ARRAY_OF_DOUBLE: ("<f8", 8),
+}
+
+#: {numpy dtype name: (transport type, logical type)}
+DTYPE_ARRAY_TYPES = {
+    "bool": (
+        AnyArrayType.ARRAY_OF_BOOLEAN,
+        AnyLogicalArrayType.ARRAY_OF_BOOLEAN,
+    ),
+    "int8": (AnyArrayType.ARRAY_OF_INT, AnyLogicalArrayType.ARRAY_OF_INT8),
+    "uint8": (AnyArrayType.ARRAY_OF_INT, AnyLogicalArrayType.ARRAY_OF_UINT8),
+    "int16": (
+        AnyArrayType.ARRAY_OF_INT,
+        AnyLogicalArrayType.ARRAY_OF_INT16_LE,
+    ),
+    "uint16": (
+        AnyArrayType.ARRAY_OF_INT,
+        AnyLogicalArrayType.ARRAY_OF_UINT16_LE,
+    ),
+    "int32": (
+        AnyArrayType.ARRAY_OF_INT,
+        AnyLogicalArrayType.ARRAY_OF_INT32_LE,
+    ),
+    "uint32": (
+        AnyArrayType.ARRAY_OF_LONG,
+        AnyLogicalArrayType.ARRAY_OF_UINT32_LE,
+    ),
+    "int64": (
+        AnyArrayType.ARRAY_OF_LONG,
+        AnyLogicalArrayType.ARRAY_OF_INT64_LE,
+    ),
+    "float32": (
+        AnyArrayType.ARRAY_OF_FLOAT,
+        AnyLogicalArrayType.ARRAY_OF_FLOAT32_LE,
+    ),
+    "float64": (
+        AnyArrayType.ARRAY_OF_DOUBLE,
+        AnyLogicalArrayType.ARRAY_OF_DOUBLE64_LE,
+    ),
+}
+
+
+#: max size of the map keys of the tiles taken into account by :func:`tile_overhead` (the keys of a
+#: SubarrayAssembler are short, a store answers with the keys of the customer)
+MAX_TILE_KEY_SIZE = 64
+
+
+@lru_cache(maxsize=None)
+def tile_overhead(nb_dimensions: int) -> int:
+    """
+    Returns an upper bound of the size of a message with a single tile of :param nb_dimensions:, without its
+    values (GetDataArraysResponse, GetDataSubarraysResponse or PutDataSubarrays, whose uid is not counted) :
+    the size of the header and of the encoding of the largest of them, a PutDataSubarrays with an empty uid,
+    a key of MAX_TILE_KEY_SIZE bytes, the largest starts and counts, and an empty array of values (plus the
+    size of the count of the values).
+    """
+    largest = -(1 << 63)
+    message = PutDataSubarrays(
+        data_subarrays={
+            "k"
+            * MAX_TILE_KEY_SIZE: PutDataSubarraysType(
+                uid=DataArrayIdentifier(uri="", path_in_resource=""),
+                data=AnyArray(item=ArrayOfDouble(values=[])),
+                starts=[largest] * nb_dimensions,
+                counts=[largest] * nb_dimensions,
+            )
+        }
+    )
+    return MAX_HEADER_SIZE + len(EncodedBody.from_model(message).data) + 10
+
+
+def tile_counts(
+    dimensions: Sequence[int], item_size: int, max_bytes: int
+) -> List[int]:
+    """
+    Returns the dimensions of the tiles of an array, so that a tile of values of :param item_size: bytes
+    fits in a message of :param max_bytes:. The tiles are made of whole rows of the last dimensions,
+    as many as possible, so that each tile is a contiguous part of the array (C order).
+    """
+    max_items = max(
+        1, (max_bytes - tile_overhead(len(dimensions))) // item_size
+    )
+    counts = [1] * len(dimensions)
+    inner = 1
+    for i in reversed(range(len(dimensions))):
+        if inner * dimensions[i] <= max_items:
+            counts[i] = max(dimensions[i], 1)
+            inner *= counts[i]
+        else:
+            counts[i] = max(1, max_items // inner)
+            break
+    return counts
+
+
+def iter_tiles(
+    dimensions: Sequence[int], counts: Sequence[int]
+) -> Iterator[Tuple[List[int], List[int]]]:
+    """Yields the (starts, counts) of the tiles of an array, in C order"""
+    if 0 in dimensions:
+        return
+    for starts in product(
+        *(range(0, d, c) for d, c in zip(dimensions, counts))
+    ):
+        yield list(starts), [
+            min(c, d - s) for s, c, d in zip(starts, counts, dimensions)
+        ]
+
+
+def tile_slices(
+    starts: Sequence[int], counts: Sequence[int]
+) -> Tuple[slice, ...]:
+    return tuple(slice(s, s + c) for s, c in zip(starts, counts))
+
+
+def array_types(dtype: Any) -> Tuple[AnyArrayType, AnyLogicalArrayType]:
+    """
+    Returns the transport and logical array types of a numpy dtype.
+    Raises a NotSupportedError if the dtype can not be sent (e.g. uint64, strings or objects).
+    """
+    types = DTYPE_ARRAY_TYPES.get(np.dtype(dtype).name)
+    if types is None:
+        raise NotSupportedError()
+    return types
+
+
+def array_item_size(values: Any) -> int:
+    """Returns the max size of an encoded value of a numpy array"""
+    transport_type, _ = array_types(values.dtype)
+    return TRANSPORT_TYPES[transport_type][1]
+
+
+def data_array_metadata(
+    dtype: Any, shape: Sequence[int], max_payload_size: int = -1
+) -> DataArrayMetadata:
+    """
+    Returns the metadata of an array of numpy :param dtype: and :param shape:, with its tiles for messages
+    of :param max_payload_size: bytes as preferredSubarrayDimensions (the whole array if it is not positive)
+    """
+    transport_type, logical_type = array_types(dtype)
+    dimensions = list(shape)
+    return DataArrayMetadata(
+        dimensions=dimensions,
+        preferred_subarray_dimensions=(
+            tile_counts(
+                dimensions,
+                TRANSPORT_TYPES[transport_type][1],
+                max_payload_size,
+            )
+            if max_payload_size > 0
+            else dimensions
+        ),
+        transport_array_type=transport_type,
+        logical_array_type=logical_type,
+        store_last_write=0,
+        store_created=0,
+        custom_data={},
+    )
+
+
+class SubarrayAssembler:
+    """
+    Gets a data array in tiles with GetDataSubarrays (customer side).
+    The tiles are computed from the array metadata (GetDataArrayMetadataResponse) so that each one fits
+    in :param max_payload_size: bytes (a single tile if it is not positive), and are written in :ivar array:
+    as soon as they are received.
+
+        assembler = SubarrayAssembler(uid, metadata, connection.max_payload_size())
+        # send Message.get_object_message(assembler.request()), then for each GetDataSubarraysResponse :
+        assembler.add(response.data_subarrays)
+        if assembler.is_complete():
+            use(assembler.array)
+
+    :ivar array: the numpy array with the dimensions of the data array, :param out: if it is given
+    :ivar tiles: the {key: GetDataSubarraysType} of the request
+    :ivar missing: the keys of the tiles not received yet
+    """
+
+    def __init__(
+        self,
+        uid: DataArrayIdentifier,
+        metadata: DataArrayMetadata,
+        max_payload_size: int,
+        out: Optional[Any] = None,
+        key_prefix: str = "",
+    ) -> None:
+        if metadata.transport_array_type not in TRANSPORT_TYPES:
+            raise ValueError(
+                f"Unsupported transport array type : {metadata.transport_array_type}"
+            )
+        dtype, item_size = TRANSPORT_TYPES[metadata.transport_array_type]
+        self.uid = uid
+        self.dimensions = list(metadata.dimensions)
+        if out is None:
+            out = np.empty(self.dimensions, dtype=dtype)
+        elif list(out.shape) != self.dimensions:
+            raise ValueError(
+                f"Array of shape {out.shape} for a data array of dimensions {self.dimensions}"
+            )
+        self.array = out
+        # a single tile if the message size is not limited (as data_array_metadata)
+        tile_dimensions = (
+            tile_counts(self.dimensions, item_size, max_payload_size)
+            if max_payload_size > 0
+            else self.dimensions
+        )
+        self.tiles: Dict[str, GetDataSubarraysType] = {
+            f"{key_prefix}{i}": GetDataSubarraysType(
+                uid=uid, starts=starts, counts=counts
+            )
+            for i, (starts, counts) in enumerate(
+                iter_tiles(self.dimensions, tile_dimensions)
+            )
+        }
+        self.missing: Set[str] = set(self.tiles)
+
+    def request(self) -> GetDataSubarrays:
+        return GetDataSubarrays(data_subarrays=self.tiles)
+
+    def add(self, data_subarrays: Mapping[str, DataArray]) -> bool:
+        """
+        Writes the received tiles in the array (the other keys are ignored).
+        Returns True if all the tiles have been received.
+        """
+        for key, data_array in data_subarrays.items():
+            tile = self.tiles.get(key)
+            if tile is None:
+                continue
+            self.array[tile_slices(tile.starts, tile.counts)] = to_numpy(
+                data_array.data
+            ).reshape(tile.counts)
+            self.missing.discard(key)
+        return self.is_complete()
+
+    def is_complete(self) -> bool:
+        return len(self.missing) == 0
+
+
+class TiledDataArrayHandler(DataArrayHandler):
+    """
+    DataArrayHandler of a store that answers GetDataArrayMetadata, GetDataArrays and GetDataSubarrays
+    from the numpy arrays given by :meth:`get_array`.
+    The arrays too large for a message of MaxWebSocketMessagePayloadSize bytes are refused by GetDataArrays
+    with a MaxSizeExceededError, their metadata gives the dimensions of the tiles in preferredSubarrayDimensions.
+    """
+
+    async def get_array(
+        self,
+        uid: DataArrayIdentifier,
+        client_info: Union[None, ClientInfo] = None,
+    ) -> Any:
+        """Returns the numpy array identified by :param uid:. Raises a NotFoundError if there is none."""
+        raise NotFoundError()
+
+    @staticmethod
+    def max_payload_size(client_info: Union[None, ClientInfo]) -> int:
+        max_size = (
+            client_info.getCapability("MaxWebSocketMessagePayloadSize")
+            if client_info is not None
+            else None
+        )
+        return max_size if max_size is not None and max_size > 0 else -1
+
+    async def on_get_data_array_metadata(
+        self,
+        msg: GetDataArrayMetadata,
+        msg_header: MessageHeader,
+        client_info: Union[None, ClientInfo] = None,
+    ) -> AsyncGenerator[Optional[Message], None]:
+        max_size = self.max_payload_size(client_info)
+        metadata = {}
+        errors = {}
+        for key, uid in msg.data_arrays.items():
+            try:
+                values = await self.get_array(uid, client_info)
+                metadata[key] = data_array_metadata(
+                    values.dtype, values.shape, max_size
+                )
+            except ETPError as err:
+                errors[key] = err.to_etp_error()
+        for answer in self._answers(
+            GetDataArrayMetadataResponse(array_metadata=metadata),
+            metadata,
+            errors,
+            msg_header,
+        ):
+            yield answer
+
+    async def on_get_data_arrays(
+        self,
+        msg: GetDataArrays,
+        msg_header: MessageHeader,
+        client_info: Union[None, ClientInfo] = None,
+    ) -> AsyncGenerator[Optional[Message], None]:
+        max_size = self.max_payload_size(client_info)
+        data_arrays = {}
+        errors = {}
+        for key, uid in msg.data_arrays.items():
+            try:
+                values = await self.get_array(uid, client_info)
+                if (
+                    max_size > 0
+                    and values.size * array_item_size(values)
+                    + tile_overhead(values.ndim)
+                    > max_size
+                ):
+                    # the customer gets it with GetDataSubarrays
+                    raise MaxSizeExceededError()
+                data_arrays[key] = DataArray.construct(
+                    dimensions=list(values.shape), data=to_any_array(values)
+                )
+            except ETPError as err:
+                errors[key] = err.to_etp_error()
+        for answer in self._answers(
+            GetDataArraysResponse.construct(data_arrays=data_arrays),
+            data_arrays,
+            errors,
+            msg_header,
+        ):
+            yield answer
+
+    async def on_get_data_subarrays(
+        self,
+        msg: GetDataSubarrays,
+        msg_header: MessageHeader,
+        client_info: Union[None, ClientInfo] = None,
+    ) -> AsyncGenerator[Optional[Message], None]:
+        data_subarrays = {}
+        errors = {}
+        for key, subarray in msg.data_subarrays.items():
+            try:
+                values = await self.get_array(subarray.uid, client_info)
+                if len(subarray.starts) != values.ndim or len(
+                    subarray.counts
+                ) != len(subarray.starts):
+                    raise InvalidArgumentError()
+                tile = values[tile_slices(subarray.starts, subarray.counts)]
+                if list(tile.shape) != list(subarray.counts):
+                    raise InvalidArgumentError()
+                data_subarrays[key] = DataArray.construct(
+                    dimensions=list(subarray.counts),
+                    data=to_any_array(tile),
+                )
+            except ETPError as err:
+                errors[key] = err.to_etp_error()
+        for answer in self._answers(
+            GetDataSubarraysResponse.construct(data_subarrays=data_subarrays),
+            data_subarrays,
+            errors,
+            msg_header,
+        ):
+            yield answer
+
+    @staticmethod
+    def _answers(
+        response: Any,
+        values: Mapping[str, Any],
+        errors: Dict[str, ErrorInfo],
+        msg_header: MessageHeader,
+    ) -> Iterator[Optional[Message]]:
+        """The response for the keys that succeeded, and a ProtocolException for the others"""
+        if len(values) > 0 or len(errors) == 0:
+            yield Message.get_object_message(
+                response, correlation_id=msg_header.message_id
+            )
+        if len(errors) > 0:
+            yield Message.get_object_message(
+                ProtocolException(errors=errors),
+                correlation_id=msg_header.message_id,
+            )
+
+
+class SubarrayFetchError(ETPError):
+    """Error answered by the store for a tile requested by a :class:`SubarrayFetcher`"""
+
+    def __init__(self, error: ErrorInfo) -> None:
+        super().__init__(error.message)
+        self.error = error
+
+
+class SubarrayFetcher(DataArrayHandler):
+    """
+    Gets data arrays in tiles with GetDataSubarrays (customer side), with a request per tile and at most
+    :param max_in_flight: requests waiting for their answer. The messages are sent with :param send:
+    (e.g. the send method of the websocket), and the answers are received by the fetcher as the DataArray
+    handler of the client connection :param connection:.
+
+        fetcher = SubarrayFetcher(connection, websocket.send, max_in_flight=8)
+        connection.handlers[CommunicationProtocol.DATA_ARRAY] = fetcher
+        # the ProtocolExceptions are received by the Core handler, which forwards them :
+        #     async for answer in fetcher.on_protocol_exception(msg, msg_header, client_info): yield answer
+        array = await fetcher.fetch(uid, metadata, out="grid.npy")
+
+    A failed tile raises a :class:`SubarrayFetchError` from :meth:`fetch`, as a missing answer
+    after :param timeout: seconds (asyncio.TimeoutError).
+    """
+
+    def __init__(
+        self,
+        connection: ETPConnection,
+        send: Callable[[bytes], Awaitable[Any]],
+        max_in_flight: int = 8,
+        timeout: Optional[float] = None,
+    ) -> None:
+        if max_in_flight < 1:
+            raise ValueError("max_in_flight must be at least 1")
+        self.connection = connection
+        self.send = send
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        # {correlation id: (assembler, tile key, answer)}
+        self._pending: Dict[
+            int, Tuple[SubarrayAssembler, str, "asyncio.Future[None]"]
+        ] = {}
+
+    async def fetch(
+        self,
+        uid: DataArrayIdentifier,
+        metadata: DataArrayMetadata,
+        out: Optional[Any] = None,
+    ) -> Any:
+        """
+        Returns the data array :param uid: of :param metadata: (GetDataArrayMetadataResponse).
+        The tiles are written in :param out: : a numpy array (e.g. a numpy.memmap), or the path
+        of the .npy file to create, which is returned memory-mapped.
+        """
+        if isinstance(out, (str, os.PathLike)):
+            dtype, _ = TRANSPORT_TYPES[metadata.transport_array_type]
+            out = np.lib.format.open_memmap(
+                out, mode="w+", dtype=dtype, shape=tuple(metadata.dimensions)
+            )
+        assembler = SubarrayAssembler(
+            uid, metadata, self.connection.max_payload_size(), out=out
+        )
+        tiles = iter(assembler.tiles.items())
+
+        async def worker() -> None:
+            for key, tile in tiles:
+                await self._request(assembler, key, tile)
+
+        workers = [
+            asyncio.ensure_future(worker())
+            for _ in range(min(self.max_in_flight, len(assembler.tiles)))
+        ]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for task in workers:
+                task.cancel()
+        if hasattr(assembler.array, "flush"):
+            assembler.array.flush()
+        return assembler.array
+
+    def in_flight(self) -> int:
+        """Returns the number of requests waiting for their answer"""
+        return len(self._pending)
+
+    async def _request(
+        self,
+        assembler: SubarrayAssembler,
+        key: str,
+        tile: GetDataSubarraysType,
+    ) -> None:
+        msg_id = self.connection.consume_msg_id()
+        answer = asyncio.get_running_loop().create_future()
+        self._pending[msg_id] = (assembler, key, answer)
+        try:
+            msg = Message.get_object_message(
+                GetDataSubarrays(data_subarrays={key: tile}), msg_id=msg_id
+            )
+            for msg_part in self.connection.encode_message_generator(msg):
+                await self.send(msg_part)
+            await asyncio.wait_for(answer, self.timeout)
+        finally:
+            self._pending.pop(msg_id, None)
+
+    async def on_get_data_subarrays_response(
+        self,
+        msg: GetDataSubarraysResponse,
+        msg_header: MessageHeader,
+        client_info: Union[None, ClientInfo] = None,
+    ) -> AsyncGenerator[Optional[Message], None]:
+        pending = self._pending.get(msg_header.correlation_id)
+        if pending is not None:
+            assembler, key, answer = pending
+            assembler.add(msg.data_subarrays)
+            if key not in assembler.missing and not answer.done():
+                answer.set_result(None)
+        yield None
+
+    async def on_protocol_exception(
+        self,
+        msg: ProtocolException,
+        msg_header: MessageHeader,
+        client_info: Union[None, ClientInfo] = None,
+    ) -> AsyncGenerator[Optional[Message], None]:
+        pending = self._pending.get(msg_header.correlation_id)
+        if pending is not None:
+            _, key, answer = pending
+            error = msg.errors.get(key, msg.error)
+            if error is not None and not answer.done():
+                answer.set_exception(SubarrayFetchError(error))
+        yield None
@@ -6,7 +6,20 @@ import inspect
 import json
 import pkgutil
 from collections import defaultdict
-from typing import Any, DefaultDict, Dict, List, Type, Union
+from functools import lru_cache
+from types import MethodType
+from typing import (
+    Any,
+    Callable,
+    DefaultDict,
+    Dict,
+    List,
+    Mapping,
+    Optional,
+    Tuple,
+    Type,
+    Union,
+)
 
 import etptypes.energistics.etp.v12.protocol
 from etptypes import ETPModel, avro_schema
@@ -21,13 +34,17 @@ def list_classes(modulePath: str) -> List[Type[ETPModel]]:
     return classList
 
 
-MessageDict = DefaultDict[str, Type[ETPModel]]
-ProtocolDict = DefaultDict[str, MessageDict]
+MessageDict = Mapping[str, Type[ETPModel]]
+ProtocolDict = Mapping[str, MessageDict]
 
 
 def get_all_etp_protocol_classes() -> ProtocolDict:
-    protocolDict: ProtocolDict = defaultdict(
-        lambda: defaultdict(type(ETPModel))
+    """
+    Imports all the etptypes protocol modules and returns the table of their messages.
+    See etpproto.protocol_index.ProtocolTable for a table that imports a class only when it is used.
+    """
+    protocolDict: DefaultDict[str, DefaultDict[str, Type[ETPModel]]] = (
+        defaultdict(lambda: defaultdict(type(ETPModel)))
     )
     package = etptypes.energistics.etp.v12.protocol
     for _, modname, _ in pkgutil.walk_packages(
@@ -51,6 +68,11 @@ def get_class_from_protocol_and_name(
 ):
     protocol = str(protocol)
     if protocol in dict_map_pro_to_class:
+        messages = dict_map_pro_to_class[protocol]
+        find = getattr(messages, "find", None)
+        if find is not None:
+            # MessageTable : only the class found is imported
+            return find(name)
         for msg_t in dict_map_pro_to_class[protocol]:
             if (
                 dict_map_pro_to_class[protocol][msg_t].__name__.lower()
@@ -60,6 +82,39 @@ def get_class_from_protocol_and_name(
     return None
 
 
+def get_object_class(etp_object: Any) -> type:
+    """Returns the ETP class of a message body, validated (ETPModel) or not (RecordView)"""
+    object_class = getattr(etp_object, "object_class", None)
+    if isinstance(object_class, type):
+        return object_class
+    return type(etp_object)
+
+
+@lru_cache(maxsize=None)
+def handler_method_name(object_class: type) -> str:
+    """Returns the name of the method that handles a message class in a protocol handler (e.g. on_get_resources)"""
+    return "on_" + snake_case(object_class.__name__)
+
+
+_handler_functions: Dict[Tuple[type, type], Optional[Callable]] = {}
+
+
+def get_handler_method(handler: Any, object_class: type) -> Optional[Callable]:
+    """
+    Returns the method of a protocol handler that handles a message class, bound to :param handler:
+    (None if the handler has no such method).
+    The method is searched only once for each handler class and message class.
+    """
+    key = (type(handler), object_class)
+    try:
+        func = _handler_functions[key]
+    except KeyError:
+        func = _handler_functions[key] = getattr(
+            type(handler), handler_method_name(object_class), None
+        )
+    return MethodType(func, handler) if func is not None else None
+
+
 def get_first_dict_attribute_name(obj):
     for att in obj.__dict__:
         if type(getattr(obj, att)) == dict:
@@ -0,0 +1,14 @@
+# Copyright (c) 2022-2023 Geosiris.
+# SPDX-License-Identifier: Apache-2.0
+
+import pytest
+
+from etpproto.codec import codec_registry
+
+
+@pytest.fixture
+def numpy_codecs():
+    """Decodes the arrays of the messages as numpy arrays during the test"""
+    codec_registry.use_numpy = True
+    yield codec_registry
+    codec_registry.use_numpy = False
@@ -0,0 +1,206 @@
+# Copyright (c) 2022-2023 Geosiris.
+# SPDX-License-Identifier: Apache-2.0
+
+import uuid
+
+import pytest
+from etptypes.energistics.etp.v12.datatypes.channel_data.channel_range_info import (
+    ChannelRangeInfo,
+)
+from etptypes.energistics.etp.v12.datatypes.channel_data.data_item import (
+    DataItem,
+)
+from etptypes.energistics.etp.v12.datatypes.data_value import DataValue
+from etptypes.energistics.etp.v12.datatypes.index_value import IndexValue
+from etptypes.energistics.etp.v12.datatypes.object.index_interval import (
+    IndexInterval,
+)
+from etptypes.energistics.etp.v12.protocol.channel_subscribe.get_ranges import (
+    GetRanges,
+)
+from etptypes.energistics.etp.v12.protocol.channel_subscribe.get_ranges_response import (
+    GetRangesResponse,
+)
+
+from etpproto.channel_cache import (
+    CachedChannelSubscribeHandler,
+    ChannelRangeCache,
+    ChannelRingBuffer,
+)
+from etpproto.channel_data import ChannelDataColumns
+from etpproto.channel_fanout import ChannelFanout
+from etpproto.channel_flow import ChannelDataBatcher
+from etpproto.connection import CommunicationProtocol, ETPConnection
+from etpproto.messages import Message
+
+np = pytest.importorskip("numpy")
+
+
+def _range(channel_ids, start, end) -> ChannelRangeInfo:
+    return ChannelRangeInfo(
+        channel_ids=channel_ids,
+        interval=IndexInterval(
+            start_index=IndexValue(item=start),
+            end_index=IndexValue(item=end),
+            uom="s",
+        ),
+    )
+
+
+def test_ring_buffer():
+    buffer = ChannelRingBuffer(4)
+    assert buffer.range(0, 10) is None
+    for i in range(10):
+        buffer.append(np.array([i]), np.array([i / 2]))
+    assert buffer.indexes.tolist() == [6, 7, 8, 9]
+    assert buffer.values.tolist() == [3.0, 3.5, 4.0, 4.5]
+    # older than the oldest point
+    assert buffer.range(5, 7) is None
+    indexes, values = buffer.range(7, 8)
+    assert indexes.tolist() == [7, 8] and values.tolist() == [3.5, 4.0]
+    assert buffer.range(7.5, 100)[0].tolist() == [8, 9]
+
+    # more points than the capacity
+    buffer.append(np.arange(20, 30), np.zeros(10))
+    assert buffer.indexes.tolist() == [26, 27, 28, 29]
+    # replaced points
+    buffer.append(np.array([27, 35]), np.ones(2))
+    assert buffer.indexes.tolist() == [26, 27, 35]
+    assert buffer.values.tolist() == [0.0, 1.0, 1.0]
+
+
+def test_ring_buffer_span():
+    buffer = ChannelRingBuffer(100, max_span=10)
+    buffer.append(np.arange(0, 50, 2), np.zeros(25))
+    assert buffer.indexes.tolist() == [38, 40, 42, 44, 46, 48]
+
+
+def test_ring_buffer_promotes_its_dtypes():
+    cache = ChannelRangeCache()
+    # the first batch has int indexes and values
+    cache.add(ChannelDataColumns([1, 1], [[10, 20]], [1, 2]))
+    cache.add(ChannelDataColumns([1], [[30.5]], [2.75]))
+    indexes, values = cache.lookup(1, 10, 100)
+    assert indexes.tolist() == [10, 20, 30.5]
+    assert values.tolist() == [1, 2, 2.75]
+
+    buffer = ChannelRingBuffer(4)
+    buffer.append(np.array([1]), np.array([0.5]))
+    buffer.append(np.array([2]), np.array(["a"]))
+    assert buffer.values.tolist() == [0.5, "a"]
+
+
+def test_cache_hits_and_misses():
+    cache = ChannelRangeCache(max_bytes_per_channel=16 * 100)
+    for t in range(0, 1000, 10):
+        # 3 channels, a point each 10 s
+        cache.add(ChannelDataColumns([1, 2, 3], [[t, t, t]], [t, -t, 0.5]))
+    assert sorted(cache.channels) == [1, 2, 3]
+    assert len(cache.channels[1]) == 100
+
+    indexes, values = cache.lookup(2, 500, 520)
+    assert indexes.tolist() == [500, 510, 520]
+    assert values.tolist() == [-500, -510, -520]
+
+    cached, missed = cache.get_ranges(
+        [_range([1, 3, 4], 950, 2000), _range([2], -10, 10)]
+    )
+    assert cached.channel_ids.tolist() == [1] * 5 + [3] * 5
+    assert cached.indexes[0].tolist() == list(range(950, 1000, 10)) * 2
+    assert [r.channel_ids for r in missed] == [[4], [2]]
+    assert cache.metrics.hits == 3 and cache.metrics.misses == 2
+    assert cache.metrics.points == 13
+    assert cache.metrics.hit_ratio() == 0.6
+
+
+class RangesHandler(CachedChannelSubscribeHandler):
+    async def get_ranges_from_store(self, channel_ranges, client_info=None):
+        return [
+            DataItem(
+                channel_id=channel_id,
+                indexes=[IndexValue(item=0)],
+                value=DataValue(item=-1.0),
+                value_attributes=[],
+            )
+            for channel_range in channel_ranges
+            for channel_id in channel_range.channel_ids
+        ]
+
+
+@pytest.mark.asyncio
+async def test_get_ranges_from_cache_and_store():
+    handler = RangesHandler()
+    handler.range_cache.add(
+        ChannelDataColumns(
+            np.repeat([1, 2], 1000),
+            [np.tile(np.arange(1000), 2)],
+            np.arange(2000, dtype=np.float64),
+        )
+    )
+    connection = ETPConnection(
+        handlers={CommunicationProtocol.CHANNEL_SUBSCRIBE: handler}
+    )
+    connection.is_connected = True
+    connection.client_info.endpoint_capabilities[
+        "MaxWebSocketMessagePayloadSize"
+    ] = 4096
+
+    request = Message.get_object_message(
+        GetRanges(
+            request_uuid=uuid.uuid4().bytes,
+            channel_ranges=[_range([1, 2, 3], 100, 499)],
+        ),
+        msg_id=2,
+    )
+    data = []
+    answers = []
+    async for msg_part in connection.handle_bytes_generator(
+        request.encode_message()
+    ):
+        assert len(msg_part) <= 4096
+        answer = Message.decode_binary_message(
+            msg_part, ETPConnection.generic_transition_table
+        )
+        assert isinstance(answer.body, GetRangesResponse)
+        assert answer.header.correlation_id == 2
+        answers.append(answer)
+        data.extend(answer.body.data)
+    assert [a.is_final_msg() for a in answers] == [False] * (
+        len(answers) - 1
+    ) + [True]
+    assert all(a.is_multipart_msg() for a in answers)
+    ids = [a.header.message_id for a in answers]
+    assert ids == sorted(ids)
+    assert len(data) == 801
+    assert [item.value.item for item in data[:2]] == [100.0, 101.0]
+    assert data[400].channel_id == 2
+    assert data[400].indexes[0].item == 100
+    # channel 3 is read from the store
+    assert data[-1].channel_id == 3 and data[-1].value.item == -1.0
+    assert handler.range_cache.metrics.hits == 2
+    assert handler.range_cache.metrics.misses == 1
+
+
+def test_several_indexes_are_not_cached():
+    cache = ChannelRangeCache()
+    cache.add(ChannelDataColumns([1, 2], [[10, 10]], [1.0, 2.0]))
+    # depth and time indexes
+    cache.add(ChannelDataColumns([1], [[20], [1.5]], [3.0]))
+    assert list(cache.channels) == [2]
+    cached, missed = cache.get_ranges([_range([1, 2], 0, 100)])
+    assert cached.channel_ids.tolist() == []
+    assert [r.channel_ids for r in missed] == [[1, 2]]
+
+
+@pytest.mark.asyncio
+async def test_cache_fed_by_fanout_and_batcher():
+    cache = ChannelRangeCache()
+    fanout = ChannelFanout(range_cache=cache)
+    await fanout.publish(ChannelDataColumns([1, 1], [[0, 1]], [0.5, 1.5]))
+
+    connection = ETPConnection()
+    connection.is_connected = True
+    async with ChannelDataBatcher(connection, range_cache=cache) as batcher:
+        await batcher.add(ChannelDataColumns([2], [[5]], [2.5]))
+    assert cache.lookup(1, 0, 1)[1].tolist() == [0.5, 1.5]
+    assert cache.lookup(2, 5, 5)[1].tolist() == [2.5]
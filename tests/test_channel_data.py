@@ -0,0 +1,140 @@
+# Copyright (c) 2022-2023 Geosiris.
+# SPDX-License-Identifier: Apache-2.0
+
+from io import BytesIO
+
+import pytest
+from etptypes.energistics.etp.v12.datatypes.channel_data.data_item import (
+    DataItem,
+)
+from etptypes.energistics.etp.v12.datatypes.data_value import DataValue
+from etptypes.energistics.etp.v12.datatypes.index_value import IndexValue
+from etptypes.energistics.etp.v12.protocol.channel_data_load.channel_data import (
+    ChannelData as LoadChannelData,
+)
+from etptypes.energistics.etp.v12.protocol.channel_streaming.channel_data import (
+    ChannelData,
+)
+from etptypes.energistics.etp.v12.protocol.core.ping import Ping
+
+from etpproto.channel_data import (
+    ChannelDataCodec,
+    ChannelDataColumns,
+    decode_channel_data,
+    decode_channel_data_message,
+)
+from etpproto.codec import MessageCodec, as_avro_record, get_codec_for_class
+from etpproto.compression import compress_message, get_compressor
+from etpproto.connection import ETPConnection
+from etpproto.messages import Message
+
+np = pytest.importorskip("numpy")
+
+N = 1000
+rng = np.random.default_rng(0)
+times = 1_700_000_000_000_000 + np.arange(N, dtype=np.int64) * 1_000_000
+depths = rng.random(N) * 3000
+
+
+@pytest.mark.parametrize(
+    "values",
+    [
+        rng.random(N),
+        rng.random(N).astype(np.float32),
+        rng.integers(-(2**40), 2**40, N),
+        rng.integers(-(2**31), 2**31, N).astype(np.int32),
+        rng.random(N) > 0.5,
+    ],
+    ids=["double", "float", "long", "int", "boolean"],
+)
+def test_same_encoding_as_models(values):
+    columns = ChannelDataColumns(
+        np.arange(N) * 7 - 50, [times, depths], values
+    )
+    codec = MessageCodec.from_class(ChannelData)
+    encoded = columns.encode()
+    if values.dtype != np.float32:
+        assert encoded == codec.encode(
+            as_avro_record(ChannelData(data=columns.to_data_items()))
+        )
+    else:
+        # python floats of the models are written as avro doubles
+        record = codec.read(BytesIO(encoded))
+        assert [item["value"]["item"] for item in record["data"]] == (
+            values.tolist()
+        )
+
+    decoded, pos = decode_channel_data(encoded)
+    assert pos == len(encoded)
+    assert decoded.channel_ids.tolist() == columns.channel_ids.tolist()
+    assert decoded.indexes[0].dtype == np.int64
+    assert decoded.indexes[0].tolist() == times.tolist()
+    assert decoded.indexes[1].tolist() == depths.tolist()
+    assert decoded.values.dtype == values.dtype
+    assert decoded.values.tolist() == values.tolist()
+
+
+def test_columns_in_messages():
+    assert isinstance(get_codec_for_class(ChannelData), ChannelDataCodec)
+    assert isinstance(get_codec_for_class(LoadChannelData), ChannelDataCodec)
+    columns = ChannelDataColumns(np.arange(N), [times], rng.random(N))
+    msg = Message.get_object_message(
+        LoadChannelData.construct(data=columns), msg_id=2
+    )
+    encoded = msg.encode_message()
+    assert encoded == (
+        Message.get_object_message(
+            LoadChannelData(data=columns.to_data_items()), msg_id=2
+        ).encode_message()
+    )
+
+    # the receiver gets the models, or the columns
+    decoded = Message.decode_binary_message(
+        encoded, ETPConnection.generic_transition_table
+    )
+    from_items = ChannelDataColumns.from_data_items(decoded.body.data)
+    assert from_items.encode() == columns.encode()
+    header, decoded_columns = decode_channel_data_message(
+        encoded, ETPConnection.generic_transition_table
+    )
+    assert header.protocol == 22 and header.message_id == 2
+    assert np.array_equal(decoded_columns.values, columns.values)
+
+    compressed = compress_message(encoded, get_compressor("gzip"), 0)
+    _, decoded_columns = decode_channel_data_message(
+        compressed, ETPConnection.generic_transition_table
+    )
+    assert np.array_equal(decoded_columns.indexes[0], times)
+
+    ping = Message.get_object_message(Ping(current_date_time=0), msg_id=4)
+    assert (
+        decode_channel_data_message(
+            ping.encode_message(), ETPConnection.generic_transition_table
+        )
+        is None
+    )
+
+
+def test_items_that_are_not_columns():
+    with pytest.raises(TypeError):
+        ChannelDataColumns([1], [], np.array(["a"]))
+    with pytest.raises(ValueError):
+        ChannelDataColumns([1, 2], [[1]], [1.0, 2.0])
+    assert ChannelDataColumns([], [], []).encode() == b"\x00"
+
+    strings = ChannelData(
+        data=[
+            DataItem(
+                channel_id=1,
+                indexes=[IndexValue(item=1)],
+                value=DataValue(item="a"),
+                value_attributes=[],
+            )
+        ]
+    )
+    with pytest.raises(ValueError):
+        decode_channel_data(
+            MessageCodec.from_class(ChannelData).encode(
+                as_avro_record(strings)
+            )
+        )
@@ -0,0 +1,356 @@
+# Copyright (c) 2022-2023 Geosiris.
+# SPDX-License-Identifier: Apache-2.0
+
+import pytest
+from etptypes.energistics.etp.v12.datatypes.channel_data.channel_subscribe_info import (
+    ChannelSubscribeInfo,
+)
+from etptypes.energistics.etp.v12.datatypes.index_value import IndexValue
+from etptypes.energistics.etp.v12.protocol.channel_streaming.channel_data import (
+    ChannelData as StreamingChannelData,
+)
+from etptypes.energistics.etp.v12.protocol.channel_subscribe.channel_data import (
+    ChannelData,
+)
+from etptypes.energistics.etp.v12.protocol.channel_subscribe.subscribe_channels import (
+    SubscribeChannels,
+)
+from etptypes.energistics.etp.v12.protocol.channel_subscribe.subscribe_channels_response import (
+    SubscribeChannelsResponse,
+)
+from etptypes.energistics.etp.v12.protocol.channel_subscribe.subscriptions_stopped import (
+    SubscriptionsStopped,
+)
+from etptypes.energistics.etp.v12.protocol.channel_subscribe.unsubscribe_channels import (
+    UnsubscribeChannels,
+)
+from etptypes.energistics.etp.v12.protocol.core.protocol_exception import (
+    ProtocolException,
+)
+
+from etpproto.channel_cache import ChannelRangeCache
+from etpproto.channel_data import ChannelDataColumns
+from etpproto.channel_fanout import (
+    ChannelFanout,
+    FanoutChannelSubscribeHandler,
+)
+from etpproto.connection import CommunicationProtocol, ETPConnection
+from etpproto.error import NotFoundError, NotSupportedError
+from etpproto.messages import Message, MessageFlags
+
+np = pytest.importorskip("numpy")
+
+N = 1000
+columns = ChannelDataColumns(
+    np.arange(N) % 4,
+    [1_700_000_000_000_000 + np.arange(N, dtype=np.int64)],
+    np.arange(N, dtype=np.float64),
+)
+
+
+def _connection(max_payload_size: int = 1 << 20) -> ETPConnection:
+    connection = ETPConnection()
+    connection.is_connected = True
+    connection.client_info.endpoint_capabilities[
+        "MaxWebSocketMessagePayloadSize"
+    ] = max_payload_size
+    return connection
+
+
+def _frames(connection: ETPConnection):
+    queue = connection.outbound_queue
+    frames = []
+    while not queue.empty():
+        frames.append(queue.get_nowait())
+    return frames
+
+
+def _received(connection: ETPConnection):
+    return [
+        Message.decode_binary_message(
+            frame, ETPConnection.generic_transition_table
+        )
+        for frame in _frames(connection)
+    ]
+
+
+@pytest.mark.asyncio
+async def test_publish_encodes_once():
+    fanout = ChannelFanout()
+    viewers = [_connection() for _ in range(10)]
+    for viewer in viewers:
+        fanout.subscribe(viewer, [0, 1, 2, 3])
+    # another channel set, and another protocol
+    partial = _connection()
+    fanout.subscribe(partial, [1, 3, 42])
+    streaming = _connection()
+    fanout.subscribe(
+        streaming, [0, 1, 2, 3], CommunicationProtocol.CHANNEL_STREAMING
+    )
+
+    assert await fanout.publish(columns) == 12
+    assert fanout.metrics.bodies_encoded == 2
+    assert fanout.metrics.messages_sent == 12
+
+    for viewer in viewers:
+        viewer.consume_msg_id()
+    for viewer in viewers:
+        (msg,) = _received(viewer)
+        assert isinstance(msg.body, ChannelData)
+        assert msg.header.message_id == 1
+        assert msg.is_final_msg()
+        assert len(msg.body.data) == N
+    (msg,) = _received(streaming)
+    assert isinstance(msg.body, StreamingChannelData)
+    (msg,) = _received(partial)
+    assert {item.channel_id for item in msg.body.data} == {1, 3}
+    assert len(msg.body.data) == N // 2
+
+    await fanout.publish(columns.take(slice(0, 10)))
+    (msg,) = _received(viewers[0])
+    assert msg.header.message_id == 5
+    assert [item.value.item for item in msg.body.data] == list(range(10))
+    (msg,) = _received(partial)
+    assert [item.channel_id for item in msg.body.data] == [1, 3, 1, 3, 1]
+
+    assert fanout.unsubscribe(partial, [3, 4]) == [3]
+    assert fanout.unsubscribe(partial) == [1, 42]
+    assert partial not in fanout.sessions
+    assert 42 not in fanout.subscribers
+    await fanout.publish(columns)
+    assert _received(partial) == []
+
+
+@pytest.mark.asyncio
+async def test_publish_split_and_compressed():
+    fanout = ChannelFanout()
+    small = _connection(max_payload_size=4096)
+    compressed = _connection()
+    compressed.client_info.set_compression("gzip")
+    fanout.subscribe(small, [0, 1, 2, 3])
+    fanout.subscribe(compressed, [0, 1, 2, 3])
+
+    sent = []
+
+    async def send(frame):
+        sent.append(frame)
+
+    custom = _connection()
+    fanout.subscribe(custom, [0], send=send)
+    await fanout.publish(columns.to_data_items())
+
+    frames = _frames(small)
+    assert len(frames) > 1 and all(len(frame) <= 4096 for frame in frames)
+    data = [
+        item
+        for frame in frames
+        for item in Message.decode_binary_message(
+            frame, ETPConnection.generic_transition_table
+        ).body.data
+    ]
+    assert [item.value.item for item in data] == columns.values.tolist()
+
+    (frame,) = _frames(compressed)
+    msg = Message.decode_binary_message(
+        frame, ETPConnection.generic_transition_table
+    )
+    assert msg.header.message_flags & MessageFlags.COMPRESSED
+    assert len(frame) < len(msg.encode_message())
+    assert len(msg.body.data) == N
+
+    assert len(sent) == 1
+    assert fanout.metrics.bytes_sent == sum(map(len, frames + sent + [frame]))
+
+
+class Store(FanoutChannelSubscribeHandler):
+    async def check_subscription(self, subscription, client_info=None):
+        if subscription.channel_id > 100:
+            raise NotFoundError()
+
+
+@pytest.mark.asyncio
+async def test_subscribe_handler():
+    fanout = ChannelFanout()
+    connection = _connection()
+    connection.handlers = {
+        CommunicationProtocol.CHANNEL_SUBSCRIBE: Store(connection, fanout)
+    }
+
+    answer = []
+    request = Message.get_object_message(
+        SubscribeChannels(
+            channels={
+                str(channel_id): ChannelSubscribeInfo(
+                    channel_id=channel_id,
+                    start_index=IndexValue(item=0),
+                    request_latest_index_count=0,
+                    data_changes=False,
+                )
+                for channel_id in (1, 2, 101)
+            }
+        ),
+        msg_id=2,
+    )
+    async for m in connection.handle_bytes_generator(request.encode_message()):
+        answer.append(
+            Message.decode_binary_message(
+                m, ETPConnection.generic_transition_table
+            )
+        )
+    assert isinstance(answer[0].body, SubscribeChannelsResponse)
+    assert answer[0].body.success == {"1": "", "2": ""}
+    assert isinstance(answer[1].body, ProtocolException)
+    assert answer[1].body.errors["101"].code == NotFoundError.code
+    assert set(fanout.subscribers) == {1, 2}
+
+    request = Message.get_object_message(
+        UnsubscribeChannels(channel_ids={"0": 1}), msg_id=4
+    )
+    async for m in connection.handle_bytes_generator(request.encode_message()):
+        answer = Message.decode_binary_message(
+            m, ETPConnection.generic_transition_table
+        )
+    assert isinstance(answer.body, SubscriptionsStopped)
+    assert answer.header.correlation_id == 4
+    assert set(fanout.subscribers) == {2}
+
+
+def _subscribe_request(msg_id: int, **subscriptions) -> Message:
+    return Message.get_object_message(
+        SubscribeChannels(
+            channels={
+                key: ChannelSubscribeInfo(
+                    channel_id=channel_id,
+                    start_index=IndexValue(item=start),
+                    request_latest_index_count=count,
+                )
+                for key, (channel_id, start, count) in subscriptions.items()
+            }
+        ),
+        msg_id=msg_id,
+    )
+
+
+@pytest.mark.asyncio
+async def test_subscribe_with_previous_data():
+    fanout = ChannelFanout(range_cache=ChannelRangeCache())
+    await fanout.publish(columns.take(slice(0, 100)))
+    connection = _connection()
+    connection.handlers = {
+        CommunicationProtocol.CHANNEL_SUBSCRIBE: Store(connection, fanout)
+    }
+
+    request = _subscribe_request(
+        6,
+        live=(0, None, None),
+        start=(1, 1_700_000_000_000_081, None),
+        latest=(2, None, 3),
+        too_old=(3, 0, None),
+    )
+    answer = [
+        Message.decode_binary_message(
+            m, ETPConnection.generic_transition_table
+        )
+        async for m in connection.handle_bytes_generator(
+            request.encode_message()
+        )
+    ]
+    assert answer[0].body.success == {"live": "", "start": "", "latest": ""}
+    assert answer[1].body.errors["too_old"].code == NotSupportedError.code
+    assert set(fanout.subscribers) == {0, 1, 2}
+
+    await fanout.publish(columns.take(slice(100, 104)))
+    previous, published = _received(connection)
+    assert isinstance(previous.body, ChannelData)
+    assert previous.header.correlation_id == 6
+    assert [
+        (item.channel_id, item.value.item) for item in previous.body.data
+    ] == [
+        (1, 81.0),
+        (1, 85.0),
+        (1, 89.0),
+        (1, 93.0),
+        (1, 97.0),
+        (2, 90.0),
+        (2, 94.0),
+        (2, 98.0),
+    ]
+    assert published.header.correlation_id == 6
+    assert [item.value.item for item in published.body.data] == [
+        100.0,
+        101.0,
+        102.0,
+    ]
+
+
+@pytest.mark.asyncio
+async def test_subscribe_without_cache():
+    fanout = ChannelFanout()
+    connection = _connection()
+    connection.handlers = {
+        CommunicationProtocol.CHANNEL_SUBSCRIBE: Store(connection, fanout)
+    }
+    request = _subscribe_request(2, live=(0, None, None), start=(1, 5, None))
+    answer = [
+        Message.decode_binary_message(
+            m, ETPConnection.generic_transition_table
+        )
+        async for m in connection.handle_bytes_generator(
+            request.encode_message()
+        )
+    ]
+    assert answer[0].body.success == {"live": ""}
+    assert answer[1].body.errors["start"].code == NotSupportedError.code
+    assert set(fanout.subscribers) == {0}
+
+    await fanout.publish(columns.take(slice(0, 2)))
+    (published,) = _received(connection)
+    assert published.header.correlation_id == 2
+
+
+@pytest.mark.asyncio
+async def test_publish_drops_on_back_pressure():
+    fanout = ChannelFanout()
+    slow = _connection(max_payload_size=4096)
+    slow.max_outbound_messages = 4
+    fast = _connection(max_payload_size=4096)
+    fanout.subscribe(slow, [0, 1, 2, 3])
+    fanout.subscribe(fast, [0, 1, 2, 3])
+    await fanout.publish(columns)
+
+    nb_parts = fanout.metrics.bodies_encoded
+    assert len(_frames(fast)) == nb_parts > 4
+    received = _received(slow)
+    assert len(received) == 7
+    # the data, then the BackPressureWarning and BackPressureLimitExceeded
+    assert [isinstance(m.body, ProtocolException) for m in received] == [
+        False
+    ] * 4 + [True, True, False]
+    # and the slow session is unsubscribed
+    assert isinstance(received[-1].body, SubscriptionsStopped)
+    assert received[-1].body.reason == "BackPressureLimitExceeded"
+    assert sorted(received[-1].body.channel_ids.values()) == [0, 1, 2, 3]
+    assert list(fanout.sessions) == [fast]
+    assert fanout.metrics.sessions_stopped == 1
+    assert fanout.metrics.messages_sent == nb_parts + 4
+    assert fanout.metrics.messages_dropped == nb_parts - 4
+
+    await fanout.publish(columns.take(slice(0, 4)))
+    assert _received(slow) == []
+    assert len(_frames(fast)) == 1
+
+
+@pytest.mark.asyncio
+async def test_closed_sessions_are_dropped():
+    fanout = ChannelFanout()
+    closed = _connection()
+    opened = _connection()
+    fanout.subscribe(closed, [0, 1])
+    fanout.subscribe(opened, [1])
+    assert fanout.sessions[closed] is fanout.subscribe(closed, [2])
+
+    closed.is_connected = False
+    assert await fanout.publish(columns) == 1
+    assert list(fanout.sessions) == [opened]
+    assert set(fanout.subscribers) == {1}
+    assert _received(closed) == []
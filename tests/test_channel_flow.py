@@ -0,0 +1,189 @@
+# Copyright (c) 2022-2023 Geosiris.
+# SPDX-License-Identifier: Apache-2.0
+
+import asyncio
+
+import pytest
+from etptypes.energistics.etp.v12.protocol.channel_data_load.channel_data import (
+    ChannelData as LoadChannelData,
+)
+from etptypes.energistics.etp.v12.protocol.channel_streaming.channel_data import (
+    ChannelData,
+)
+
+from etpproto.channel_data import ChannelDataColumns
+from etpproto.channel_flow import ChannelDataBatcher
+from etpproto.connection import CommunicationProtocol, ETPConnection
+from etpproto.messages import Message
+
+np = pytest.importorskip("numpy")
+
+
+def _columns(start: int, nb: int) -> ChannelDataColumns:
+    return ChannelDataColumns(
+        np.arange(start, start + nb) % 3,
+        [np.arange(start, start + nb, dtype=np.int64)],
+        np.arange(start, start + nb, dtype=np.float64),
+    )
+
+
+def _connection() -> ETPConnection:
+    connection = ETPConnection()
+    connection.is_connected = True
+    connection.client_info.endpoint_capabilities[
+        "MaxWebSocketMessagePayloadSize"
+    ] = (1 << 20)
+    return connection
+
+
+def _received(connection: ETPConnection):
+    queue = connection.outbound_queue
+    received = []
+    while not queue.empty():
+        received.append(
+            Message.decode_binary_message(
+                queue.get_nowait(), ETPConnection.generic_transition_table
+            )
+        )
+    return received
+
+
+@pytest.mark.asyncio
+async def test_size_flush_and_increase():
+    connection = _connection()
+    batcher = ChannelDataBatcher(
+        connection,
+        correlation_id=6,
+        min_batch_bytes=1024,
+        max_batch_bytes=4096,
+        max_latency=10,
+    )
+    async with batcher:
+        for start in range(0, 5000, 50):
+            await batcher.add(_columns(start, 50))
+
+    received = _received(connection)
+    assert len(received) == batcher.stats.messages
+    assert all(isinstance(m.body, ChannelData) for m in received)
+    assert all(m.header.correlation_id == 6 for m in received)
+    ids = [m.header.message_id for m in received]
+    assert ids == sorted(ids)
+    values = [item.value.item for m in received for item in m.body.data]
+    assert values == list(range(5000))
+
+    assert batcher.batch_bytes == 4096 and batcher.stats.decreases == 0
+    assert batcher.stats.points == 5000
+    assert batcher.stats.latency_flushes == 0
+    # the batches grow up to max_batch_bytes
+    sizes = [len(m.body.data) for m in received]
+    assert sizes[0] < sizes[-2]
+    assert batcher.stats.bytes < 5000 * 32
+
+
+@pytest.mark.asyncio
+async def test_latency_flush():
+    connection = _connection()
+    batcher = ChannelDataBatcher(
+        connection,
+        protocol=CommunicationProtocol.CHANNEL_DATALOAD,
+        max_latency=0.01,
+    )
+    await batcher.add(_columns(0, 10).to_data_items())
+    await batcher.add(_columns(10, 10))
+    assert _received(connection) == []
+    await asyncio.sleep(0.05)
+    (msg,) = _received(connection)
+    assert isinstance(msg.body, LoadChannelData)
+    assert len(msg.body.data) == 20
+    assert batcher.stats.latency_flushes == 1
+    await batcher.close()
+    assert _received(connection) == []
+
+
+@pytest.mark.asyncio
+async def test_lagging_peer():
+    sent = []
+
+    async def slow_send(frame):
+        await asyncio.sleep(0.01)
+        sent.append(frame)
+
+    batcher = ChannelDataBatcher(
+        _connection(),
+        send=slow_send,
+        min_batch_bytes=256,
+        max_batch_bytes=1024,
+        target_send_latency=0.001,
+        max_rate=2000,
+    )
+    batcher.batch_bytes = 1024
+    start = asyncio.get_running_loop().time()
+    async with batcher:
+        for i in range(0, 400, 20):
+            await batcher.add(_columns(i, 20))
+    elapsed = asyncio.get_running_loop().time() - start
+
+    assert batcher.lagging and batcher.batch_bytes == 256
+    assert batcher.stats.decreases == batcher.stats.messages
+    assert batcher.stats.rate_limited_time > 0
+    # at most max_rate points per second once the peer lags
+    assert elapsed >= 0.15
+    assert len(sent) == batcher.stats.messages
+
+
+@pytest.mark.asyncio
+async def test_suspended_by_outbound_queue():
+    connection = _connection()
+    connection.max_outbound_messages = 4
+    batcher = ChannelDataBatcher(
+        connection, min_batch_bytes=256, max_batch_bytes=256
+    )
+    queue = connection.outbound_queue
+    received = []
+
+    async def consume():
+        while True:
+            await asyncio.sleep(0.002)
+            received.append(
+                Message.decode_binary_message(
+                    await queue.get(), ETPConnection.generic_transition_table
+                )
+            )
+
+    consumer = asyncio.ensure_future(consume())
+    async with batcher:
+        for i in range(0, 1000, 20):
+            await batcher.add(_columns(i, 20))
+    while not queue.empty():
+        await asyncio.sleep(0.01)
+    consumer.cancel()
+
+    assert queue.stats.suspensions > 0 and batcher.stats.decreases > 0
+    values = [
+        item.value.item
+        for m in received
+        if isinstance(m.body, ChannelData)
+        for item in m.body.data
+    ]
+    # the producer waits, no point is dropped
+    assert values == list(range(1000))
+
+
+@pytest.mark.asyncio
+async def test_latency_flush_error_is_raised():
+    async def failing_send(frame):
+        raise ConnectionError("closed")
+
+    batcher = ChannelDataBatcher(
+        _connection(), send=failing_send, max_latency=0.01
+    )
+    await batcher.add(_columns(0, 10))
+    await asyncio.sleep(0.05)
+    with pytest.raises(ConnectionError):
+        await batcher.add(_columns(10, 10))
+    await batcher.add(_columns(20, 10))
+
+    await asyncio.sleep(0.05)
+    with pytest.raises(ConnectionError):
+        await batcher.close()
+    assert batcher.stats.latency_flushes == 2 and batcher.stats.points == 0
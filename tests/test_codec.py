@@ -0,0 +1,278 @@
+# Copyright (c) 2022-2023 Geosiris.
+# SPDX-License-Identifier: Apache-2.0
+
+import json
+import subprocess
+import sys
+from io import BytesIO
+
+import pytest
+
+from etptypes import avro_schema
+from etptypes.energistics.etp.v12.datatypes.message_header import MessageHeader
+from etptypes.energistics.etp.v12.datatypes.any_array import AnyArray
+from etptypes.energistics.etp.v12.datatypes.array_of_double import (
+    ArrayOfDouble,
+)
+from etptypes.energistics.etp.v12.datatypes.data_array_types.data_array import (
+    DataArray,
+)
+from etptypes.energistics.etp.v12.datatypes.data_array_types.data_array_identifier import (
+    DataArrayIdentifier,
+)
+from etptypes.energistics.etp.v12.datatypes.data_array_types.put_data_arrays_type import (
+    PutDataArraysType,
+)
+from etptypes.energistics.etp.v12.datatypes.data_value import DataValue
+from etptypes.energistics.etp.v12.datatypes.object.dataspace import Dataspace
+from etptypes.energistics.etp.v12.protocol.core.ping import Ping
+from etptypes.energistics.etp.v12.protocol.dataspace.delete_dataspaces import (
+    DeleteDataspaces,
+)
+from etptypes.energistics.etp.v12.protocol.dataspace.delete_dataspaces_response import (
+    DeleteDataspacesResponse,
+)
+from etptypes.energistics.etp.v12.protocol.data_array.put_data_arrays import (
+    PutDataArrays,
+)
+from etptypes.energistics.etp.v12.protocol.dataspace.put_dataspaces import (
+    PutDataspaces,
+)
+from fastavro import schemaless_reader
+
+from etpproto.codec import (
+    MAX_HEADER_SIZE,
+    CodecRegistry,
+    ModelRecord,
+    RecordView,
+    as_avro_record,
+    codec_registry,
+    get_codec,
+    get_codec_for_class,
+    get_header_codec,
+    header_to_record,
+)
+from etpproto.messages import Message
+
+try:
+    from .server_protocol_example import *
+except Exception:
+    from server_protocol_example import *
+
+
+def test_codec_is_parsed_once():
+    registry = CodecRegistry()
+    codec = registry.for_class(Ping)
+    assert registry.for_class(Ping) is codec
+    assert registry.get(0, 8) is codec
+    assert codec.protocol == 0
+    assert codec.message_type == 8
+
+
+def test_codec_get_by_key():
+    codec = get_codec(0, 8, ETPConnection.generic_transition_table)
+    assert codec.object_class is Ping
+    assert get_codec_for_class(Ping) is codec
+
+
+def test_codec_header_is_not_a_message():
+    codec = get_header_codec()
+    assert codec.object_class is MessageHeader
+    assert codec.protocol == -1
+    assert codec.message_type == -1
+
+
+def test_codec_encode_compatible_with_raw_schema():
+    ping = Ping(current_date_time=123456)
+    encoded = get_codec_for_class(Ping).encode(ping.dict(by_alias=True))
+    decoded = schemaless_reader(
+        BytesIO(encoded), json.loads(avro_schema(Ping))
+    )
+    assert decoded == {"currentDateTime": 123456}
+
+
+def test_codec_message_round_trip():
+    msg = Message.get_object_message(
+        Ping(current_date_time=42), msg_id=3, correlation_id=1
+    )
+    decoded = Message.decode_binary_message(
+        msg.encode_message(), ETPConnection.generic_transition_table
+    )
+    assert decoded.header == msg.header
+    assert decoded.body == msg.body
+
+
+def test_lazy_decode_returns_record_view():
+    msg = Message.get_object_message(
+        PutDataspaces(
+            dataspaces={
+                "0": Dataspace(
+                    uri="eml:///dataspace('a')",
+                    store_last_write=1,
+                    store_created=2,
+                )
+            }
+        ),
+        msg_id=3,
+    )
+    decoded = Message.decode_binary_message(
+        msg.encode_message(),
+        ETPConnection.generic_transition_table,
+        lazy_validation=True,
+    )
+    assert isinstance(decoded.body, RecordView)
+    assert decoded.body_class() is PutDataspaces
+    assert decoded.header.message_id == 3
+    dataspace = decoded.body.dataspaces["0"]
+    assert isinstance(dataspace, RecordView)
+    assert dataspace.uri == "eml:///dataspace('a')"
+    assert dataspace.store_created == 2
+    assert decoded.body_model() == msg.body
+    # a view can be encoded again without validation
+    assert decoded.encode_message() == msg.encode_message()
+
+
+def test_lazy_decode_keeps_core_models():
+    msg = Message.get_object_message(Ping(current_date_time=42), msg_id=3)
+    decoded = Message.decode_binary_message(
+        msg.encode_message(),
+        ETPConnection.generic_transition_table,
+        lazy_validation=True,
+    )
+    assert isinstance(decoded.body, Ping)
+
+
+async def test_lazy_validation_connection():
+    connection = ETPConnection(lazy_validation=True)
+    connection.is_connected = True
+
+    delete_dataspaces = Message.get_object_message(
+        DeleteDataspaces(uris={"a": "b", "c": "d"}), msg_id=1
+    )
+    answer = []
+    async for m in connection.handle_bytes_generator(
+        delete_dataspaces.encode_message()
+    ):
+        answer.append(
+            Message.decode_binary_message(
+                m, ETPConnection.generic_transition_table
+            )
+        )
+
+    assert len(answer) == 1
+    assert isinstance(answer[0].body, DeleteDataspacesResponse)
+    assert list(answer[0].body.success.keys()) == ["a", "c"]
+
+
+def test_model_record_encoding_matches_dict_encoding():
+    body = PutDataArrays(
+        data_arrays={
+            "0": PutDataArraysType(
+                uid=DataArrayIdentifier(uri="eml:///", path_in_resource="/a"),
+                array=DataArray(
+                    dimensions=[3],
+                    data=AnyArray(item=ArrayOfDouble(values=[1.1, 2.2, 3.3])),
+                ),
+                custom_data={"k": DataValue(item=2)},
+            )
+        }
+    )
+    codec = get_codec_for_class(PutDataArrays)
+    assert codec.encode(as_avro_record(body)) == codec.encode(
+        body.dict(by_alias=True)
+    )
+
+
+def test_model_record_does_not_copy_values():
+    values = [1.0, 2.0]
+    array = DataArray(
+        dimensions=[2], data=AnyArray(item=ArrayOfDouble(values=values))
+    )
+    record = as_avro_record(array)
+    assert isinstance(record, ModelRecord)
+    assert record["dimensions"] is array.dimensions
+    assert record["data"]["item"][1]["values"] is array.data.item.values
+
+
+def test_numpy_is_not_used_by_default():
+    code = (
+        "import sys\n"
+        "from etptypes.energistics.etp.v12.protocol.core.ping import Ping\n"
+        "from etpproto.connection import ETPConnection\n"
+        "from etpproto.messages import Message\n"
+        "msg = Message.get_object_message(Ping(current_date_time=1), msg_id=2)\n"
+        "Message.decode_binary_message(\n"
+        "    msg.encode_message(), ETPConnection.generic_transition_table\n"
+        ")\n"
+        "print('numpy' in sys.modules)\n"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True
+    )
+    assert result.stdout.strip() == "False", result.stderr
+
+    msg = Message.get_object_message(
+        PutDataArrays(
+            data_arrays={
+                "a": PutDataArraysType(
+                    uid=DataArrayIdentifier(
+                        uri="eml:///", path_in_resource="/a"
+                    ),
+                    array=DataArray(
+                        dimensions=[2],
+                        data=AnyArray(item=ArrayOfDouble(values=[1.5, 2.5])),
+                    ),
+                )
+            }
+        ),
+        msg_id=2,
+    )
+    decoded = Message.decode_binary_message(
+        msg.encode_message(), ETPConnection.generic_transition_table
+    )
+    # the values are python lists : the models can be compared and serialized
+    assert decoded.body == msg.body
+    assert json.loads(decoded.body.json()) == json.loads(msg.body.json())
+
+
+def test_numpy_for_a_connection():
+    np = pytest.importorskip("numpy")
+    connection = ETPConnection(codec_registry=CodecRegistry(use_numpy=True))
+    msg = Message.get_object_message(
+        PutDataArrays(
+            data_arrays={
+                "a": PutDataArraysType(
+                    uid=DataArrayIdentifier(
+                        uri="eml:///", path_in_resource="/a"
+                    ),
+                    array=DataArray(
+                        dimensions=[2],
+                        data=AnyArray(item=ArrayOfDouble(values=[1.5, 2.5])),
+                    ),
+                )
+            }
+        ),
+        msg_id=2,
+    )
+    encoded = msg.encode_message()
+    assert msg.encode_message(connection.codec_registry) == encoded
+
+    values = connection.decode_message(encoded).body.data_arrays["a"]
+    assert isinstance(values.array.data.item.values, np.ndarray)
+    # the other connections still decode lists
+    assert not codec_registry.use_numpy
+    values = ETPConnection().decode_message(encoded).body.data_arrays["a"]
+    assert values.array.data.item.values == [1.5, 2.5]
+
+
+def test_max_header_size():
+    header = MessageHeader(
+        protocol=-(1 << 31),
+        message_type=-(1 << 31),
+        correlation_id=-(1 << 63),
+        message_id=-(1 << 63),
+        message_flags=-(1 << 31),
+    )
+    bio = BytesIO()
+    get_header_codec().write(bio, header_to_record(header))
+    assert len(bio.getvalue()) == MAX_HEADER_SIZE
@@ -0,0 +1,194 @@
+# Copyright (c) 2022-2023 Geosiris.
+# SPDX-License-Identifier: Apache-2.0
+
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from etptypes.energistics.etp.v12.protocol.core.acknowledge import Acknowledge
+
+from etpproto.client_info import ClientInfo
+from etpproto.compression import (
+    can_compress,
+    compress_message,
+    compressors,
+    decompress_body,
+    get_compressor,
+    negotiate_compression,
+)
+from etpproto.error import MaxSizeExceededError
+from etpproto.messages import MessageFlags
+
+try:
+    from .server_protocol_example import *
+except Exception:
+    from server_protocol_example import *
+
+
+get_resources_response = Message.get_object_message(
+    GetResourcesResponse(
+        resources=[
+            Resource(
+                uri=f"eml:///dataspace('a')/resqml20.obj_Grid2dRepresentation({i})",
+                name="Grid",
+                last_changed=0,
+                store_created=0,
+                store_last_write=0,
+                active_status=ActiveStatusKind.INACTIVE,
+                alternate_uris=[],
+                custom_data={},
+            )
+            for i in range(50)
+        ]
+    ),
+    msg_id=3,
+    correlation_id=1,
+    message_flags=MessageFlags.FINALPART,
+)
+
+
+def test_negotiate_compression():
+    assert negotiate_compression(["string"]) == ""
+    assert negotiate_compression(None) == ""
+    assert negotiate_compression(["GZIP"]) == "gzip"
+    assert negotiate_compression("gzip") == "gzip"
+    assert negotiate_compression(
+        ["gzip", "zstd"], preferred=["zstd", "gzip"]
+    ) == ("zstd" if "zstd" in compressors else "gzip")
+
+
+def test_client_info_compression_from_open_session():
+    client_info = ClientInfo()
+    client_info.set_compression("gzip")
+    assert client_info.compression == "gzip"
+    client_info.set_compression("string")
+    assert client_info.compression == ""
+
+
+@pytest.mark.parametrize("name", ["gzip", "zstd", "lz4"])
+def test_compressed_message_round_trip(name):
+    compressor = get_compressor(name)
+    if compressor is None:
+        pytest.skip(f"{name} is not installed")
+    encoded = get_resources_response.encode_message()
+    compressed = compress_message(encoded, compressor, threshold=100)
+    assert len(compressed) < len(encoded)
+
+    decoded = Message.decode_binary_message(
+        compressed, ETPConnection.generic_transition_table
+    )
+    assert decoded.is_msg_body_compressed()
+    assert decoded.body == get_resources_response.body
+    assert decoded.header.message_id == 3
+
+
+@pytest.mark.parametrize("name", ["gzip", "zstd", "lz4"])
+def test_decompressed_size_is_bounded(name):
+    compressor = get_compressor(name)
+    if compressor is None:
+        pytest.skip(f"{name} is not installed")
+    bomb = compressor.compress(bytes(10_000_000))
+    assert len(bomb) < 100_000
+    with pytest.raises(MaxSizeExceededError):
+        decompress_body(bomb, 1_000_000)
+    assert decompress_body(bomb, 10_000_000) == bytes(10_000_000)
+
+    encoded = get_resources_response.encode_message()
+    compressed = compress_message(encoded, compressor)
+    with pytest.raises(MaxSizeExceededError):
+        Message.decode_binary_message(
+            compressed,
+            ETPConnection.generic_transition_table,
+            max_decompressed_size=len(encoded) // 2,
+        )
+
+
+def test_compression_threshold_and_excluded_messages():
+    gzip = get_compressor("gzip")
+    encoded = get_resources_response.encode_message()
+    assert compress_message(encoded, gzip, threshold=len(encoded)) == encoded
+
+    ack = Message.get_object_message(Acknowledge(), msg_id=5).encode_message()
+    assert compress_message(ack, gzip) == ack
+    assert not can_compress(0, 1)  # RequestSession
+    assert not can_compress(0, 2)  # OpenSession
+    assert not can_compress(4, 1000)  # ProtocolException
+    assert can_compress(0, 8)  # Ping
+
+
+def test_decode_unknown_compression():
+    header = get_resources_response.header.copy()
+    header.message_flags |= MessageFlags.COMPRESSED
+    not_compressed = Message(header, get_resources_response.body)
+    assert (
+        Message.decode_binary_message(
+            not_compressed.encode_message(),
+            ETPConnection.generic_transition_table,
+        )
+        is None
+    )
+
+
+@pytest.mark.asyncio
+async def test_connection_compresses_answers():
+    connection = ETPConnection(compression_threshold=10)
+    connection.is_connected = True
+    connection.client_info.set_compression("gzip")
+
+    answer = []
+    async for m in connection.handle_bytes_generator(
+        Message.get_object_message(GetDataspaces(), msg_id=1).encode_message()
+    ):
+        answer.append(
+            Message.decode_binary_message(
+                m, ETPConnection.generic_transition_table
+            )
+        )
+    assert len(answer) == 1
+    assert answer[0].is_msg_body_compressed()
+    assert isinstance(answer[0].body, GetDataspacesResponse)
+    assert len(answer[0].body.dataspaces) == 2
+    # other connections are not compressed
+    assert ETPConnection().client_info.compression == ""
+
+
+@pytest.mark.asyncio
+async def test_connection_refuses_large_decompressed_body():
+    encoded = get_resources_response.encode_message()
+    compressed = compress_message(encoded, get_compressor("gzip"))
+
+    async def answer(connection):
+        connection.is_connected = True
+        return [
+            Message.decode_binary_message(
+                m, ETPConnection.generic_transition_table
+            )
+            async for m in connection.handle_bytes_generator(compressed)
+        ]
+
+    # the payload size limits the compressed message, not its body
+    connection = ETPConnection()
+    connection.client_info.endpoint_capabilities[
+        "MaxWebSocketMessagePayloadSize"
+    ] = len(compressed)
+    assert len(encoded) > len(compressed)
+    assert isinstance(
+        connection.decode_message(compressed).body, GetResourcesResponse
+    )
+
+    (refused,) = await answer(
+        ETPConnection(max_decompressed_size=len(encoded) // 2)
+    )
+    assert refused.body.error.code == MaxSizeExceededError.code
+
+
+def test_zstd_from_several_threads():
+    zstd = get_compressor("zstd")
+    if zstd is None:
+        pytest.skip("zstd is not installed")
+    bodies = [bytes([i]) * 100_000 + bytes(range(256)) for i in range(32)]
+
+    def round_trip(body):
+        return decompress_body(zstd.compress(body)) == body
+
+    with ThreadPoolExecutor(8) as executor:
+        assert all(executor.map(round_trip, bodies * 4))
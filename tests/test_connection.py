@@ -1,6 +1,10 @@
 # Copyright (c) 2022-2023 Geosiris.
 # SPDX-License-Identifier: Apache-2.0
 
+import asyncio
+import threading
+from typing import List
+
 import pytest
 from etptypes.energistics.etp.v12.datatypes.object.context_info import (
     ContextInfo,
@@ -15,11 +19,22 @@ from etptypes.energistics.etp.v12.protocol.core.acknowledge import Acknowledge
 from etptypes.energistics.etp.v12.protocol.core.protocol_exception import (
     ProtocolException,
 )
+from etptypes.energistics.etp.v12.protocol.transaction.start_transaction import (
+    StartTransaction,
+)
+from etptypes.energistics.etp.v12.protocol.transaction.start_transaction_response import (
+    StartTransactionResponse,
+)
 
+from etpproto.connection import HandlerRegistry, HandlerScope
 from etpproto.error import (
     InvalidMessageError,
     InvalidStateError,
+    LimitExceededError,
+    MultipartCancelledError,
 )
+from etpproto.messages import ChunkReassembler, ResponseBuilder
+from etpproto.protocols.transaction import TransactionHandler
 
 try:
     from .server_protocol_example import *
@@ -422,6 +437,462 @@ async def test_connection_requestSession_answer_as_bytes_generator_acknowledge()
     assert isinstance(answer[1].body, OpenSession)
 
 
+@pytest.mark.asyncio
+async def test_connection_multipart_byte_budget() -> None:
+    sender = ETPConnection(connection_type=ConnectionType.SERVER)
+    connection = ETPConnection(
+        connection_type=ConnectionType.CLIENT, max_multipart_bytes=100
+    )
+    connection.is_connected = True
+    dataObjectResponse_msg.set_final_msg(True)
+
+    answer = []
+    for part in dataObjectResponse_msg.encode_message_generator(500, sender):
+        async for m in connection.handle_bytes_generator(part):
+            answer.append(
+                Message.decode_binary_message(
+                    m, ETPConnection.generic_transition_table
+                )
+            )
+
+    assert len(answer) == 1
+    assert isinstance(answer[0].body, ProtocolException)
+    assert answer[0].body.error.code == LimitExceededError.code
+    assert answer[0].header.correlation_id == 2
+    assert len(connection.chunk_reassembler) == 0
+
+
+@pytest.mark.asyncio
+async def test_connection_evicts_multipart_on_any_message() -> None:
+    now = [0.0]
+    sender = ETPConnection(connection_type=ConnectionType.SERVER)
+    connection = ETPConnection(
+        connection_type=ConnectionType.CLIENT,
+        chunk_reassembler=ChunkReassembler(clock=lambda: now[0]),
+    )
+    connection.is_connected = True
+    dataObjectResponse_msg.set_final_msg(True)
+    first_part = next(
+        dataObjectResponse_msg.encode_message_generator(500, sender)
+    )
+    async for m in connection.handle_bytes_generator(first_part):
+        pass
+    assert len(connection.chunk_reassembler) == 1
+
+    # the peer stops sending the parts, and sends another message
+    now[0] = ChunkReassembler.DEFAULT_TIMEOUT_PERIOD + 1
+    answer = []
+    async for m in connection.handle_bytes_generator(
+        Message.get_object_message(GetDataspaces(), msg_id=4).encode_message()
+    ):
+        answer.append(
+            Message.decode_binary_message(
+                m, ETPConnection.generic_transition_table
+            )
+        )
+    assert len(connection.chunk_reassembler) == 0
+    assert answer[0].body.error.code == MultipartCancelledError.code
+    assert answer[0].header.correlation_id == 2
+
+
+class CountingDataspaceHandler(DataspaceHandler):
+    """Keeps a per-instance state, without lock"""
+
+    def __init__(self, prefix: str = "dataspace") -> None:
+        self.prefix = prefix
+        self.count = 0
+
+    async def on_get_dataspaces(
+        self,
+        msg: GetDataspaces,
+        msg_header: MessageHeader,
+        client_info: Union[None, ClientInfo] = None,
+    ) -> AsyncGenerator[Optional[Message], None]:
+        self.count += 1
+        yield Message.get_object_message(
+            GetDataspacesResponse(
+                dataspaces=[
+                    Dataspace(
+                        uri=f"{self.prefix}-{self.count}",
+                        store_last_write=0,
+                        store_created=0,
+                    )
+                ]
+            ),
+            correlation_id=msg_header.message_id,
+        )
+
+
+async def _get_dataspace_uris(connection: ETPConnection) -> List[str]:
+    connection.is_connected = True
+    answer = []
+    async for m in connection.handle_bytes_generator(
+        Message.get_object_message(GetDataspaces(), msg_id=1).encode_message()
+    ):
+        answer.append(
+            Message.decode_binary_message(
+                m, ETPConnection.generic_transition_table
+            )
+        )
+    return [d.uri for a in answer for d in a.body.dataspaces]
+
+
+@pytest.mark.asyncio
+async def test_handler_registry_per_connection() -> None:
+    registry = HandlerRegistry()
+    registry.on(CommunicationProtocol.DATASPACE)(CountingDataspaceHandler)
+
+    connection_a = ETPConnection(handler_registry=registry)
+    connection_b = ETPConnection(handler_registry=registry)
+    assert await _get_dataspace_uris(connection_a) == ["dataspace-1"]
+    assert await _get_dataspace_uris(connection_a) == ["dataspace-2"]
+    assert await _get_dataspace_uris(connection_b) == ["dataspace-1"]
+    # only the registered protocols are supported
+    assert connection_a.get_handler(CommunicationProtocol.STORE) is None
+    assert [p.protocol for p in registry.get_supported_protocol_list()] == [
+        CommunicationProtocol.DATASPACE.value
+    ]
+    # the connections without registry keep the handlers of ETPConnection.on
+    assert (
+        ETPConnection().get_handler(CommunicationProtocol.DATASPACE)
+        is ETPConnection.transition_table[CommunicationProtocol.DATASPACE]
+    )
+
+
+@pytest.mark.asyncio
+async def test_handler_registry_scopes() -> None:
+    registry = HandlerRegistry()
+    registry.register(
+        CommunicationProtocol.DATASPACE,
+        lambda: CountingDataspaceHandler("replica"),
+        HandlerScope.SHARED,
+    )
+    registry.register(
+        CommunicationProtocol.STORE, myStoreProtocol, HandlerScope.WORKER
+    )
+    primary = HandlerRegistry()
+    primary.register(
+        CommunicationProtocol.DATASPACE,
+        lambda: CountingDataspaceHandler("primary"),
+    )
+
+    connection_a = ETPConnection(handler_registry=registry)
+    connection_b = ETPConnection(handler_registry=registry)
+    connection_c = ETPConnection(handler_registry=primary)
+    assert connection_a.handlers == connection_b.handlers
+    assert await _get_dataspace_uris(connection_a) == ["replica-1"]
+    assert await _get_dataspace_uris(connection_b) == ["replica-2"]
+    assert await _get_dataspace_uris(connection_c) == ["primary-1"]
+
+    other_worker = []
+    thread = threading.Thread(
+        target=lambda: other_worker.append(
+            ETPConnection(handler_registry=registry)
+        )
+    )
+    thread.start()
+    thread.join()
+    assert (
+        other_worker[0].handlers[CommunicationProtocol.DATASPACE]
+        is connection_a.handlers[CommunicationProtocol.DATASPACE]
+    )
+    assert (
+        other_worker[0].handlers[CommunicationProtocol.STORE]
+        is not connection_a.handlers[CommunicationProtocol.STORE]
+    )
+
+
+class SlowDataspaceHandler(DataspaceHandler):
+    def __init__(self) -> None:
+        self.running = 0
+        self.max_running = 0
+
+    async def on_get_dataspaces(
+        self,
+        msg: GetDataspaces,
+        msg_header: MessageHeader,
+        client_info: Union[None, ClientInfo] = None,
+    ) -> AsyncGenerator[Optional[Message], None]:
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        await asyncio.sleep(0.01)
+        self.running -= 1
+        yield Message.get_object_message(
+            GetDataspacesResponse(dataspaces=[]),
+            correlation_id=msg_header.message_id,
+        )
+
+
+@pytest.mark.asyncio
+async def test_handle_bytes_batch() -> None:
+    registry = HandlerRegistry()
+    registry.register(CommunicationProtocol.CORE, myCoreProtocol)
+    registry.register(CommunicationProtocol.DATASPACE, SlowDataspaceHandler)
+    connection = ETPConnection(handler_registry=registry)
+    handler = connection.get_handler(CommunicationProtocol.DATASPACE)
+
+    frames = [requestSession_msg.encode_message()] + [
+        Message.get_object_message(
+            GetDataspaces(), msg_id=10 + 2 * i
+        ).encode_message()
+        for i in range(8)
+    ]
+    answer = [
+        Message.decode_binary_message(
+            m, ETPConnection.generic_transition_table
+        )
+        for m in await connection.handle_bytes_batch(frames, max_concurrency=4)
+    ]
+
+    assert connection.is_connected
+    assert isinstance(answer[0].body, OpenSession)
+    assert all(isinstance(a.body, GetDataspacesResponse) for a in answer[1:])
+    assert sorted(a.header.correlation_id for a in answer[1:]) == [
+        10 + 2 * i for i in range(8)
+    ]
+    ids = [a.header.message_id for a in answer]
+    assert ids == sorted(ids)
+    assert handler.max_running == 4
+
+
+class InterleavedDataspaceHandler(DataspaceHandler):
+    async def on_get_dataspaces(
+        self,
+        msg: GetDataspaces,
+        msg_header: MessageHeader,
+        client_info: Union[None, ClientInfo] = None,
+    ) -> AsyncGenerator[Optional[Message], None]:
+        # the last requests answer first, and all the answers are interleaved
+        for part in range(3):
+            await asyncio.sleep(0.001 * (100 - msg_header.message_id))
+            yield Message.get_object_message(
+                GetDataspacesResponse(dataspaces=[]),
+                correlation_id=msg_header.message_id,
+            )
+
+
+@pytest.mark.asyncio
+async def test_handle_bytes_batch_in_request_order() -> None:
+    registry = HandlerRegistry()
+    registry.register(
+        CommunicationProtocol.DATASPACE, InterleavedDataspaceHandler
+    )
+    connection = ETPConnection(handler_registry=registry)
+    connection.is_connected = True
+
+    frames = [
+        Message.get_object_message(
+            GetDataspaces(), msg_id=10 + 2 * i
+        ).encode_message()
+        for i in range(4)
+    ]
+    answer = [
+        Message.decode_binary_message(
+            m, ETPConnection.generic_transition_table
+        )
+        for m in await connection.handle_bytes_batch(frames)
+    ]
+    assert [a.header.correlation_id for a in answer] == [
+        10 + 2 * (i // 3) for i in range(12)
+    ]
+    ids = [a.header.message_id for a in answer]
+    assert ids == sorted(ids) and len(set(ids)) == 12
+    assert all(isinstance(a.body, GetDataspacesResponse) for a in answer)
+
+
+def _drain(queue: asyncio.Queue) -> List[Message]:
+    answer = []
+    while not queue.empty():
+        answer.append(
+            Message.decode_binary_message(
+                queue.get_nowait(), ETPConnection.generic_transition_table
+            )
+        )
+    return answer
+
+
+@pytest.mark.asyncio
+async def test_concurrent_handling_does_not_block_ping() -> None:
+    registry = HandlerRegistry()
+    registry.register(CommunicationProtocol.CORE, myCoreProtocol)
+    registry.register(CommunicationProtocol.DATASPACE, SlowDataspaceHandler)
+    connection = ETPConnection(
+        handler_registry=registry,
+        concurrent_handling=True,
+        max_concurrent_requests=2,
+    )
+    connection.is_connected = True
+
+    for i in range(3):
+        await connection.submit_bytes(
+            Message.get_object_message(
+                GetDataspaces(), msg_id=10 + 2 * i
+            ).encode_message()
+        )
+    await connection.submit_bytes(
+        Message.get_object_message(
+            Ping(current_date_time=0), msg_id=20
+        ).encode_message()
+    )
+    # the Ping is answered while the GetDataspaces are handled
+    answer = _drain(connection.outbound_queue)
+    assert len(answer) == 1
+    assert isinstance(answer[0].body, Pong)
+    assert answer[0].header.correlation_id == 20
+
+    await connection.wait_pending_requests()
+    answer = _drain(connection.outbound_queue)
+    assert sorted(a.header.correlation_id for a in answer) == [10, 12, 14]
+    assert all(a.is_final_msg() for a in answer)
+    ids = [a.header.message_id for a in answer]
+    assert ids == sorted(ids)
+    handler = connection.get_handler(CommunicationProtocol.DATASPACE)
+    assert handler.max_running == 2
+
+
+class SlowTransactionHandler(TransactionHandler):
+    def __init__(self) -> None:
+        self.started = []
+
+    async def on_start_transaction(
+        self,
+        msg: StartTransaction,
+        msg_header: MessageHeader,
+        client_info: Union[None, ClientInfo] = None,
+    ) -> AsyncGenerator[Optional[Message], None]:
+        self.started.append(msg_header.message_id)
+        await asyncio.sleep(0.02 if msg_header.message_id == 10 else 0)
+        yield Message.get_object_message(
+            StartTransactionResponse(transaction_uuid=uuid.uuid4().bytes),
+            correlation_id=msg_header.message_id,
+        )
+
+
+@pytest.mark.asyncio
+async def test_concurrent_handling_serialized_protocol() -> None:
+    registry = HandlerRegistry()
+    registry.register(
+        CommunicationProtocol.TRANSACTION, SlowTransactionHandler
+    )
+    connection = ETPConnection(
+        handler_registry=registry, concurrent_handling=True
+    )
+    connection.is_connected = True
+
+    for msg_id in (10, 12, 14):
+        await connection.submit_bytes(
+            Message.get_object_message(
+                StartTransaction(read_only=True), msg_id=msg_id
+            ).encode_message()
+        )
+    await connection.wait_pending_requests()
+
+    handler = connection.get_handler(CommunicationProtocol.TRANSACTION)
+    assert handler.started == [10, 12, 14]
+    answer = _drain(connection.outbound_queue)
+    assert [a.header.correlation_id for a in answer] == [10, 12, 14]
+
+
+class StreamingDataspaceHandler(DataspaceHandler):
+    def __init__(self, nb_dataspaces: int) -> None:
+        self.nb_dataspaces = nb_dataspaces
+        self.produced = 0
+
+    async def dataspaces(self):
+        for i in range(self.nb_dataspaces):
+            self.produced += 1
+            await asyncio.sleep(0)
+            yield Dataspace(
+                uri=f"eml:///dataspace('{i}')",
+                store_last_write=0,
+                store_created=0,
+            )
+
+    async def on_get_dataspaces(
+        self,
+        msg: GetDataspaces,
+        msg_header: MessageHeader,
+        client_info: Union[None, ClientInfo] = None,
+    ) -> AsyncGenerator[Optional[Message], None]:
+        yield ResponseBuilder(
+            GetDataspacesResponse(dataspaces=[]),
+            "dataspaces",
+            self.dataspaces(),
+            correlation_id=msg_header.message_id,
+        )
+
+
+@pytest.mark.asyncio
+async def test_response_builder_streams_values() -> None:
+    registry = HandlerRegistry()
+    registry.register(
+        CommunicationProtocol.DATASPACE,
+        lambda: StreamingDataspaceHandler(200),
+    )
+    connection = ETPConnection(handler_registry=registry)
+    connection.is_connected = True
+    connection.client_info.endpoint_capabilities[
+        "MaxWebSocketMessagePayloadSize"
+    ] = 1000
+    handler = connection.get_handler(CommunicationProtocol.DATASPACE)
+
+    answer = []
+    produced = []
+    async for m in connection.handle_bytes_generator(
+        Message.get_object_message(GetDataspaces(), msg_id=10).encode_message()
+    ):
+        assert len(m) <= 1000
+        produced.append(handler.produced)
+        answer.append(
+            Message.decode_binary_message(
+                m, ETPConnection.generic_transition_table
+            )
+        )
+
+    assert len(answer) > 1
+    # the first messages are sent before all the values are produced
+    assert produced[0] < 200
+    assert [d.uri for a in answer for d in a.body.dataspaces] == [
+        f"eml:///dataspace('{i}')" for i in range(200)
+    ]
+    assert all(a.header.correlation_id == 10 for a in answer)
+    assert all(a.is_multipart_msg() for a in answer)
+    assert [a.is_final_msg() for a in answer] == [False] * (
+        len(answer) - 1
+    ) + [True]
+    ids = [a.header.message_id for a in answer]
+    assert ids == sorted(set(ids))
+
+
+@pytest.mark.asyncio
+async def test_response_builder_single_message_and_error() -> None:
+    connection = ETPConnection()
+    builder = ResponseBuilder(
+        GetDataspacesResponse(dataspaces=[]), "dataspaces", [], 10
+    )
+    answer = [m async for m in builder.messages(1000, connection)]
+    assert len(answer) == 1
+    assert answer[0].is_final_msg() and not answer[0].is_multipart_msg()
+    assert answer[0].body.dataspaces == []
+
+    def failing_values():
+        yield Dataspace(uri="eml:///", store_last_write=0, store_created=0)
+        raise InvalidStateError()
+
+    builder = ResponseBuilder(
+        GetDataspacesResponse(dataspaces=[]),
+        "dataspaces",
+        failing_values(),
+        10,
+    )
+    answer = [m async for m in builder.messages(1000, connection)]
+    assert len(answer) == 1
+    assert isinstance(answer[0].body, ProtocolException)
+    assert answer[0].body.error.code == InvalidStateError.code
+    assert answer[0].header.correlation_id == 10
+    assert answer[0].is_final_msg()
+
+
 if __name__ == "__main__":
     # asyncio.run(test_send_msg_without_connection_generator())
     # asyncio.run(test_connection_requestSession_answer_as_bytes_generator())
@@ -0,0 +1,280 @@
+# Copyright (c) 2022-2023 Geosiris.
+# SPDX-License-Identifier: Apache-2.0
+
+import mmap
+
+import pytest
+from etptypes.energistics.etp.v12.datatypes.data_array_types.data_array_identifier import (
+    DataArrayIdentifier,
+)
+from etptypes.energistics.etp.v12.datatypes.data_array_types.get_data_subarrays_type import (
+    GetDataSubarraysType,
+)
+from etptypes.energistics.etp.v12.datatypes.data_array_types.put_data_subarrays_type import (
+    PutDataSubarraysType,
+)
+from etptypes.energistics.etp.v12.datatypes.data_array_types.put_uninitialized_data_array_type import (
+    PutUninitializedDataArrayType,
+)
+from etptypes.energistics.etp.v12.protocol.core.protocol_exception import (
+    ProtocolException,
+)
+from etptypes.energistics.etp.v12.protocol.data_array.get_data_subarrays import (
+    GetDataSubarrays,
+)
+from etptypes.energistics.etp.v12.protocol.data_array.put_data_subarrays import (
+    PutDataSubarrays,
+)
+from etptypes.energistics.etp.v12.protocol.data_array.put_data_subarrays_response import (
+    PutDataSubarraysResponse,
+)
+from etptypes.energistics.etp.v12.protocol.data_array.put_uninitialized_data_arrays import (
+    PutUninitializedDataArrays,
+)
+
+from etpproto.connection import CommunicationProtocol, ETPConnection
+from etpproto.error import (
+    InternalError,
+    InvalidArgumentError,
+    NotFoundError,
+    NotSupportedError,
+)
+from etpproto.mapped_arrays import (
+    MappedArray,
+    MappedDataArrayHandler,
+    iter_put_data_subarrays,
+)
+from etpproto.messages import Message
+from etpproto.numpy_codec import to_any_array
+from etpproto.subarrays import data_array_metadata
+
+np = pytest.importorskip("numpy")
+
+# the arrays of the DataArray messages are decoded to numpy arrays
+pytestmark = pytest.mark.usefixtures("numpy_codecs")
+
+MAX_PAYLOAD_SIZE = 8192
+
+values = np.arange(120 * 50, dtype=np.int64).reshape(120, 50) * 3 - 1000
+
+
+def _uid(path: str) -> DataArrayIdentifier:
+    return DataArrayIdentifier(
+        uri="eml:///dataspace('a')", path_in_resource=path
+    )
+
+
+def _store_connection(directory) -> ETPConnection:
+    class FileStore(MappedDataArrayHandler):
+        def array_path(self, uid, client_info=None):
+            return str(directory / f"{uid.path_in_resource.strip('/')}.npy")
+
+    connection = ETPConnection(
+        handlers={CommunicationProtocol.DATA_ARRAY: FileStore()}
+    )
+    connection.is_connected = True
+    connection.client_info.endpoint_capabilities[
+        "MaxWebSocketMessagePayloadSize"
+    ] = MAX_PAYLOAD_SIZE
+    return connection
+
+
+async def _send(connection: ETPConnection, body, msg_id: int):
+    answer = []
+    msg = Message.get_object_message(body, msg_id=msg_id)
+    for msg_part in connection.encode_message_generator(msg):
+        assert len(msg_part) <= MAX_PAYLOAD_SIZE
+        async for m in connection.handle_bytes_generator(msg_part):
+            answer.append(
+                Message.decode_binary_message(
+                    m, ETPConnection.generic_transition_table
+                )
+            )
+    return answer
+
+
+async def _upload(connection, uid, source, **kwargs) -> int:
+    answer = await _send(
+        connection,
+        PutUninitializedDataArrays(
+            data_arrays={
+                "0": PutUninitializedDataArrayType(
+                    uid=uid, metadata=data_array_metadata(np.int64, (120, 50))
+                )
+            }
+        ),
+        msg_id=2,
+    )
+    assert answer[0].body.success == {"0": ""}
+    nb_messages = 0
+    for i, body in enumerate(
+        iter_put_data_subarrays(uid, source, MAX_PAYLOAD_SIZE, **kwargs)
+    ):
+        answer = await _send(connection, body, msg_id=4 + 2 * i)
+        assert isinstance(answer[0].body, PutDataSubarraysResponse)
+        assert list(answer[0].body.success) == list(body.data_subarrays)
+        nb_messages += 1
+    return nb_messages
+
+
+@pytest.mark.asyncio
+async def test_stream_npy_file_to_store(tmp_path):
+    source = tmp_path / "source.npy"
+    np.save(source, values)
+    store = _store_connection(tmp_path)
+
+    nb_messages = await _upload(store, _uid("/grid"), str(source))
+    assert nb_messages > 1
+    assert np.array_equal(np.load(tmp_path / "grid.npy"), values)
+
+    # the store answers from the file
+    answer = await _send(
+        store,
+        GetDataSubarrays(
+            data_subarrays={
+                "0": GetDataSubarraysType(
+                    uid=_uid("/grid"), starts=[10, 5], counts=[2, 3]
+                )
+            }
+        ),
+        msg_id=100,
+    )
+    assert answer[0].body.data_subarrays["0"].data.item.values.tolist() == (
+        values[10:12, 5:8].ravel().tolist()
+    )
+
+
+@pytest.mark.asyncio
+async def test_stream_raw_mmap_to_store(tmp_path):
+    source = tmp_path / "source.raw"
+    source.write_bytes(b"\0" * 16 + values.tobytes())
+    store = _store_connection(tmp_path)
+    with open(source, "rb") as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    await _upload(
+        store,
+        _uid("/raw"),
+        buffer,
+        dtype=np.int64,
+        shape=(120, 50),
+        offset=16,
+    )
+    assert np.array_equal(np.load(tmp_path / "raw.npy"), values)
+
+
+@pytest.mark.asyncio
+async def test_put_data_subarrays_errors(tmp_path):
+    store = _store_connection(tmp_path)
+    MappedArray.create(tmp_path / "grid.npy", np.int64, (120, 50)).close()
+    answer = await _send(
+        store,
+        PutDataSubarrays(
+            data_subarrays={
+                "ok": PutDataSubarraysType(
+                    uid=_uid("/grid"),
+                    data=to_any_array(np.array([1, 2])),
+                    starts=[119, 48],
+                    counts=[1, 2],
+                ),
+                "outside": PutDataSubarraysType(
+                    uid=_uid("/grid"),
+                    data=to_any_array(np.array([1, 2])),
+                    starts=[119, 49],
+                    counts=[1, 2],
+                ),
+                "none": PutDataSubarraysType(
+                    uid=_uid("/none"),
+                    data=to_any_array(np.array([1])),
+                    starts=[0],
+                    counts=[1],
+                ),
+            }
+        ),
+        msg_id=2,
+    )
+    assert answer[0].body.success == {"ok": ""}
+    assert isinstance(answer[1].body, ProtocolException)
+    assert answer[1].body.errors["outside"].code == InvalidArgumentError.code
+    assert answer[1].body.errors["none"].code == NotFoundError.code
+    assert np.load(tmp_path / "grid.npy")[119, 48:].tolist() == [1, 2]
+
+
+@pytest.mark.asyncio
+async def test_put_uninitialized_data_arrays_os_error(tmp_path):
+    store = _store_connection(tmp_path)
+    answer = await _send(
+        store,
+        PutUninitializedDataArrays(
+            data_arrays={
+                key: PutUninitializedDataArrayType(
+                    uid=_uid(path),
+                    metadata=data_array_metadata(np.int64, (2, 3)),
+                )
+                for key, path in [("ok", "/a"), ("no_dir", "/missing/a")]
+            }
+        ),
+        msg_id=2,
+    )
+    assert answer[0].body.success == {"ok": ""}
+    assert isinstance(answer[1].body, ProtocolException)
+    assert answer[1].body.errors["no_dir"].code == InternalError.code
+
+
+def test_iter_put_data_subarrays_without_limit(tmp_path):
+    source = tmp_path / "source.npy"
+    np.save(source, np.arange(100, dtype=np.float64))
+    for max_payload_size in (-1, 0, None):
+        (body,) = iter_put_data_subarrays(_uid("/a"), source, max_payload_size)
+        (subarray,) = body.data_subarrays.values()
+        assert subarray.starts == [0] and subarray.counts == [100]
+
+    np.save(source, np.arange(100, dtype=np.uint64))
+    for max_payload_size in (-1, MAX_PAYLOAD_SIZE):
+        with pytest.raises(NotSupportedError):
+            next(iter_put_data_subarrays(_uid("/a"), source, max_payload_size))
+
+
+def test_mapped_array(tmp_path):
+    array = MappedArray.create(tmp_path / "a.npy", np.float32, (4, 3))
+    array.write([1, 1], [2, 2], [1.0, 2.0, 3.0, 4.0])
+    assert array.read([1, 1], [1, 2]).tolist() == [[1.0, 2.0]]
+    with pytest.raises(ValueError):
+        array.write([0, 0], [1, 2], [1.0])
+    array.close()
+    assert np.load(tmp_path / "a.npy").tolist() == [
+        [0, 0, 0],
+        [0, 1, 2],
+        [0, 3, 4],
+        [0, 0, 0],
+    ]
+    with pytest.raises(ValueError):
+        MappedArray.open(tmp_path / "a.npy", dtype=np.float32)
+
+
+def test_iter_put_data_subarrays_closes_its_file(tmp_path, monkeypatch):
+    closed = []
+    close = MappedArray.close
+
+    def recording_close(self):
+        closed.append(self)
+        close(self)
+
+    monkeypatch.setattr(MappedArray, "close", recording_close)
+    source = tmp_path / "source.npy"
+    np.save(source, values)
+
+    bodies = iter_put_data_subarrays(_uid("/a"), source, MAX_PAYLOAD_SIZE)
+    assert len([body for body in bodies]) > 1
+    assert len(closed) == 1 and closed[0].buffer.closed
+    # stopped before the end
+    bodies = iter_put_data_subarrays(_uid("/a"), source, MAX_PAYLOAD_SIZE)
+    next(bodies)
+    bodies.close()
+    assert len(closed) == 2
+
+    # the arrays of the caller are not closed
+    array = MappedArray.open(source)
+    for _ in iter_put_data_subarrays(_uid("/a"), array, MAX_PAYLOAD_SIZE):
+        pass
+    assert len(closed) == 2
+    array.close()
@@ -3,6 +3,7 @@
 
 import asyncio
 import json
+import zlib
 from copy import deepcopy
 from io import BytesIO
 from math import ceil
@@ -40,13 +41,22 @@ from etptypes.energistics.etp.v12.protocol.store.get_data_objects_response impor
 )
 from fastavro import schemaless_reader, schemaless_writer
 
+from etpproto.codec import get_header_codec, long_size
+from etpproto.compression import Compressor
 from etpproto.error import (
     ETPError,
     InvalidMessageError,
+    LimitExceededError,
     UnsupportedProtocolError,
     MaxSizeExceededError,
 )
-from etpproto.messages import Message, MessageFlags
+from etpproto.messages import (
+    ChunkReassembler,
+    EncodedBody,
+    Message,
+    MessageFlags,
+    chunk_payload_size,
+)
 
 # try:
 from .server_protocol_example import *
@@ -255,10 +265,12 @@ def test_msg_multipart_map_split_in_2_parts_and_chunks():
     assert len(dataObjectResponse_msg.body.data_objects) == 2
     size_limit = 500
 
-    nb_chunks = ceil(
-        len(resqml_obj_37166c33_3ebb_40ae_9bc6_1ab9693def60)
-        / (size_limit - 50)
-    )  # 50 is the size limit security (see message.py)
+    # header of the chunks : 5 bytes (small ids), blobId and final flag : 17 bytes
+    payload_size = chunk_payload_size(size_limit - 5 - 17)
+    nb_chunks = [
+        ceil(len(do.data) / payload_size)
+        for do in dataObjectResponse_msg.body.data_objects.values()
+    ]
 
     connection_client = ETPConnection(connection_type=ConnectionType.CLIENT)
     dataObjectResponse_msg.set_final_msg(True)
@@ -274,9 +286,9 @@ def test_msg_multipart_map_split_in_2_parts_and_chunks():
             )
         )
 
-    assert len(decoded_partial_msg_list) == nb_data_objects * (
-        1 + nb_chunks
-    )  # 1 GetDataObjectResponse and 4 chunks for each dataObject, so 10
+    assert len(decoded_partial_msg_list) == nb_data_objects + sum(
+        nb_chunks
+    )  # 1 GetDataObjectResponse and its chunks for each dataObject
 
     chunk_total_size = 0
 
@@ -290,7 +302,7 @@ def test_msg_multipart_map_split_in_2_parts_and_chunks():
                 == decoded_partial_msg_list[0].header.message_id
             )
 
-        if i == 0 or i == int(len(decoded_partial_msg_list) / 2):
+        if i == 0 or i == 1 + nb_chunks[0]:
             assert isinstance(decoded_k.body, GetDataObjectsResponse)
             # print(">>", list(decoded_k.body.data_objects.values())[0].resource.uri)
             assert len(decoded_k.body.data_objects) == 1
@@ -326,10 +338,11 @@ def test_msg_multipart_chunks_reassembled_in_connection():
     connection_client = ETPConnection(connection_type=ConnectionType.CLIENT)
     dataObjectResponse_msg.set_final_msg(True)
 
-    nb_chunks = ceil(
-        len(resqml_obj_37166c33_3ebb_40ae_9bc6_1ab9693def60)
-        / (size_limit - 50)
-    )  # 50 is the size limit security (see message.py)
+    payload_size = chunk_payload_size(size_limit - 5 - 17)
+    nb_chunks = [
+        ceil(len(do.data) / payload_size)
+        for do in dataObjectResponse_msg.body.data_objects.values()
+    ]
 
     decoded_partial_msg_list = []
     for part in dataObjectResponse_msg.encode_message_generator(
@@ -342,7 +355,7 @@ def test_msg_multipart_chunks_reassembled_in_connection():
             )
         )
 
-    assert len(decoded_partial_msg_list) == nb_data_objects * (1 + nb_chunks)
+    assert len(decoded_partial_msg_list) == nb_data_objects + sum(nb_chunks)
 
     for msg in decoded_partial_msg_list:
         assert msg.is_chunk_msg() or msg.is_chunk_msg_referencer()
@@ -355,6 +368,276 @@ def test_msg_multipart_chunks_reassembled_in_connection():
         assert dataObjectResponse_msg.body.data_objects[idx].data == do.data
 
 
+def test_msg_chunks_are_encoded_lazily():
+    size_limit = 500
+    connection_client = ETPConnection(connection_type=ConnectionType.CLIENT)
+    original = deepcopy(dataObjectResponse_msg.body.data_objects)
+
+    parts = dataObjectResponse_msg.encode_message_generator(
+        size_limit, connection_client
+    )
+    referencer = Message.decode_binary_message(
+        next(parts), ETPConnection.generic_transition_table
+    )
+    assert referencer.is_chunk_msg_referencer()
+    key, referencer_do = list(referencer.body.data_objects.items())[0]
+
+    first_chunk = Message.decode_binary_message(
+        next(parts), ETPConnection.generic_transition_table
+    )
+    assert first_chunk.is_chunk_msg()
+    assert first_chunk.header.correlation_id == referencer.header.message_id
+    assert first_chunk.body.blob_id == referencer_do.blob_id
+    assert not first_chunk.body.final
+    chunk_data = first_chunk.body.data
+    assert 0 < len(chunk_data) < size_limit
+    assert original[key].data.startswith(chunk_data)
+    parts.close()
+
+    # the data objects of the original message are not modified
+    assert dataObjectResponse_msg.body.data_objects == original
+
+
+def test_msg_chunks_fill_frames():
+    size_limit = 4096
+    data = bytes(range(256)) * 400
+    data_object = dataObjectResponse_msg.body.data_objects["0"]
+    msg = Message.get_object_message(
+        GetDataObjectsResponse(
+            data_objects={"0": data_object.copy(update={"data": data})}
+        ),
+        msg_id=40,
+        message_flags=MessageFlags.FINALPART,
+    )
+    connection_client = ETPConnection(connection_type=ConnectionType.CLIENT)
+
+    parts = list(msg.encode_message_generator(size_limit, connection_client))
+    chunk_parts = parts[1:]
+    assert all(len(part) <= size_limit for part in parts)
+    # no empty chunk : the data is sent in the minimal number of frames
+    assert len(chunk_parts) == ceil(
+        len(data) / chunk_payload_size(size_limit - 5 - 17)
+    )
+    # every chunk but the last one fills its frame
+    assert all(len(part) == size_limit for part in chunk_parts[:-1])
+    assert len(data) / (size_limit * len(chunk_parts[:-1])) > 0.99
+
+    decoded = [
+        Message.decode_binary_message(
+            part, ETPConnection.generic_transition_table
+        )
+        for part in parts
+    ]
+    assert b"".join(m.body.data for m in decoded[1:]) == data
+    assert [m.body.final for m in decoded[1:]] == [False] * (
+        len(chunk_parts) - 1
+    ) + [True]
+    assert [m.is_final_msg() for m in decoded] == [False] * (
+        len(parts) - 1
+    ) + [True]
+
+
+def test_chunk_payload_size():
+    for available in range(0, 70000, 7):
+        payload = chunk_payload_size(available)
+        assert payload + long_size(payload) <= available or payload == 0
+        assert payload + 1 + long_size(payload + 1) > available
+
+
+def test_chunk_reassembler_is_incremental():
+    size_limit = 500
+    connection_client = ETPConnection(connection_type=ConnectionType.CLIENT)
+    dataObjectResponse_msg.set_final_msg(True)
+
+    parts = [
+        Message.decode_binary_message(
+            part, ETPConnection.generic_transition_table
+        )
+        for part in dataObjectResponse_msg.encode_message_generator(
+            size_limit, connection_client
+        )
+    ]
+
+    reassembler = ChunkReassembler()
+    for part in parts[:-1]:
+        reassembler.add(7, part)
+    assert 7 in reassembler
+    # chunk messages are not kept, only their data
+    assert reassembler._messages[7].referencer is parts[0]
+    blob_id = parts[1].body.blob_id
+    assert bytes(reassembler._messages[7].blobs[blob_id]) == b"".join(
+        p.body.data
+        for p in parts
+        if p.is_chunk_msg() and p.body.blob_id == blob_id
+    )
+
+    reassembler.add(7, parts[-1])
+    result = reassembler.pop(7)
+    assert 7 not in reassembler
+    assert len(reassembler) == 0
+    for idx, do in result.body.data_objects.items():
+        assert do.blob_id is None
+        assert dataObjectResponse_msg.body.data_objects[idx].data == do.data
+
+
+def test_chunk_reassembler_does_not_encode_received_referencers(
+    monkeypatch,
+):
+    connection_client = ETPConnection(connection_type=ConnectionType.CLIENT)
+    dataObjectResponse_msg.set_final_msg(True)
+    frames = list(
+        dataObjectResponse_msg.encode_message_generator(500, connection_client)
+    )
+    parts = [
+        Message.decode_binary_message(
+            frame, ETPConnection.generic_transition_table
+        )
+        for frame in frames
+    ]
+    assert [p.encoded_size for p in parts] == [len(f) for f in frames]
+
+    def encode_message(self, registry=None):
+        raise AssertionError("the referencer is encoded again")
+
+    monkeypatch.setattr(Message, "encode_message", encode_message)
+    reassembler = ChunkReassembler()
+    for part in parts:
+        reassembler.add(7, part)
+    assert reassembler.size == sum(
+        len(p.body.data) if p.is_chunk_msg() else len(frame)
+        for p, frame in zip(parts, frames)
+    )
+    assert reassembler.pop(7) is not None
+
+
+def test_chunk_reassembler_missing_chunks():
+    connection_client = ETPConnection(connection_type=ConnectionType.CLIENT)
+    dataObjectResponse_msg.set_final_msg(True)
+
+    parts = [
+        Message.decode_binary_message(
+            part, ETPConnection.generic_transition_table
+        )
+        for part in dataObjectResponse_msg.encode_message_generator(
+            500, connection_client
+        )
+    ]
+    reassembler = ChunkReassembler()
+    for part in parts:
+        if not part.is_chunk_msg():
+            reassembler.add(1, part)
+    assert reassembler.pop(1) is None
+    assert reassembler.pop(2) is None
+
+
+def test_chunk_reassembler_empty_data_object():
+    blob_id = bytes(range(16))
+    data_object = dataObjectResponse_msg.body.data_objects["1"]
+    referencer = Message.get_object_message(
+        GetDataObjectsResponse(
+            data_objects={
+                "1": data_object.copy(update={"blob_id": blob_id, "data": b""})
+            }
+        ),
+        msg_id=1,
+        message_flags=MessageFlags.MULTIPART,
+    )
+    chunk = Message.get_object_message(
+        store_chunk.Chunk(blob_id=blob_id, data=b"", final=True),
+        msg_id=2,
+        correlation_id=1,
+        message_flags=MessageFlags.MULTIPART_AND_FINALPART,
+    )
+    reassembler = ChunkReassembler()
+    for part in (referencer, chunk):
+        reassembler.add(
+            1,
+            Message.decode_binary_message(
+                part.encode_message(), ETPConnection.generic_transition_table
+            ),
+        )
+    result = reassembler.pop(1)
+    assert result.body.data_objects["1"].data == b""
+    assert result.body.data_objects["1"].blob_id is None
+
+
+def _chunked_parts(size_limit=500):
+    connection_client = ETPConnection(connection_type=ConnectionType.CLIENT)
+    dataObjectResponse_msg.set_final_msg(True)
+    return [
+        Message.decode_binary_message(
+            part, ETPConnection.generic_transition_table
+        )
+        for part in dataObjectResponse_msg.encode_message_generator(
+            size_limit, connection_client
+        )
+    ]
+
+
+def test_chunk_reassembler_timeout():
+    now = [0.0]
+    parts = _chunked_parts()
+    reassembler = ChunkReassembler(timeout_period=60, clock=lambda: now[0])
+    reassembler.add(1, parts[0])
+    now[0] = 30.0
+    reassembler.add(2, parts[0])
+    assert reassembler.evict_expired() == []
+
+    now[0] = 61.0
+    assert reassembler.evict_expired() == [1]
+    assert 1 not in reassembler
+    assert 2 in reassembler
+    # next parts of an expired message are ignored
+    assert not reassembler.add(1, parts[1])
+    assert not reassembler.add(1, parts[-1])
+    assert reassembler.add(1, parts[0])
+
+
+def test_chunk_reassembler_limits():
+    parts = _chunked_parts()
+    reassembler = ChunkReassembler(max_concurrent_multipart=1)
+    reassembler.add(1, parts[0])
+    with pytest.raises(LimitExceededError):
+        reassembler.add(2, parts[0])
+    assert not reassembler.add(2, parts[1])
+    assert reassembler.add(1, parts[1])
+
+    # the referencer messages are counted with the chunks
+    referencer_size = len(parts[0].encode_message())
+    reassembler = ChunkReassembler(
+        max_bytes=referencer_size + len(parts[1].body.data)
+    )
+    assert reassembler.add(1, parts[0])
+    assert reassembler.size == referencer_size
+    assert reassembler.add(1, parts[1])
+    assert reassembler.size == referencer_size + len(parts[1].body.data)
+    with pytest.raises(LimitExceededError):
+        reassembler.add(1, parts[2])
+    assert 1 not in reassembler
+    assert reassembler.size == 0
+    reassembler = ChunkReassembler(max_bytes=referencer_size - 1)
+    with pytest.raises(LimitExceededError):
+        reassembler.add(1, parts[0])
+
+
+def test_chunk_reassembler_default_limits():
+    parts = _chunked_parts()
+    reassembler = ChunkReassembler()
+    assert reassembler.max_concurrent_multipart is not None
+    assert reassembler.timeout_period is not None
+    assert reassembler.max_bytes is not None
+
+    # the ids of the cancelled messages are bounded, even without timeout
+    reassembler = ChunkReassembler(
+        max_concurrent_multipart=0, timeout_period=None
+    )
+    for cache_id in range(ChunkReassembler.MAX_CANCELLED + 10):
+        with pytest.raises(LimitExceededError):
+            reassembler.add(cache_id, parts[0])
+    assert len(reassembler._cancelled) == ChunkReassembler.MAX_CANCELLED
+    assert 0 not in reassembler._cancelled
+
+
 # @pytest.mark.asyncio
 def test_msg_multipart_chunks_reassembled_in_connection_get_ressources():
     size_limit = 500
@@ -375,3 +658,151 @@ def test_msg_multipart_chunks_reassembled_in_connection_get_ressources():
 
 # if __name__ == "__main__":
 #     asyncio.run(test_connection_multipart_msg_one_part_answer_generator())
+
+
+def test_msg_plural_split_packs_items_greedily():
+    resources = [
+        ressourceResponse_msg.body.resources[0].copy(
+            update={"name": f"resource-{i}"}
+        )
+        for i in range(200)
+    ]
+    msg = Message.get_object_message(
+        GetResourcesResponse(resources=resources),
+        msg_id=5,
+        correlation_id=3,
+        message_flags=MessageFlags.FINALPART,
+    )
+    size_limit = 2000
+    connection_server = ETPConnection(connection_type=ConnectionType.SERVER)
+
+    parts = list(msg.encode_message_generator(size_limit, connection_server))
+    decoded = [
+        Message.decode_binary_message(
+            p, ETPConnection.generic_transition_table
+        )
+        for p in parts
+    ]
+
+    item_size = len(resources[0].json())  # upper bound of the avro size
+    assert len(parts) > 1
+    assert all(len(p) <= size_limit for p in parts)
+    # greedy packing : every part but the last one can not take the next item
+    for p in parts[:-1]:
+        assert len(p) + item_size > size_limit
+
+    assert [r.name for d in decoded for r in d.body.resources] == [
+        r.name for r in resources
+    ]
+    assert all(d.is_multipart_msg() for d in decoded)
+    assert [d.is_final_msg() for d in decoded] == [False] * (
+        len(decoded) - 1
+    ) + [True]
+    assert all(d.header.correlation_id == 3 for d in decoded)
+    assert decoded[0].header.message_id == 5
+    ids = [d.header.message_id for d in decoded[1:]]
+    assert ids == sorted(ids) and len(set(ids)) == len(ids)
+    # the original message is not modified
+    assert len(msg.body.resources) == 200
+    assert msg.is_final_msg() and not msg.is_multipart_msg()
+
+
+def test_msg_plural_split_request_correlation():
+    msg = Message.get_object_message(
+        GetResourcesResponse(resources=ressourceResponse_msg.body.resources),
+        msg_id=4,
+    )
+    connection_client = ETPConnection(connection_type=ConnectionType.CLIENT)
+    decoded = [
+        Message.decode_binary_message(
+            p, ETPConnection.generic_transition_table
+        )
+        for p in msg.encode_message_generator(500, connection_client)
+    ]
+    assert len(decoded) > 1
+    assert decoded[0].header.correlation_id == 0
+    assert all(d.header.correlation_id == 4 for d in decoded[1:])
+
+
+def test_encoded_body_new_headers():
+    body = ressourceResponse_msg.body
+    encoded = EncodedBody.from_model(body)
+    for msg_id, correlation_id in [(7, 3), (1 << 40, 0)]:
+        assert encoded.encode_message(msg_id, correlation_id) == (
+            Message.get_object_message(
+                body,
+                msg_id=msg_id,
+                correlation_id=correlation_id,
+                message_flags=MessageFlags.FINALPART,
+            ).encode_message()
+        )
+
+    # without the model, the body is decoded if needed
+    decoded = Message(
+        ressourceResponse_msg.header,
+        EncodedBody(GetResourcesResponse, encoded.data),
+    ).body_model()
+    assert decoded == body
+
+
+def test_encoded_body_sent_by_connection():
+    nb_compressions = []
+
+    def compress(data):
+        nb_compressions.append(len(data))
+        return zlib.compress(data)
+
+    counting = Compressor("counting", b"\x78", compress, zlib.decompress)
+    encoded = EncodedBody.from_model(ressourceResponse_msg.body)
+    connection = ETPConnection(connection_type=ConnectionType.SERVER)
+    connection.client_info.endpoint_capabilities[
+        "MaxWebSocketMessagePayloadSize"
+    ] = 100000
+    frames = []
+    for correlation_id in (2, 4):
+        msg = Message.get_object_message(
+            encoded,
+            msg_id=connection.consume_msg_id(),
+            correlation_id=correlation_id,
+            message_flags=MessageFlags.FINALPART,
+        )
+        assert msg.body_class() is GetResourcesResponse
+        frames.extend(connection.encode_message_generator(msg))
+    decoded = [
+        Message.decode_binary_message(
+            frame, ETPConnection.generic_transition_table
+        )
+        for frame in frames
+    ]
+    assert [d.header.correlation_id for d in decoded] == [2, 4]
+    assert decoded[1].body == ressourceResponse_msg.body
+
+    # the body is compressed once
+    frames = [
+        encoded.encode_message(msg_id, 0, compressor=counting)
+        for msg_id in (1, 3)
+    ]
+    assert len(nb_compressions) == 1
+    # same body, after the protocol, messageType, correlationId and messageId
+    assert frames[0][4:] == frames[1][4:]
+    header = get_header_codec().read(BytesIO(frames[0]))
+    assert header["messageFlags"] & MessageFlags.COMPRESSED
+
+    # a message larger than the max payload size is split from the model
+    connection.client_info.endpoint_capabilities[
+        "MaxWebSocketMessagePayloadSize"
+    ] = 1000
+    parts = list(
+        connection.encode_message_generator(
+            Message.get_object_message(encoded, msg_id=2)
+        )
+    )
+    assert len(parts) > 1 and all(len(p) <= 1000 for p in parts)
+    assert sum(
+        len(
+            Message.decode_binary_message(
+                p, ETPConnection.generic_transition_table
+            ).body.resources
+        )
+        for p in parts
+    ) == len(ressourceResponse_msg.body.resources)
@@ -0,0 +1,208 @@
+# Copyright (c) 2022-2023 Geosiris.
+# SPDX-License-Identifier: Apache-2.0
+
+from io import BytesIO
+
+import pytest
+from etptypes.energistics.etp.v12.datatypes.any_array import AnyArray
+from etptypes.energistics.etp.v12.datatypes.array_of_boolean import (
+    ArrayOfBoolean,
+)
+from etptypes.energistics.etp.v12.datatypes.array_of_double import (
+    ArrayOfDouble,
+)
+from etptypes.energistics.etp.v12.datatypes.array_of_float import ArrayOfFloat
+from etptypes.energistics.etp.v12.datatypes.array_of_int import ArrayOfInt
+from etptypes.energistics.etp.v12.datatypes.array_of_long import ArrayOfLong
+from etptypes.energistics.etp.v12.datatypes.array_of_string import (
+    ArrayOfString,
+)
+from etptypes.energistics.etp.v12.datatypes.data_array_types.data_array import (
+    DataArray,
+)
+from etptypes.energistics.etp.v12.datatypes.data_array_types.data_array_identifier import (
+    DataArrayIdentifier,
+)
+from etptypes.energistics.etp.v12.datatypes.data_array_types.put_data_arrays_type import (
+    PutDataArraysType,
+)
+from etptypes.energistics.etp.v12.datatypes.data_value import DataValue
+from etptypes.energistics.etp.v12.protocol.data_array.get_data_arrays_response import (
+    GetDataArraysResponse,
+)
+from etptypes.energistics.etp.v12.protocol.data_array.put_data_arrays import (
+    PutDataArrays,
+)
+
+from etpproto.codec import (
+    CodecRegistry,
+    MessageCodec,
+    as_avro_record,
+    get_codec_for_class,
+)
+from etpproto.connection import ETPConnection
+from etpproto.error import NotSupportedError
+from etpproto.messages import Message
+from etpproto.numpy_codec import (
+    NumpyMessageCodec,
+    decode_varints,
+    encode_varints,
+    read_array,
+    to_any_array,
+    to_numpy,
+)
+
+np = pytest.importorskip("numpy")
+
+# the arrays of the DataArray messages are decoded to numpy arrays
+pytestmark = pytest.mark.usefixtures("numpy_codecs")
+
+LONGS = [0, -1, 1, 63, 64, -64, -65, 2**31, -(2**63), 2**63 - 1]
+
+
+def _data_array(item) -> DataArray:
+    return DataArray(dimensions=[len(item.values)], data=AnyArray(item=item))
+
+
+put_data_arrays = PutDataArrays(
+    data_arrays={
+        str(i): PutDataArraysType(
+            uid=DataArrayIdentifier(
+                uri="eml:///dataspace('a')", path_in_resource=f"/{i}"
+            ),
+            array=_data_array(item),
+            custom_data={"scale": DataValue(item=1.5)},
+        )
+        for i, item in enumerate(
+            [
+                ArrayOfBoolean(values=[True, False, True]),
+                ArrayOfInt(values=[0, -1, 2**31 - 1, -(2**31)]),
+                ArrayOfLong(values=LONGS),
+                ArrayOfFloat(values=[1.5, -2.25]),
+                ArrayOfDouble(values=[1e300, -0.5, 3.0]),
+                ArrayOfString(values=["a", "bc"]),
+            ]
+        )
+    }
+)
+
+
+def test_numpy_codec_same_encoding_as_fastavro():
+    codec = get_codec_for_class(PutDataArrays)
+    assert isinstance(codec, NumpyMessageCodec)
+    fastavro_codec = MessageCodec.from_class(PutDataArrays)
+
+    record = as_avro_record(put_data_arrays)
+    encoded = fastavro_codec.encode(record)
+    assert codec.encode(record) == encoded
+
+    decoded = codec.read(BytesIO(encoded))
+    expected = fastavro_codec.read(BytesIO(encoded))
+    for key, data_array in expected["dataArrays"].items():
+        name, values = data_array["array"]["data"]["item"]
+        decoded_name, decoded_values = decoded["dataArrays"][key]["array"][
+            "data"
+        ]["item"]
+        assert decoded_name == name
+        if name.endswith("ArrayOfString"):
+            assert decoded_values == values
+        else:
+            assert isinstance(decoded_values["values"], np.ndarray)
+            assert decoded_values["values"].tolist() == values["values"]
+        assert (
+            decoded["dataArrays"][key]["customData"]
+            == data_array["customData"]
+        )
+
+
+def test_numpy_arrays_in_messages():
+    values = np.linspace(0.0, 1.0, 10000)
+    msg = Message.get_object_message(
+        GetDataArraysResponse.construct(
+            data_arrays={
+                "grid": DataArray.construct(
+                    dimensions=[100, 100], data=to_any_array(values)
+                ),
+                "ids": DataArray.construct(
+                    dimensions=[3],
+                    data=to_any_array(np.array([1, -2, 3], dtype=np.int32)),
+                ),
+            }
+        ),
+        msg_id=2,
+        correlation_id=1,
+    )
+    decoded = Message.decode_binary_message(
+        msg.encode_message(), ETPConnection.generic_transition_table
+    )
+
+    grid = decoded.body.data_arrays["grid"].data
+    assert isinstance(grid.item, ArrayOfDouble)
+    assert isinstance(grid.item.values, np.ndarray)
+    assert np.array_equal(to_numpy(grid), values)
+    ids = decoded.body.data_arrays["ids"].data
+    assert isinstance(ids.item, ArrayOfInt)
+    assert ids.item.values.dtype == np.int32
+    assert ids.item.values.tolist() == [1, -2, 3]
+
+
+def test_to_numpy_from_lists():
+    assert to_numpy(AnyArray(item=ArrayOfFloat(values=[1.5]))).dtype == (
+        np.float32
+    )
+    assert to_numpy(AnyArray(item=b"\x01\x02")).tolist() == [1, 2]
+    for values in (["a"], [1 << 63], [None]):
+        with pytest.raises(NotSupportedError):
+            to_any_array(np.array(values))
+
+
+@pytest.mark.parametrize("views", [False, True])
+def test_numpy_views(views):
+    codec = CodecRegistry(use_numpy=True, numpy_views=views).for_class(
+        GetDataArraysResponse
+    )
+    values = np.linspace(0.0, 1.0, 100)
+    encoded = codec.encode(
+        as_avro_record(
+            GetDataArraysResponse.construct(
+                data_arrays={
+                    "a": DataArray.construct(
+                        dimensions=[100], data=to_any_array(values)
+                    )
+                }
+            )
+        )
+    )
+    decoded = codec.read(BytesIO(encoded))["dataArrays"]["a"]["data"]
+    decoded_values = decoded["item"][1]["values"]
+    assert decoded_values.tolist() == values.tolist()
+    # the views are read-only, the copies can be changed
+    assert decoded_values.flags.writeable is not views
+
+
+def test_varints():
+    fastavro_codec = MessageCodec.from_class(ArrayOfLong)
+    encoded = fastavro_codec.encode({"values": LONGS})
+    # count, values, end of the array
+    assert encoded[1:-1] == encode_varints(LONGS)
+    values, pos = decode_varints(encoded, 1, len(LONGS))
+    assert values.tolist() == LONGS
+    assert pos == len(encoded) - 1
+    with pytest.raises(EOFError):
+        decode_varints(encoded[:-3], 1, len(LONGS))
+
+
+def test_read_array_blocks():
+    # 2 blocks : the second one has a negative count followed by its size in bytes
+    buffer = (
+        b"\x04"
+        + np.array([1.0, 2.0]).tobytes()
+        + b"\x01\x10"
+        + np.array([3.0]).tobytes()
+        + b"\x00"
+    )
+    values, pos = read_array(buffer, 0, "double")
+    assert values.tolist() == [1.0, 2.0, 3.0]
+    assert pos == len(buffer)
+    values, pos = read_array(b"\x00", 0, "long")
+    assert len(values) == 0 and pos == 1
@@ -0,0 +1,195 @@
+# Copyright (c) 2022-2023 Geosiris.
+# SPDX-License-Identifier: Apache-2.0
+
+import asyncio
+from typing import AsyncGenerator, Optional, Union
+
+import pytest
+from etptypes.energistics.etp.v12.datatypes.message_header import MessageHeader
+from etptypes.energistics.etp.v12.datatypes.object.dataspace import Dataspace
+from etptypes.energistics.etp.v12.protocol.core.protocol_exception import (
+    ProtocolException,
+)
+from etptypes.energistics.etp.v12.protocol.dataspace.get_dataspaces import (
+    GetDataspaces,
+)
+from etptypes.energistics.etp.v12.protocol.dataspace.get_dataspaces_response import (
+    GetDataspacesResponse,
+)
+
+from etpproto.client_info import ClientInfo
+from etpproto.connection import CommunicationProtocol, ETPConnection
+from etpproto.error import (
+    BackPressureLimitExceededError,
+    BackPressureWarningError,
+)
+from etpproto.messages import Message, ResponseBuilder
+from etpproto.outbound import OutboundQueue
+from etpproto.protocols.dataspace import DataspaceHandler
+
+
+def test_watermarks_and_limits():
+    errors = []
+
+    def on_back_pressure(error):
+        errors.append(type(error))
+        return [b"!"]
+
+    queue = OutboundQueue(max_bytes=1000, on_back_pressure=on_back_pressure)
+    for _ in range(7):
+        queue.put_nowait(b"x" * 100)
+    assert queue.is_writable() and errors == []
+    # above 750 bytes
+    queue.put_nowait(b"x" * 100)
+    assert not queue.is_writable()
+    assert errors == [BackPressureWarningError]
+    assert queue.qsize() == 9 and queue.nbytes == 801
+
+    with pytest.raises(BackPressureLimitExceededError):
+        queue.put_nowait(b"x" * 200)
+    queue.put_nowait(b"x" * 200, force=True)
+    assert errors == [BackPressureWarningError, BackPressureLimitExceededError]
+
+    # drained below 250 bytes
+    while queue.nbytes > 250:
+        queue.get_nowait()
+    assert queue.is_writable()
+    assert queue.stats.peak_bytes == 1002
+    assert queue.stats.messages == 9
+    assert queue.stats.warnings == 1 and queue.stats.refused == 1
+
+    # a message larger than the queue does not suspend the producers
+    with pytest.raises(BackPressureLimitExceededError):
+        queue.put_nowait(b"x" * 2000)
+    assert queue.is_writable()
+
+    with pytest.raises(ValueError):
+        OutboundQueue(high_watermark=0.2, low_watermark=0.5)
+
+
+@pytest.mark.asyncio
+async def test_put_waits_until_drained():
+    queue = OutboundQueue(max_messages=4)
+    for i in range(4):
+        await queue.put(bytes([i]))
+    blocked = asyncio.ensure_future(queue.put(b"\x04"))
+    await asyncio.sleep(0.01)
+    assert not blocked.done()
+    assert [await queue.get() for _ in range(3)] == [b"\0", b"\1", b"\2"]
+    await blocked
+    assert queue.stats.suspensions == 1 and queue.stats.suspended_time > 0
+
+
+class ManyDataspacesHandler(DataspaceHandler):
+    def __init__(self) -> None:
+        self.produced = 0
+
+    async def dataspaces(self):
+        for i in range(500):
+            self.produced += 1
+            yield Dataspace(
+                uri=f"eml:///dataspace('{i}')",
+                store_last_write=0,
+                store_created=0,
+            )
+
+    async def on_get_dataspaces(
+        self,
+        msg: GetDataspaces,
+        msg_header: MessageHeader,
+        client_info: Union[None, ClientInfo] = None,
+    ) -> AsyncGenerator[Optional[Message], None]:
+        yield ResponseBuilder(
+            GetDataspacesResponse(dataspaces=[]),
+            "dataspaces",
+            self.dataspaces(),
+            correlation_id=msg_header.message_id,
+        )
+
+
+@pytest.mark.asyncio
+async def test_slow_consumer_suspends_handler():
+    handler = ManyDataspacesHandler()
+    connection = ETPConnection(
+        handlers={CommunicationProtocol.DATASPACE: handler},
+        max_outbound_messages=8,
+    )
+    connection.is_connected = True
+    connection.client_info.endpoint_capabilities[
+        "MaxWebSocketMessagePayloadSize"
+    ] = 1000
+
+    request = asyncio.ensure_future(
+        connection.submit_bytes(
+            Message.get_object_message(
+                GetDataspaces(), msg_id=2
+            ).encode_message()
+        )
+    )
+    await asyncio.sleep(0.01)
+    queue = connection.outbound_queue
+    assert not request.done()
+    # the warning and 6 messages (above the high watermark : 0.75 * 8)
+    assert queue.qsize() == 8 and handler.produced < 500
+
+    answer = []
+    while not request.done() or not queue.empty():
+        frame = await asyncio.wait_for(queue.get(), 1)
+        answer.append(
+            Message.decode_binary_message(
+                frame, ETPConnection.generic_transition_table
+            )
+        )
+    assert handler.produced == 500
+    warnings = [a for a in answer if isinstance(a.body, ProtocolException)]
+    assert len(warnings) == queue.stats.warnings > 1
+    assert warnings[0].body.error.code == BackPressureWarningError.code
+    assert (
+        sum(
+            len(a.body.dataspaces)
+            for a in answer
+            if isinstance(a.body, GetDataspacesResponse)
+        )
+        == 500
+    )
+    ids = [a.header.message_id for a in answer]
+    assert ids == sorted(ids)
+
+
+@pytest.mark.asyncio
+async def test_answers_wait_for_a_writable_queue():
+    handler = ManyDataspacesHandler()
+    connection = ETPConnection(
+        handlers={CommunicationProtocol.DATASPACE: handler},
+        max_outbound_messages=8,
+        concurrent_handling=True,
+    )
+    connection.is_connected = True
+    queue = connection.outbound_queue
+    while queue.is_writable():
+        queue.put_nowait(b"x")
+    size = queue.qsize()
+
+    for msg_id in range(2, 22, 2):
+        await connection.submit_bytes(
+            Message.get_object_message(
+                GetDataspaces(), msg_id=msg_id
+            ).encode_message()
+        )
+    await asyncio.sleep(0.01)
+    # no answer is produced while the queue is above its high watermark
+    assert queue.qsize() == size and handler.produced == 0
+
+    answer = []
+    while len(connection._pending_tasks) > 0 or not queue.empty():
+        frame = await asyncio.wait_for(queue.get(), 1)
+        assert queue.qsize() < 8 + connection.max_concurrent_requests
+        if frame != b"x":
+            answer.append(
+                Message.decode_binary_message(
+                    frame, ETPConnection.generic_transition_table
+                )
+            )
+    assert handler.produced == 5000
+    ids = [a.header.message_id for a in answer]
+    assert ids == sorted(ids)
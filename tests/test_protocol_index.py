@@ -0,0 +1,83 @@
+# Copyright (c) 2022-2023 Geosiris.
+# SPDX-License-Identifier: Apache-2.0
+
+import json
+
+import pytest
+from etptypes.energistics.etp.v12.protocol.core.ping import Ping
+
+from etpproto.connection import ETPConnection
+from etpproto.protocol_index import (
+    INDEX_PATH,
+    ProtocolTable,
+    load_protocol_index,
+    scan_protocol_classes,
+    write_protocol_index,
+)
+from etpproto.utils import (
+    get_all_etp_protocol_classes,
+    get_class_from_protocol_and_name,
+)
+
+
+def _flatten(table):
+    return {
+        (protocol, message_type): table[protocol][message_type]
+        for protocol in table
+        for message_type in table[protocol]
+    }
+
+
+def test_protocol_table_matches_all_classes():
+    assert _flatten(ProtocolTable()) == _flatten(
+        get_all_etp_protocol_classes()
+    )
+
+
+def test_protocol_table_is_lazy():
+    table = ProtocolTable()
+    assert table._protocols is None
+    assert table[0][8] is Ping
+    assert table["0"]["8"] is Ping
+    assert list(table["0"]._classes) == ["8"]
+    assert len(table["3"]._classes) == 0
+
+
+def test_find_class_by_name_is_lazy():
+    table = ProtocolTable()
+    assert get_class_from_protocol_and_name("0", "ping", table) is Ping
+    assert list(table["0"]._classes) == ["8"]
+    chunk = get_class_from_protocol_and_name("4", "Chunk", table)
+    assert chunk.__name__ == "Chunk"
+    assert len(table["4"]._classes) == 1
+    assert get_class_from_protocol_and_name("4", "Ping", table) is None
+    assert get_class_from_protocol_and_name("99", "Ping", table) is None
+
+
+def test_connection_uses_protocol_table():
+    assert isinstance(ETPConnection.generic_transition_table, ProtocolTable)
+
+
+def test_shipped_index_is_up_to_date():
+    index = load_protocol_index()
+    if index is None:
+        pytest.skip("protocol_index.json is for another etptypes version")
+    assert index == scan_protocol_classes()
+
+
+def test_protocol_index_version_guard(tmp_path):
+    path = str(tmp_path / "index.json")
+    index = write_protocol_index(path)
+    assert load_protocol_index(path) == index
+
+    with open(path) as f:
+        content = json.load(f)
+    content["etptypes_version"] = "0.0.0"
+    content["protocols"] = {}
+    with open(path, "w") as f:
+        json.dump(content, f)
+    assert load_protocol_index(path) is None
+    # the table falls back to a scan of etptypes
+    assert ProtocolTable(path)[0][8] is Ping
+    assert load_protocol_index(str(tmp_path / "missing.json")) is None
+    assert INDEX_PATH.endswith("protocol_index.json")
@@ -35,10 +35,18 @@ from etptypes.energistics.etp.v12.datatypes.object.context_scope_kind import (
 from etptypes.energistics.etp.v12.datatypes.object.relationship_kind import (
     RelationshipKind,
 )
+from etptypes.energistics.etp.v12.protocol.core.ping import Ping
 from etptypes.energistics.etp.v12.protocol.discovery_query.find_resources import (
     FindResources,
 )
 
+from etpproto.error import InvalidMessageTypeError
+from etpproto.utils import (
+    _handler_functions,
+    get_handler_method,
+    handler_method_name,
+)
+
 try:
     from .server_protocol_example import *
 except Exception:
@@ -924,3 +932,24 @@ async def test_on_replace_parts_by_range():
 
     assert len(answer) == 1
     assert isinstance(answer[0].body, ReplacePartsByRangeResponse)
+
+
+def test_handler_method_is_resolved_once() -> None:
+    handler = ETPConnection.transition_table[CommunicationProtocol.DATASPACE]
+    method = get_handler_method(handler, GetDataspaces)
+    assert method.__func__ is type(handler).on_get_dataspaces
+    assert method.__self__ is handler
+    assert (type(handler), GetDataspaces) in _handler_functions
+    assert handler_method_name(GetDataspaces) == "on_get_dataspaces"
+    assert get_handler_method(handler, Ping) is None
+
+
+@pytest.mark.asyncio
+async def test_handler_unknown_message() -> None:
+    handler = ETPConnection.transition_table[CommunicationProtocol.DATASPACE]
+    msg = Message.get_object_message(Ping(current_date_time=0), msg_id=1)
+    with pytest.raises(InvalidMessageTypeError):
+        async for _ in handler.handle_message(
+            etp_object=msg.body, msg_header=msg.header
+        ):
+            pass
@@ -0,0 +1,345 @@
+# Copyright (c) 2022-2023 Geosiris.
+# SPDX-License-Identifier: Apache-2.0
+
+import asyncio
+from typing import List
+
+import pytest
+from etptypes.energistics.etp.v12.datatypes.any_array_type import (
+    AnyArrayType,
+)
+from etptypes.energistics.etp.v12.datatypes.any_logical_array_type import (
+    AnyLogicalArrayType,
+)
+from etptypes.energistics.etp.v12.datatypes.data_array_types.data_array import (
+    DataArray,
+)
+from etptypes.energistics.etp.v12.datatypes.data_array_types.data_array_identifier import (
+    DataArrayIdentifier,
+)
+from etptypes.energistics.etp.v12.datatypes.data_array_types.data_array_metadata import (
+    DataArrayMetadata,
+)
+from etptypes.energistics.etp.v12.protocol.core.protocol_exception import (
+    ProtocolException,
+)
+from etptypes.energistics.etp.v12.protocol.data_array.get_data_array_metadata import (
+    GetDataArrayMetadata,
+)
+from etptypes.energistics.etp.v12.protocol.data_array.get_data_arrays import (
+    GetDataArrays,
+)
+from etptypes.energistics.etp.v12.protocol.data_array.get_data_arrays_response import (
+    GetDataArraysResponse,
+)
+from etptypes.energistics.etp.v12.protocol.data_array.get_data_subarrays_response import (
+    GetDataSubarraysResponse,
+)
+
+from etpproto.connection import (
+    CommunicationProtocol,
+    ConnectionType,
+    ETPConnection,
+    HandlerRegistry,
+)
+from etpproto.error import (
+    MaxSizeExceededError,
+    NotFoundError,
+    NotSupportedError,
+)
+from etpproto.messages import EncodedBody, Message
+from etpproto.numpy_codec import to_any_array
+from etpproto.subarrays import (
+    SubarrayAssembler,
+    SubarrayFetcher,
+    SubarrayFetchError,
+    TiledDataArrayHandler,
+    iter_tiles,
+    tile_counts,
+    tile_overhead,
+)
+
+np = pytest.importorskip("numpy")
+
+# the arrays of the DataArray messages are decoded to numpy arrays
+pytestmark = pytest.mark.usefixtures("numpy_codecs")
+
+MAX_PAYLOAD_SIZE = 16384
+
+grid = np.arange(300 * 200, dtype=np.float64).reshape(300, 200) / 7
+small = np.arange(10, dtype=np.int32)
+
+
+class GridStore(TiledDataArrayHandler):
+    async def get_array(self, uid, client_info=None):
+        arrays = {
+            "/grid": grid,
+            "/small": small,
+            "/words": np.array(["a", "b"]),
+            "/uint64": np.arange(3, dtype=np.uint64),
+        }
+        if uid.path_in_resource not in arrays:
+            raise NotFoundError()
+        return arrays[uid.path_in_resource]
+
+
+def _uid(path: str) -> DataArrayIdentifier:
+    return DataArrayIdentifier(
+        uri="eml:///dataspace('a')", path_in_resource=path
+    )
+
+
+def _store_connection() -> ETPConnection:
+    registry = HandlerRegistry()
+    registry.register(CommunicationProtocol.DATA_ARRAY, GridStore)
+    connection = ETPConnection(handler_registry=registry)
+    connection.is_connected = True
+    connection.client_info.endpoint_capabilities[
+        "MaxWebSocketMessagePayloadSize"
+    ] = MAX_PAYLOAD_SIZE
+    return connection
+
+
+async def _ask(connection: ETPConnection, body, msg_id: int) -> List[Message]:
+    answer = []
+    async for m in connection.handle_bytes_generator(
+        Message.get_object_message(body, msg_id=msg_id).encode_message()
+    ):
+        assert len(m) <= MAX_PAYLOAD_SIZE
+        answer.append(
+            Message.decode_binary_message(
+                m, ETPConnection.generic_transition_table
+            )
+        )
+    return answer
+
+
+def test_tiles():
+    counts = tile_counts([300, 200], 8, MAX_PAYLOAD_SIZE)
+    assert counts == [(MAX_PAYLOAD_SIZE - tile_overhead(2)) // 8 // 200, 200]
+    tiles = list(iter_tiles([5, 3], [2, 3]))
+    assert tiles == [([0, 0], [2, 3]), ([2, 0], [2, 3]), ([4, 0], [1, 3])]
+    # tiles smaller than a row
+    assert tile_counts([4, 1000000], 8, MAX_PAYLOAD_SIZE) == [
+        1,
+        (MAX_PAYLOAD_SIZE - tile_overhead(2)) // 8,
+    ]
+    assert list(iter_tiles([0, 3], [1, 3])) == []
+
+
+def test_tile_overhead_bounds_the_messages():
+    for dimensions in ([100000], [300, 200], [3, 50, 40, 30]):
+        counts = tile_counts(dimensions, 10, MAX_PAYLOAD_SIZE)
+        tile = np.full(counts, -(1 << 63), dtype=np.int64)
+        message = Message.get_object_message(
+            EncodedBody.from_model(
+                GetDataSubarraysResponse.construct(
+                    data_subarrays={
+                        "k"
+                        * 64: DataArray.construct(
+                            dimensions=[-(1 << 63)] * len(dimensions),
+                            data=to_any_array(tile),
+                        )
+                    }
+                )
+            ),
+            msg_id=-(1 << 63),
+            correlation_id=-(1 << 63),
+        )
+        assert len(message.encode_message()) <= MAX_PAYLOAD_SIZE
+
+
+@pytest.mark.asyncio
+async def test_unsupported_dtypes():
+    connection = _store_connection()
+    for request in (
+        GetDataArrayMetadata(
+            data_arrays={
+                "grid": _uid("/grid"),
+                "words": _uid("/words"),
+                "uint64": _uid("/uint64"),
+            }
+        ),
+        GetDataArrays(
+            data_arrays={
+                "small": _uid("/small"),
+                "words": _uid("/words"),
+                "uint64": _uid("/uint64"),
+            }
+        ),
+    ):
+        response, error = await _ask(connection, request, msg_id=2)
+        assert (
+            len(
+                getattr(response.body, "array_metadata", None)
+                or response.body.data_arrays
+            )
+            == 1
+        )
+        assert isinstance(error.body, ProtocolException)
+        assert {key: e.code for key, e in error.body.errors.items()} == {
+            "words": NotSupportedError.code,
+            "uint64": NotSupportedError.code,
+        }
+
+
+@pytest.mark.asyncio
+async def test_oversized_array_in_tiles():
+    connection = _store_connection()
+
+    answer = await _ask(
+        connection,
+        GetDataArrays(
+            data_arrays={
+                "grid": _uid("/grid"),
+                "small": _uid("/small"),
+                "none": _uid("/none"),
+            }
+        ),
+        msg_id=2,
+    )
+    assert isinstance(answer[0].body, GetDataArraysResponse)
+    assert list(answer[0].body.data_arrays) == ["small"]
+    assert answer[0].body.data_arrays["small"].data.item.values.tolist() == (
+        small.tolist()
+    )
+    assert isinstance(answer[1].body, ProtocolException)
+    assert answer[1].body.errors["grid"].code == MaxSizeExceededError.code
+    assert answer[1].body.errors["none"].code == NotFoundError.code
+
+    answer = await _ask(
+        connection,
+        GetDataArrayMetadata(data_arrays={"grid": _uid("/grid")}),
+        msg_id=4,
+    )
+    metadata = answer[0].body.array_metadata["grid"]
+    assert metadata.dimensions == [300, 200]
+    assert metadata.transport_array_type == AnyArrayType.ARRAY_OF_DOUBLE
+
+    out = np.zeros((300, 200))
+    assembler = SubarrayAssembler(
+        _uid("/grid"), metadata, MAX_PAYLOAD_SIZE, out=out
+    )
+    rows = metadata.preferred_subarray_dimensions[0]
+    assert metadata.preferred_subarray_dimensions == [rows, 200]
+    assert len(assembler.tiles) == -(-300 // rows)
+    answer = await _ask(connection, assembler.request(), msg_id=6)
+    assert len(answer) > 1
+    for i, response in enumerate(answer):
+        assert assembler.add(response.body.data_subarrays) == (
+            i == len(answer) - 1
+        )
+    assert assembler.array is out
+    assert np.array_equal(out, grid)
+
+
+def test_assembler_checks_output_shape():
+    metadata = DataArrayMetadata(
+        dimensions=[300, 200],
+        preferred_subarray_dimensions=[],
+        transport_array_type=AnyArrayType.ARRAY_OF_DOUBLE,
+        logical_array_type=AnyLogicalArrayType.ARRAY_OF_DOUBLE64_LE,
+        store_last_write=0,
+        store_created=0,
+        custom_data={},
+    )
+    with pytest.raises(ValueError):
+        SubarrayAssembler(
+            _uid("/grid"), metadata, MAX_PAYLOAD_SIZE, out=np.zeros((3, 2))
+        )
+    with pytest.raises(ValueError):
+        SubarrayAssembler(
+            _uid("/grid"),
+            metadata.copy(
+                update={"transport_array_type": AnyArrayType.ARRAY_OF_STRING}
+            ),
+            MAX_PAYLOAD_SIZE,
+        )
+
+
+def test_assembler_without_payload_limit():
+    metadata = _metadata([300, 200])
+    for max_payload_size in (0, -1):
+        assembler = SubarrayAssembler(
+            _uid("/grid"), metadata, max_payload_size
+        )
+        (tile,) = assembler.tiles.values()
+        assert tile.starts == [0, 0] and tile.counts == [300, 200]
+        assert assembler.add(
+            {"0": DataArray(dimensions=[300, 200], data=to_any_array(grid))}
+        )
+        assert np.array_equal(assembler.array, grid)
+
+
+def _metadata(dimensions: List[int]) -> DataArrayMetadata:
+    return DataArrayMetadata(
+        dimensions=dimensions,
+        preferred_subarray_dimensions=[],
+        transport_array_type=AnyArrayType.ARRAY_OF_DOUBLE,
+        logical_array_type=AnyLogicalArrayType.ARRAY_OF_DOUBLE64_LE,
+        store_last_write=0,
+        store_created=0,
+        custom_data={},
+    )
+
+
+def _fetcher(max_in_flight: int) -> SubarrayFetcher:
+    """A fetcher of a client connection that exchanges its messages with a GridStore in memory"""
+    store = _store_connection()
+    client = ETPConnection(connection_type=ConnectionType.CLIENT)
+    client.is_connected = True
+    client.client_info.endpoint_capabilities[
+        "MaxWebSocketMessagePayloadSize"
+    ] = MAX_PAYLOAD_SIZE
+
+    async def deliver(msg_data: bytes) -> None:
+        # the other requests are sent meanwhile
+        await asyncio.sleep(0.001)
+        async for answer in store.handle_bytes_generator(msg_data):
+            msg = Message.decode_binary_message(
+                answer, ETPConnection.generic_transition_table
+            )
+            if isinstance(msg.body, ProtocolException):
+                # forwarded by the Core handler of the client
+                async for _ in fetcher.on_protocol_exception(
+                    msg.body, msg.header
+                ):
+                    pass
+            else:
+                async for _ in client.handle_bytes_generator(answer):
+                    pass
+
+    async def send(msg_data: bytes) -> None:
+        fetcher.max_seen = max(fetcher.max_seen, fetcher.in_flight())
+        asyncio.ensure_future(deliver(msg_data))
+
+    fetcher = SubarrayFetcher(client, send, max_in_flight=max_in_flight)
+    fetcher.max_seen = 0
+    client.handlers[CommunicationProtocol.DATA_ARRAY] = fetcher
+    return fetcher
+
+
+@pytest.mark.asyncio
+async def test_fetcher_bounded_window(tmp_path):
+    fetcher = _fetcher(max_in_flight=3)
+    array = await fetcher.fetch(_uid("/grid"), _metadata([300, 200]))
+    assert np.array_equal(array, grid)
+    assert fetcher.max_seen == 3
+    assert fetcher.in_flight() == 0
+
+    path = tmp_path / "grid.npy"
+    array = await fetcher.fetch(
+        _uid("/grid"), _metadata([300, 200]), out=str(path)
+    )
+    assert isinstance(array, np.memmap)
+    assert np.array_equal(np.load(path, mmap_mode="r"), grid)
+
+
+@pytest.mark.asyncio
+async def test_fetcher_error():
+    fetcher = _fetcher(max_in_flight=2)
+    with pytest.raises(SubarrayFetchError) as err:
+        await fetcher.fetch(_uid("/none"), _metadata([300, 200]))
+    assert err.value.error.code == NotFoundError.code
+    await asyncio.sleep(0.01)
+    assert fetcher.in_flight() == 0